@@ -1,40 +1,84 @@
-"""Application entry point."""
+"""Application entry point.
+
+Importing this package only sets up the extensions; the blueprints and
+everything they pull in are imported by create_app.
+"""
 import os
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from flask_migrate import Migrate
+from sqlalchemy import orm
+
+from app.database import SQLAlchemy, init_replicas
 
 db = SQLAlchemy()
 login_manager = LoginManager()
 
-from config import app_config
-from app.algorithms.routes import algo_bp
-from app.users.routes import auth_bp
-from app.category.routes import cat_bp
-from app.models import seed_db
 
-
-def create_app(env):
+def create_app(env=None):
     """Configure and create flask app."""
+    from flask_migrate import Migrate
+
+    from config import app_config
+    from app.algorithms.routes import algo_bp
+    from app.users.routes import auth_bp
+    from app.category.routes import cat_bp
+    from app.diagnostics.routes import diag_bp
+    from app.algorithms.commands import algo_cli
+    from app.algorithms.revisions import init_revision_cache
+    from app.algorithms.search import include_object, search_cli
+    from app.cache import init_cache
+    from app.compression import init_compression
+    from app.events import init_events
+    from app.identity import init_identity_cache
+    from app.metrics import init_metrics
+    from app.profiling import init_profiling
+    from app.ratelimit import init_rate_limits
+    from app.subrequests import init_batch_requests
+    from app.users.commands import seed_command
+
     app = Flask(__name__)
     app.secret_key = os.getenv('SECRET') or 'a-very-long-string'
-    app.config.from_object(app_config[env])
+    app.config.from_object(app_config[env or os.getenv('ENV', 'development')])
     db.init_app(app)
-    Migrate(app, db)
+    # Before any hook loading the user, so that query can use a replica.
+    init_replicas(db, app)
+    init_metrics(app)
+    init_profiling(app)
+    init_rate_limits(app)
+    Migrate(app, db, include_object=include_object)
     login_manager.init_app(app)
+    init_cache(app)
+    init_compression(app)
+    init_identity_cache(app)
+    init_revision_cache(app)
+    init_events(app)
+    init_batch_requests(app)
 
     app.register_blueprint(algo_bp)
     app.register_blueprint(auth_bp, url_prefix='/users')
     app.register_blueprint(cat_bp, url_prefix='/categories')
+    app.register_blueprint(diag_bp, url_prefix='/debug')
+    app.cli.add_command(algo_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(seed_command)
+    return app
 
-    @app.before_first_request
-    def initialize():
-        """Initialize the app."""
-        seed_db()
 
-    return app
+def preload(app):
+    """Build shared read-only state before a server forks its workers.
+
+    Mappers and the URL map are compiled once in the parent process, and
+    the engines are created without keeping any connection open, so
+    workers never share a socket.
+    """
+    with app.app_context():
+        orm.configure_mappers()
+        app.url_map.update()
+        db.dispose_engines(app)
 
 
-app = create_app(os.getenv('ENV', 'development'))
+def after_fork(app):
+    """Give a freshly forked worker its own database connections."""
+    with app.app_context():
+        db.dispose_engines(app)
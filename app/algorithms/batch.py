@@ -0,0 +1,105 @@
+"""Create, update and delete many algorithms in one transaction."""
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db
+from app.algorithms.bulk import validate_row
+from app.models import Algorithm, Category, db_batch
+
+OPERATIONS = ('create', 'update', 'delete')
+
+
+class OperationError(Exception):
+    """An operation that cannot be applied, with its HTTP status."""
+
+    def __init__(self, message, status=400):
+        super(OperationError, self).__init__(message)
+        self.status = status
+
+
+class BatchAborted(Exception):
+    """Raised to roll a batch back when any operation failed."""
+
+
+def apply_operation(operation, algos, user_id, category_ids):
+    """Apply one operation and return the algorithm it touched."""
+    if not isinstance(operation, dict):
+        raise OperationError('Expected a JSON object.')
+    name = operation.get('op')
+    if name not in OPERATIONS:
+        raise OperationError('Invalid op.')
+    data = dict(operation)
+    del data['op']
+    if name == 'create':
+        try:
+            row = validate_row(data, category_ids)
+        except ValueError as error:
+            raise OperationError(str(error))
+        return Algorithm.add(user_id=user_id, **row)
+
+    algo_id = data.pop('id', None)
+    if not isinstance(algo_id, int) or isinstance(algo_id, bool):
+        raise OperationError('Invalid id.')
+    algo = algos.get(algo_id)
+    if algo is None:
+        raise OperationError('Algorithm does not exist.', 404)
+    if algo.user_id != user_id:
+        raise OperationError('Unauthorized.', 403)
+    if name == 'delete':
+        algo.delete()
+        del algos[algo.id]
+        return algo
+    try:
+        row = validate_row(data, category_ids, partial=True)
+    except ValueError as error:
+        raise OperationError(str(error))
+    for attr, value in row.items():
+        setattr(algo, attr, value)
+    algo.save()
+    return algo
+
+
+def apply_operations(operations, user_id):
+    """Apply operations atomically.
+
+    Return per-operation results, or per-operation errors if anything
+    failed and the whole batch was rolled back. Each operation is flushed
+    on its own, so a database error is reported at its index; the
+    transaction cannot go on after one, so later operations are not tried.
+    """
+    ids = [operation.get('id') for operation in operations
+           if isinstance(operation, dict) and
+           isinstance(operation.get('id'), int)]
+    algos = {algo.id: algo for algo in
+             Algorithm.query.filter(Algorithm.id.in_(ids))} if ids else {}
+    category_ids = {id_ for id_, in db.session.query(Category.id)}
+    touched, errors = [], []
+    try:
+        with db_batch():
+            for index, operation in enumerate(operations):
+                try:
+                    algo = apply_operation(
+                        operation, algos, user_id, category_ids)
+                    db.session.flush()
+                    touched.append((index, operation['op'], algo))
+                except OperationError as error:
+                    errors.append({'index': index, 'status': error.status,
+                                   'message': str(error)})
+                except SQLAlchemyError:
+                    errors.append({'index': index, 'status': 400,
+                                   'message': 'Could not be saved.'})
+                    break
+            if errors:
+                raise BatchAborted()
+            results = [result(index, name, algo)
+                       for index, name, algo in touched]
+    except BatchAborted:
+        return None, errors
+    return results, None
+
+
+def result(index, name, algo):
+    """Return the result of a successful operation as a Dict."""
+    if name == 'delete':
+        return {'index': index, 'status': 200, 'id': algo.id}
+    return {'index': index, 'status': 201 if name == 'create' else 200,
+            'algorithm': algo.get_secure_attributes()}
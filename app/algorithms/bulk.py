@@ -0,0 +1,113 @@
+"""Batched NDJSON import of algorithms."""
+import json
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db
+from app.models import Algorithm, Category, db_batch
+
+MAX_REPORTED_ERRORS = 100
+TEXT_FIELDS = ('content', 'sub_category', 'access')
+
+
+class ImportReport(object):
+    """Count imported rows and collect per-line errors."""
+
+    def __init__(self):
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, line, message):
+        """Record an error, keeping the first MAX_REPORTED_ERRORS."""
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'message': message})
+
+    def to_dict(self):
+        """Return the report as a Dict."""
+        return {'imported': self.imported, 'error_count': self.error_count,
+                'errors': self.errors}
+
+
+def parse_row(line, category_ids):
+    """Return Algorithm attributes from an NDJSON line.
+
+    Raise ValueError with a message for the client if the row is invalid.
+    """
+    try:
+        data = json.loads(line.decode() if isinstance(line, bytes) else line)
+    except ValueError:
+        raise ValueError('Invalid JSON.')
+    return validate_row(data, category_ids)
+
+
+def validate_row(data, category_ids, partial=False):
+    """Return Algorithm attributes from a decoded JSON object.
+
+    With `partial`, only the attributes present are checked and returned.
+    Raise ValueError with a message for the client if they are invalid.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object.')
+
+    row = {}
+    title = data.get('title')
+    if not partial or 'title' in data:
+        if not isinstance(title, str) or not title.strip():
+            raise ValueError('Invalid title.')
+        row['title'] = title
+    if not partial or 'category_id' in data or 'category' in data:
+        try:
+            category_id = int(data.get('category_id', data.get('category')))
+        except (TypeError, ValueError):
+            category_id = None
+        if category_id not in category_ids:
+            raise ValueError('Invalid category id.')
+        row['category_id'] = category_id
+    for field in TEXT_FIELDS:
+        value = data.get(field)
+        if value is not None and not isinstance(value, str):
+            raise ValueError('Invalid {}.'.format(field))
+        if value is not None:
+            row[field] = value
+    return row
+
+
+def save_batch(batch, user_id, report):
+    """Insert a batch in one transaction, retrying row by row on failure."""
+    try:
+        with db_batch(len(batch)):
+            for _, row in batch:
+                Algorithm.add(user_id=user_id, **row)
+        report.imported += len(batch)
+        return
+    except SQLAlchemyError:
+        pass
+    for line, row in batch:
+        try:
+            Algorithm.add(user_id=user_id, **row)
+            report.imported += 1
+        except SQLAlchemyError:
+            db.session.rollback()
+            report.error(line, 'Could not be saved.')
+
+
+def import_algorithms(lines, user_id, batch_size):
+    """Validate and insert NDJSON lines for a user in batches."""
+    category_ids = {id_ for id_, in db.session.query(Category.id)}
+    report = ImportReport()
+    batch = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            batch.append((number, parse_row(line, category_ids)))
+        except ValueError as error:
+            report.error(number, str(error))
+        if len(batch) == batch_size:
+            save_batch(batch, user_id, report)
+            batch = []
+    if batch:
+        save_batch(batch, user_id, report)
+    return report
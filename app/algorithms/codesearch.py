@@ -0,0 +1,310 @@
+"""Substring and regex search inside algorithm bodies, narrowed by trigrams.
+
+A posting table of the lowercased trigrams of each body narrows the search
+to bodies containing every trigram of the literal text a match needs;
+candidates are then checked with the exact pattern, under a time limit
+since a regex can backtrack for exponentially long. Mapper events keep the
+index in the same transaction as the write.
+"""
+import bisect
+import time
+
+import regex as regex_module
+from flask import current_app
+from sqlalchemy import column, event, func, inspect, select, table, text
+
+from app import db
+from app.blobs import read_content
+from app.models import Algorithm, ContentBlob, load_contents
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# It starts with the full-text index name, so migrations skip it.
+INDEX_TABLE = 'algorithm_search_trigram'
+# Mapped attributes whose changes alter the body.
+TRACKED = ('content_hash', 'inline_content')
+# Seconds before a missing index table is looked for again.
+RECHECK_INTERVAL = 30
+
+# Unindexing looks rows up by algorithm, hence the second index.
+CREATE_INDEX = {
+    'sqlite': [
+        "CREATE TABLE IF NOT EXISTS algorithm_search_trigram ("
+        "trigram INTEGER NOT NULL, algorithm_id INTEGER NOT NULL, "
+        "PRIMARY KEY (trigram, algorithm_id)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS ix_algorithm_search_trigram_algorithm "
+        "ON algorithm_search_trigram (algorithm_id)"
+    ],
+    'postgresql': [
+        "CREATE TABLE IF NOT EXISTS algorithm_search_trigram ("
+        "trigram BIGINT NOT NULL, algorithm_id INTEGER NOT NULL "
+        "REFERENCES algorithm (id) ON DELETE CASCADE, "
+        "PRIMARY KEY (trigram, algorithm_id))",
+        "CREATE INDEX IF NOT EXISTS ix_algorithm_search_trigram_algorithm "
+        "ON algorithm_search_trigram (algorithm_id)"
+    ]
+}
+
+INSERT_DOCUMENT = {
+    'sqlite': (
+        "INSERT OR IGNORE INTO algorithm_search_trigram "
+        "(trigram, algorithm_id) VALUES (:trigram, :id)"),
+    'postgresql': (
+        "INSERT INTO algorithm_search_trigram (trigram, algorithm_id) "
+        "VALUES (:trigram, :id) ON CONFLICT DO NOTHING")
+}
+
+trigrams_table = table(INDEX_TABLE, column('trigram'), column('algorithm_id'))
+
+_ready = {}
+
+
+def supported(connection):
+    """Check whether the database has a code index implementation."""
+    return connection.dialect.name in CREATE_INDEX
+
+
+def index_ready(connection):
+    """Check whether the code index table exists.
+
+    A table found is remembered; a missing one is looked for again after
+    RECHECK_INTERVAL seconds, so workers notice it once migrations ran.
+    """
+    url = str(connection.engine.url)
+    ready, checked_at = _ready.get(url, (False, None))
+    if not ready and (checked_at is None or
+                      time.time() - checked_at >= RECHECK_INTERVAL):
+        ready = supported(connection) and connection.dialect.has_table(
+            connection, INDEX_TABLE)
+        _ready[url] = (ready, time.time())
+    return ready
+
+
+def create_index(connection):
+    """Create the code index table if it is missing."""
+    for statement in CREATE_INDEX[connection.dialect.name]:
+        connection.execute(text(statement))
+    _ready[str(connection.engine.url)] = (True, time.time())
+
+
+def drop_index(connection):
+    """Drop the code index table."""
+    connection.execute(text('DROP TABLE IF EXISTS ' + INDEX_TABLE))
+    _ready.pop(str(connection.engine.url), None)
+
+
+def trigrams(value):
+    """Return the distinct lowercased trigrams of a string as integers."""
+    value = value.lower()
+    return {(ord(value[i]) << 42) | (ord(value[i + 1]) << 21) |
+            ord(value[i + 2]) for i in range(len(value) - 2)}
+
+
+def unindex(connection, ids):
+    """Remove algorithms from the index."""
+    connection.execute(trigrams_table.delete().where(
+        trigrams_table.c.algorithm_id.in_(ids)))
+
+
+def index_contents(connection, contents):
+    """Add or replace the bodies of algorithms keyed by id."""
+    unindex(connection, list(contents))
+    rows = [{'id': algo_id, 'trigram': trigram}
+            for algo_id, content in contents.items()
+            for trigram in trigrams(content or '')]
+    if rows:
+        connection.execute(
+            text(INSERT_DOCUMENT[connection.dialect.name]), rows)
+
+
+@event.listens_for(Algorithm.__table__, 'after_create')
+def on_algorithm_table_create(target, connection, **kw):
+    """Create the code index alongside the algorithm table."""
+    if supported(connection):
+        create_index(connection)
+
+
+@event.listens_for(Algorithm.__table__, 'before_drop')
+def on_algorithm_table_drop(target, connection, **kw):
+    """Drop the code index before the algorithm table."""
+    if supported(connection):
+        drop_index(connection)
+
+
+@event.listens_for(Algorithm, 'after_insert')
+def on_algorithm_insert(mapper, connection, target):
+    """Index the body of a new algorithm."""
+    if index_ready(connection):
+        index_contents(connection, {target.id: target.content})
+
+
+@event.listens_for(Algorithm, 'after_update')
+def on_algorithm_update(mapper, connection, target):
+    """Reindex an algorithm whose body changed."""
+    attrs = inspect(target).attrs
+    changed = any(attrs[name].history.has_changes() for name in TRACKED)
+    if changed and index_ready(connection):
+        index_contents(connection, {target.id: target.content})
+
+
+@event.listens_for(Algorithm, 'after_delete')
+def on_algorithm_delete(mapper, connection, target):
+    """Remove a deleted algorithm from the index."""
+    if index_ready(connection):
+        unindex(connection, [target.id])
+
+
+def required_literals(parsed):
+    """Return the literal runs every match of a parsed regex contains."""
+    literals, run = [], []
+    for op, arg in parsed:
+        if op == sre_parse.LITERAL:
+            run.append(chr(arg))
+            continue
+        literals.append(''.join(run))
+        run = []
+        if op == sre_parse.SUBPATTERN:
+            literals.extend(required_literals(arg[-1]))
+        elif (op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and
+                arg[0] >= 1):
+            literals.extend(required_literals(arg[2]))
+    literals.append(''.join(run))
+    return [literal for literal in literals if len(literal) >= 3]
+
+
+class QueryTimeout(Exception):
+    """Raised when matching takes longer than CODE_SEARCH_TIMEOUT."""
+
+
+class CodeQuery(object):
+    """A substring or regex query and the literals narrowing it.
+
+    Patterns are compiled with the regex package, whose matching can be
+    given a timeout; the literals are read with Python's own parser.
+    """
+
+    def __init__(self, query, regex=False, ignore_case=False):
+        if len(query) > current_app.config['CODE_SEARCH_MAX_QUERY']:
+            raise ValueError('Query is too long.')
+        flags = regex_module.IGNORECASE if ignore_case else 0
+        if regex:
+            try:
+                self.pattern = regex_module.compile(query, flags)
+                literals = required_literals(sre_parse.parse(query, flags))
+            except (regex_module.error, sre_parse.error):
+                raise ValueError('Invalid regular expression.')
+        else:
+            self.pattern = regex_module.compile(
+                regex_module.escape(query), flags)
+            literals = [query] if len(query) >= 3 else []
+        if not literals:
+            raise ValueError(
+                'Query needs at least 3 consecutive literal characters.')
+        self.literals = literals
+
+    def matches(self, content, limit, deadline):
+        """Return the positions of up to limit matches in a body.
+
+        Raise QueryTimeout if matching goes on past the deadline.
+        """
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            raise QueryTimeout()
+        lines = None
+        found = []
+        try:
+            for match in self.pattern.finditer(content or '',
+                                               timeout=timeout):
+                if match.end() == match.start():
+                    continue
+                if lines is None:
+                    lines = [0] + [i + 1 for i, char in enumerate(content)
+                                   if char == '\n']
+                line = bisect.bisect_right(lines, match.start()) - 1
+                end_of_line = content.find('\n', match.start())
+                if end_of_line < 0:
+                    end_of_line = len(content)
+                found.append({
+                    'start': match.start(), 'end': match.end(),
+                    'line': line + 1,
+                    'column': match.start() - lines[line] + 1,
+                    'text': content[lines[line]:end_of_line][:200]})
+                if len(found) == limit:
+                    break
+        except TimeoutError:
+            raise QueryTimeout()
+        return found
+
+
+def candidates(connection, query, after, limit):
+    """Return ids above after of bodies that contain every literal."""
+    grams = set()
+    for literal in query.literals:
+        grams.update(trigrams(literal))
+    statement = select([trigrams_table.c.algorithm_id]).where(
+        trigrams_table.c.trigram.in_(grams)).where(
+        trigrams_table.c.algorithm_id > after).group_by(
+        trigrams_table.c.algorithm_id).having(
+        func.count() == len(grams)).order_by(
+        trigrams_table.c.algorithm_id)
+    return [row[0] for row in connection.execute(statement.limit(limit))]
+
+
+def search_code(query, limit, after=0):
+    """Return matching (id, matches) pairs after an id and a next cursor.
+
+    At most CODE_SEARCH_MAX_CANDIDATES candidates are checked per call; the
+    cursor is the last id checked, or None when no candidates are left.
+    Return None when the database has no code index, and raise QueryTimeout
+    when matching takes longer than CODE_SEARCH_TIMEOUT seconds.
+    """
+    connection = db.session.connection()
+    if not index_ready(connection):
+        return None
+    config = current_app.config
+    batch_size = config['CODE_SEARCH_BATCH_SIZE']
+    budget = config['CODE_SEARCH_MAX_CANDIDATES']
+    deadline = time.time() + config['CODE_SEARCH_TIMEOUT']
+    results = []
+    while budget > 0:
+        ids = candidates(connection, query, after, min(batch_size, budget))
+        if not ids:
+            return results, None
+        budget -= len(ids)
+        contents = load_contents(ids)
+        for algo_id in ids:
+            after = algo_id
+            found = query.matches(contents.get(algo_id),
+                                  config['CODE_SEARCH_MAX_MATCHES'], deadline)
+            if found:
+                results.append((algo_id, found))
+                if len(results) == limit:
+                    return results, after
+    return results, after
+
+
+def rebuild_code_index(batch_size=500):
+    """Recreate the code index from the algorithm table."""
+    algorithms, blobs = Algorithm.__table__, ContentBlob.__table__
+    joined = algorithms.outerjoin(
+        blobs, blobs.c.hash == algorithms.c.content_hash)
+    count, last_id = 0, 0
+    with db.engine.begin() as connection:
+        drop_index(connection)
+        create_index(connection)
+        while True:
+            rows = connection.execute(
+                select([algorithms.c.id, algorithms.c.content, blobs.c.data,
+                        blobs.c.encoding]).select_from(joined)
+                .where(algorithms.c.id > last_id)
+                .order_by(algorithms.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            index_contents(connection, {
+                row[0]: read_content(*row[1:]) for row in rows})
+            count += len(rows)
+            last_id = rows[-1].id
+    return count
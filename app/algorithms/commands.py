@@ -0,0 +1,129 @@
+"""Maintenance commands for algorithms."""
+import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import exists, select
+
+from app import db
+from app.algorithms.similarity import rebuild_similarity
+from app.changes import backfill_changes
+from app.models import Algorithm, ContentBlob, hash_content, store_blobs
+
+algo_cli = AppGroup('algorithms', help='Maintain stored algorithms.')
+
+
+def backfill_content_hashes(batch_size=500):
+    """Fill in the content hash and length of rows written before them."""
+    table = Algorithm.__table__
+    count, last_id = 0, 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(
+                select([table.c.id, table.c.content])
+                .where(table.c.id > last_id)
+                .where(table.c.content_hash.is_(None))
+                .order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                return count
+            updates = []
+            for row in rows:
+                content_hash, content_length = hash_content(row.content)
+                updates.append({'row_id': row.id, 'hash': content_hash,
+                                'length': content_length})
+            connection.execute(
+                table.update()
+                .where(table.c.id == db.bindparam('row_id'))
+                .values(content_hash=db.bindparam('hash'),
+                        content_length=db.bindparam('length')), updates)
+        count += len(rows)
+        last_id = rows[-1].id
+
+
+@algo_cli.command('backfill-hashes')
+@click.option('--batch-size', default=500, help='Rows updated per commit.')
+def backfill_hashes_command(batch_size):
+    """Compute content hashes and lengths missing from older rows."""
+    count = backfill_content_hashes(batch_size)
+    click.echo('Updated {} algorithms.'.format(count))
+
+
+def migrate_contents(batch_size=500):
+    """Move inline bodies into the blob table, one batch per transaction."""
+    table = Algorithm.__table__
+    count, last_id = 0, 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(
+                select([table.c.id, table.c.content])
+                .where(table.c.id > last_id)
+                .where(table.c.content.isnot(None))
+                .order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                return count
+            contents, updates = {}, []
+            for row in rows:
+                content_hash, content_length = hash_content(row.content)
+                contents[content_hash] = row.content
+                updates.append({'row_id': row.id, 'hash': content_hash,
+                                'length': content_length})
+            store_blobs(connection, contents)
+            # Rows rewritten since they were read already point at a blob.
+            connection.execute(
+                table.update()
+                .where(table.c.id == db.bindparam('row_id'))
+                .where(table.c.content.isnot(None))
+                .values(content=None, content_hash=db.bindparam('hash'),
+                        content_length=db.bindparam('length')), updates)
+        count += len(rows)
+        last_id = rows[-1].id
+
+
+def prune_blobs(older_than=3600):
+    """Delete blobs no algorithm points at.
+
+    Blobs younger than `older_than` seconds are kept, as the algorithm
+    pointing at them may not be committed yet.
+    """
+    blobs, table = ContentBlob.__table__, Algorithm.__table__
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=older_than)
+    with db.engine.begin() as connection:
+        return connection.execute(
+            blobs.delete()
+            .where(blobs.c.created_at < cutoff)
+            .where(~exists().where(table.c.content_hash == blobs.c.hash))
+        ).rowcount
+
+
+@algo_cli.command('migrate-blobs')
+@click.option('--batch-size', default=500, help='Rows moved per commit.')
+def migrate_blobs_command(batch_size):
+    """Move algorithm bodies still stored inline to the blob table."""
+    count = migrate_contents(batch_size)
+    click.echo('Moved {} algorithms.'.format(count))
+
+
+@algo_cli.command('prune-blobs')
+@click.option('--older-than', default=3600,
+              help='Keep unreferenced blobs younger than this many seconds.')
+def prune_blobs_command(older_than):
+    """Delete stored bodies that no algorithm uses any more."""
+    count = prune_blobs(older_than)
+    click.echo('Deleted {} blobs.'.format(count))
+
+
+@algo_cli.command('rebuild-similarity')
+@click.option('--batch-size', default=500, help='Rows indexed per query.')
+def rebuild_similarity_command(batch_size):
+    """Recompute the similarity signatures of every algorithm."""
+    count = rebuild_similarity(batch_size)
+    click.echo('Indexed {} algorithms.'.format(count))
+
+
+@algo_cli.command('backfill-changes')
+@click.option('--batch-size', default=500, help='Rows logged per commit.')
+def backfill_changes_command(batch_size):
+    """Add algorithms and categories missing from the change feed."""
+    count = backfill_changes(batch_size)
+    click.echo('Logged {} rows.'.format(count))
@@ -0,0 +1,276 @@
+"""Keyset pagination and streaming for algorithm list endpoints.
+
+Rows are read as plain tuples through a Core select of the requested
+columns, skipping ORM hydration, and encoded with app.serializers.
+"""
+import base64
+import json
+from urllib.parse import urlencode
+
+from flask import Response, current_app, jsonify, request, stream_with_context
+from sqlalchemy import cast, func, literal, select, tuple_, union_all
+
+from app import db
+from app.blobs import read_content
+from app.models import Algorithm, ContentBlob
+from app.serializers import dumps, json_response
+
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'array': 'application/json'
+}
+
+SUMMARY_FIELDS = ('id', 'title', 'category_id', 'sub_category', 'access',
+                  'content_length', 'content_hash')
+FIELDS = SUMMARY_FIELDS + ('content', 'user_id')
+# The keys of Algorithm.get_secure_attributes.
+SECURE_FIELDS = ('id', 'title', 'content', 'category_id', 'sub_category',
+                 'user_id', 'access')
+# Search results show snippets instead of the bodies.
+SEARCH_FIELDS = tuple(name for name in SECURE_FIELDS if name != 'content')
+FACETS = ('category_id', 'sub_category', 'access')
+# Columns read for the content field: the inline body and its blob.
+CONTENT_COLUMNS = (Algorithm.inline_content, ContentBlob.data,
+                   ContentBlob.encoding)
+
+# Sort orders and the columns of their keyset, which always ends in id.
+SORTS = {
+    'id': ('id',),
+    'title': ('title', 'id')
+}
+COLUMN_TYPES = {'id': int, 'title': str}
+
+
+def encode_cursor(sort, descending, values):
+    """Return an opaque cursor pointing after a row in a sort order."""
+    key = [values[name] for name in SORTS[sort]]
+    raw = json.dumps({'sort': sort, 'descending': descending,
+                      'key': key}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(sort, descending, cursor):
+    """Return the sort key held by a cursor, or None if it is invalid.
+
+    A cursor is only valid in the sort order and direction it was issued
+    for.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw.decode())
+        key = data['key']
+        if (data['sort'] != sort or data['descending'] is not descending or
+                len(key) != len(SORTS[sort])):
+            return None
+        return [COLUMN_TYPES[name](value)
+                for name, value in zip(SORTS[sort], key)]
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def next_page_url(**params):
+    """Return the current URL with the given query parameters replaced."""
+    args = request.args.to_dict(flat=False)
+    args.update((key, [value]) for key, value in params.items())
+    return '{}?{}'.format(request.base_url, urlencode(args, doseq=True))
+
+
+def parse_fields(args):
+    """Return the fields selected by `view` or `fields`.
+
+    Raise ValueError for an unknown view or field.
+    """
+    view = args.get('view', 'full')
+    if view == 'summary':
+        return SUMMARY_FIELDS
+    if view != 'full':
+        raise ValueError(view)
+    if 'fields' not in args:
+        return SECURE_FIELDS
+    fields = tuple(args['fields'].split(','))
+    if not set(fields) <= set(FIELDS):
+        raise ValueError(fields)
+    return fields
+
+
+def select_columns(query, names, limit=None):
+    """Return a Core select of the named columns under a query's criteria.
+
+    The blob table is only joined when the content field is selected.
+    """
+    columns = []
+    for name in names:
+        if name == 'content':
+            columns.extend(CONTENT_COLUMNS)
+        else:
+            columns.append(getattr(Algorithm, name))
+    if 'content' in names:
+        query = query.outerjoin(
+            ContentBlob, ContentBlob.hash == Algorithm.content_hash)
+    statement = query.with_entities(*columns).statement
+    return statement if limit is None else statement.limit(limit)
+
+
+def to_dict(names, row):
+    """Return a row of select_columns as a Dict of the named fields."""
+    values = iter(row)
+    result = {}
+    for name in names:
+        if name == 'content':
+            result[name] = read_content(
+                next(values), next(values), next(values))
+        else:
+            result[name] = next(values)
+    return result
+
+
+def stream_algorithms(query, fmt, fields, limit=None):
+    """Yield algorithms as NDJSON or as a chunked JSON array."""
+    batch_size = current_app.config['STREAM_BATCH_SIZE']
+    result = db.session.execute(select_columns(query, fields, limit)
+                                .execution_options(stream_results=True))
+    if fmt == 'array':
+        yield b'['
+    separator = b''
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        yield render_chunk(
+            [dumps(to_dict(fields, row)) for row in rows], fmt, separator)
+        separator = b','
+    if fmt == 'array':
+        yield b']'
+
+
+def render_chunk(rows, fmt, separator):
+    """Join encoded rows into a single chunk of the stream."""
+    if fmt == 'ndjson':
+        return b'\n'.join(rows) + b'\n'
+    return separator + b','.join(rows)
+
+
+def filter_criteria(args):
+    """Return SQL criteria for the category, sub category and access filters.
+
+    Each filter may be repeated to match any of several values.
+    """
+    criteria = []
+    if 'category_id' in args:
+        try:
+            ids = [int(value) for value in args.getlist('category_id')]
+        except ValueError:
+            raise ValueError('Invalid category id.')
+        criteria.append(Algorithm.category_id.in_(ids))
+    for name in ('sub_category', 'access'):
+        if name in args:
+            criteria.append(getattr(Algorithm, name).in_(args.getlist(name)))
+    return criteria
+
+
+def parse_limit(args):
+    """Return the requested page size capped at MAX_PAGE_SIZE, or None."""
+    if 'limit' not in args:
+        return None
+    try:
+        limit = int(args['limit'])
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise ValueError('Invalid limit.')
+    return min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+
+def parse_sort(args):
+    """Return the sort order name and whether it is descending."""
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in SORTS:
+        raise ValueError('Invalid sort order.')
+    return sort, descending
+
+
+def algorithm_list(query):
+    """Return a filtered, sorted and keyset-paginated or streamed list.
+
+    Only the selected fields are loaded, so the summary view never reads
+    the content blobs.
+    """
+    args = request.args
+    try:
+        fmt = args.get('stream')
+        if fmt is not None and fmt not in STREAM_FORMATS:
+            raise ValueError('Invalid stream format.')
+        try:
+            fields = parse_fields(args)
+        except ValueError:
+            raise ValueError('Invalid fields.')
+        limit = parse_limit(args)
+        sort, descending = parse_sort(args)
+        query = query.filter(*filter_criteria(args))
+        columns = [getattr(Algorithm, name) for name in SORTS[sort]]
+        if 'after' in args:
+            key = decode_cursor(sort, descending, args['after'])
+            if key is None:
+                raise ValueError('Invalid cursor.')
+            position = tuple_(*columns) if len(columns) > 1 else columns[0]
+            key = tuple_(*key) if len(key) > 1 else key[0]
+            query = query.filter(position < key if descending else
+                                 position > key)
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+
+    query = query.order_by(
+        *[column.desc() if descending else column for column in columns])
+    if fmt is not None:
+        rows = stream_algorithms(query, fmt, fields, limit)
+        return Response(stream_with_context(rows),
+                        mimetype=STREAM_FORMATS[fmt])
+
+    extra = tuple(name for name in SORTS[sort] if name not in fields)
+    rows = db.session.execute(select_columns(
+        query, fields + extra, limit and limit + 1)).fetchall()
+    records = [to_dict(fields + extra, row) for row in rows[:limit]]
+    cursor = None
+    if limit is not None and len(rows) > limit:
+        cursor = encode_cursor(sort, descending, records[-1])
+    for record in records:
+        for name in extra:
+            del record[name]
+    response = json_response(records)
+    if cursor is not None:
+        response.headers['X-Next-Cursor'] = cursor
+        response.headers['Link'] = '<{}>; rel="next"'.format(
+            next_page_url(after=cursor))
+    return response
+
+
+def algorithm_facets(*criteria):
+    """Count matching algorithms per category, sub category and access.
+
+    The counts of every facet come back from a single UNION ALL query.
+    """
+    try:
+        criteria += tuple(filter_criteria(request.args))
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+    queries = []
+    for name in FACETS:
+        column = getattr(Algorithm, name)
+        query = select([literal(name).label('facet'),
+                        cast(column, db.String).label('value'),
+                        func.count().label('count')])
+        for criterion in criteria:
+            query = query.where(criterion)
+        queries.append(query.group_by(column))
+
+    facets = {name: [] for name in FACETS}
+    for row in db.session.execute(union_all(*queries)):
+        value = row.value
+        if row.facet == 'category_id' and value is not None:
+            value = int(value)
+        facets[row.facet].append({'value': value, 'count': row.count})
+    for counts in facets.values():
+        counts.sort(key=lambda item: -item['count'])
+    return jsonify(facets)
@@ -0,0 +1,279 @@
+"""Revision history of algorithms, kept as snapshots and line deltas.
+
+Every flush that changes a tracked field appends a revision in the same
+transaction. Most revisions are deltas against the previous one; a full
+snapshot is stored every REVISION_SNAPSHOT_INTERVAL revisions, or sooner
+when a delta would not be much smaller, so rebuilding any revision reads
+one snapshot and a bounded chain of deltas.
+"""
+import difflib
+import json
+import zlib
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+
+from app.cache import LRUBackend
+from app.models import Algorithm, ContentBlob, Revision
+from app.signals import on_commit
+
+FIELDS = ('title', 'content', 'category_id', 'sub_category', 'access')
+# Mapped attributes whose changes alter FIELDS.
+TRACKED = ('title', 'content_hash', 'inline_content', 'category_id',
+           'sub_category', 'access')
+
+
+def encode(payload):
+    """Return a snapshot or delta as stored bytes."""
+    return zlib.compress(json.dumps(
+        payload, separators=(',', ':'), sort_keys=True).encode())
+
+
+def decode(data):
+    """Return the snapshot or delta held by stored bytes."""
+    return json.loads(zlib.decompress(bytes(data)).decode())
+
+
+def diff_lines(old, new):
+    """Return the ops rebuilding new from the lines of old.
+
+    An op is either a [start, end] range of old lines to copy or a list of
+    new lines to insert.
+    """
+    old_lines, new_lines = old.splitlines(True), new.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(new_lines[j1:j2])
+    return ops
+
+
+def patch_lines(old, ops):
+    """Apply the ops of diff_lines to old."""
+    old_lines, lines = old.splitlines(True), []
+    for op in ops:
+        if op and isinstance(op[0], int):
+            lines.extend(old_lines[op[0]:op[1]])
+        else:
+            lines.extend(op)
+    return ''.join(lines)
+
+
+def make_delta(old, new):
+    """Return the changes turning one state into another."""
+    delta = {}
+    for name in FIELDS:
+        if old[name] == new[name]:
+            continue
+        if name == 'content' and None not in (old[name], new[name]):
+            delta['lines'] = diff_lines(old[name], new[name])
+        else:
+            delta.setdefault('set', {})[name] = new[name]
+    return delta
+
+
+def apply_delta(state, delta):
+    """Return a state with a delta applied."""
+    state = dict(state)
+    if 'lines' in delta:
+        state['content'] = patch_lines(state['content'], delta['lines'])
+    state.update(delta.get('set', {}))
+    return state
+
+
+def init_revision_cache(app):
+    """Attach a cache of rebuilt revisions to the app."""
+    app.extensions['revision_cache'] = LRUBackend(
+        app.config['REVISION_CACHE_SIZE'], app.config['REVISION_CACHE_TTL'])
+
+
+def revision_cache():
+    """Return the revision cache of the current app, if any."""
+    return has_app_context() and current_app.extensions.get('revision_cache')
+
+
+def cache_key(cache, algo_id, number):
+    """Return the cache key of a revision.
+
+    Keys include a generation bumped when an algorithm is deleted or its
+    revisions are rolled back, as their numbers can then be reused.
+    """
+    tag = 'algorithm:{}'.format(algo_id)
+    return '{}:{}:{}'.format(tag, cache.generations([tag])[0], number)
+
+
+def rebuild(connection, algo_id, number):
+    """Return the fields of an algorithm at a revision, or None."""
+    cache = revision_cache()
+    key = cache and cache_key(cache, algo_id, number)
+    state = cache and cache.get(key)
+    if state:
+        return state
+    table = Revision.__table__
+    start = select([table.c.number - table.c.chain]).where(
+        table.c.algorithm_id == algo_id).where(
+        table.c.number == number).as_scalar()
+    rows = connection.execute(
+        select([table.c.data])
+        .where(table.c.algorithm_id == algo_id)
+        .where(table.c.number.between(start, number))
+        .order_by(table.c.number)).fetchall()
+    if not rows:
+        return None
+    state = decode(rows[0].data)
+    for row in rows[1:]:
+        state = apply_delta(state, decode(row.data))
+    if cache:
+        cache.set(key, state)
+    return state
+
+
+def previous_state(algo):
+    """Return the fields of an algorithm before its flushed changes."""
+    attrs = inspect(algo).attrs
+    state = {}
+    for name in FIELDS:
+        if name != 'content':
+            history = attrs[name].history
+            state[name] = (history.deleted[0] if history.deleted else
+                           getattr(algo, name))
+    inline = attrs.inline_content.history
+    content_hash = attrs.content_hash.history
+    if not inline.has_changes() and not content_hash.has_changes():
+        state['content'] = algo.content
+    elif inline.deleted and inline.deleted[0] is not None:
+        state['content'] = inline.deleted[0]
+    else:
+        old_hash = content_hash.deleted[0] if content_hash.deleted else None
+        blob = old_hash and ContentBlob.query.get(old_hash)
+        state['content'] = blob.text if blob else None
+    return state
+
+
+def insert_revision(connection, algo_id, number, chain, payload):
+    """Store a revision."""
+    connection.execute(Revision.__table__.insert().values(
+        algorithm_id=algo_id, number=number, chain=chain,
+        data=encode(payload)))
+
+
+def record_revision(connection, algo, created):
+    """Append a revision for the current fields of an algorithm.
+
+    The algorithm row is locked first, so concurrent edits of one algorithm
+    number their revisions one after the other instead of both taking the
+    next number. SQLite, which renders no FOR UPDATE, lets one writer in at
+    a time anyway.
+    """
+    state = {name: getattr(algo, name) for name in FIELDS}
+    table = Revision.__table__
+    if not created:
+        algorithms = Algorithm.__table__
+        connection.execute(
+            select([algorithms.c.id])
+            .where(algorithms.c.id == algo.id).with_for_update())
+    latest = None if created else connection.execute(
+        select([table.c.number, table.c.chain])
+        .where(table.c.algorithm_id == algo.id)
+        .order_by(table.c.number.desc()).limit(1)).first()
+    if latest is None:
+        if not created:
+            # Algorithms written before revisions start from their old state.
+            previous = previous_state(algo)
+            if previous == state:
+                return
+            insert_revision(connection, algo.id, 1, 0, previous)
+        insert_revision(connection, algo.id, 1 if created else 2, 0, state)
+        return
+
+    base = rebuild(connection, algo.id, latest.number)
+    delta = make_delta(base, state)
+    if not delta:
+        return
+    interval = current_app.config['REVISION_SNAPSHOT_INTERVAL']
+    snapshot = encode(state)
+    if latest.chain + 1 < interval and len(encode(delta)) * 2 < len(snapshot):
+        insert_revision(connection, algo.id, latest.number + 1,
+                        latest.chain + 1, delta)
+    else:
+        insert_revision(connection, algo.id, latest.number + 1, 0, state)
+
+
+@event.listens_for(Session, 'after_flush')
+def record_revisions(session, flush_context):
+    """Record revisions of the algorithms written by a flush."""
+    revised = session.info.setdefault('revised_algorithms', set())
+    for item in list(session.new) + list(session.dirty):
+        if not isinstance(item, Algorithm) or item in session.deleted:
+            continue
+        created = item in session.new
+        attrs = inspect(item).attrs
+        if created or any(attrs[name].history.has_changes()
+                          for name in TRACKED):
+            record_revision(session.connection(), item, created)
+            revised.add(item.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def keep_revisions(session):
+    """Forget the algorithms revised by a committed transaction."""
+    session.info.pop('revised_algorithms', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_revisions(session):
+    """Drop cached revisions that were rolled back."""
+    revised = session.info.pop('revised_algorithms', ())
+    cache = revision_cache()
+    if cache:
+        for algo_id in revised:
+            cache.bump('algorithm:{}'.format(algo_id))
+
+
+@event.listens_for(Algorithm, 'before_delete')
+def delete_revisions(mapper, connection, target):
+    """Delete the revisions of a deleted algorithm."""
+    table = Revision.__table__
+    connection.execute(
+        table.delete().where(table.c.algorithm_id == target.id))
+
+
+@on_commit
+def invalidate_revisions(changes):
+    """Drop cached revisions of deleted algorithms."""
+    cache = revision_cache()
+    if not cache:
+        return
+    for change in changes:
+        if change.name == 'algorithm' and change.action == 'delete':
+            cache.bump('algorithm:{}'.format(change.id))
+
+
+def list_revisions(connection, algo_id):
+    """Return the revisions of an algorithm, oldest first."""
+    table = Revision.__table__
+    rows = connection.execute(
+        select([table.c.number, table.c.chain, table.c.created_at,
+                func.length(table.c.data).label('size')])
+        .where(table.c.algorithm_id == algo_id).order_by(table.c.number))
+    return [{'number': row.number, 'snapshot': row.chain == 0,
+             'stored_bytes': row.size,
+             'created_at': row.created_at.isoformat()} for row in rows]
+
+
+def diff_revisions(old, new):
+    """Return the field changes and a unified content diff of two states."""
+    fields = {name: {'from': old[name], 'to': new[name]}
+              for name in FIELDS
+              if name != 'content' and old[name] != new[name]}
+    diff = difflib.unified_diff(
+        (old['content'] or '').splitlines(True),
+        (new['content'] or '').splitlines(True),
+        'revision {}'.format(old['number']),
+        'revision {}'.format(new['number']))
+    return {'from': old['number'], 'to': new['number'], 'fields': fields,
+            'diff': ''.join(diff)}
@@ -1,20 +1,34 @@
 """Sample API routes."""
-from flask import Blueprint, jsonify, request
+from flask import (
+    Blueprint, Response, current_app, jsonify, request, stream_with_context)
 from flask_login import current_user
 
+from app import db
 from app.models import Algorithm
+from app.algorithms.batch import apply_operations
+from app.algorithms.codesearch import CodeQuery, QueryTimeout, search_code
+from app.algorithms.bulk import import_algorithms
+from app.algorithms.listing import (
+    SEARCH_FIELDS, SECURE_FIELDS, algorithm_facets, algorithm_list,
+    next_page_url, select_columns, stream_algorithms, to_dict)
+from app.algorithms.revisions import (
+    diff_revisions, list_revisions, rebuild)
+from app.algorithms.search import search_algorithms
+from app.algorithms.similarity import similar_summaries
+from app.changes import read_changes
+from app.events import CATEGORIES, event_stream, latest_seq
+from app.cache import cached
 
 
 algo_bp = Blueprint('algorithm', __name__)
 
 
 @algo_bp.route('/', methods=['GET', 'POST'])
+@cached('algorithms')
 def home():
     """Retrieve public algorithms or create an algorithm."""
     if request.method == 'GET':
-        algos = Algorithm.query.all()
-        algos = [algo.get_secure_attributes() for algo in algos]
-        return jsonify(algos)
+        return algorithm_list(Algorithm.query)
 
     if request.method == 'POST':
         if not current_user.is_authenticated:
@@ -32,6 +46,7 @@ def home():
 
 
 @algo_bp.route('/<int:algo_id>', methods=['GET', 'PUT', 'DELETE'])
+@cached('algorithm:{algo_id}', 'similar:{algo_id}', 'similarity')
 def algorithm(algo_id):
     """Return an algorithm given the ID."""
     algo = Algorithm.get(algo_id)
@@ -39,7 +54,12 @@ def algorithm(algo_id):
         return jsonify({'message': 'Algorithm does not exist.'}), 404
 
     if request.method == 'GET':
-        return jsonify(algo.get_secure_attributes()), 200
+        config = current_app.config
+        result = algo.get_secure_attributes()
+        result['similar'] = similar_summaries(
+            algo_id, config['SIMILARITY_SHOWN'],
+            config['SIMILARITY_THRESHOLD'])
+        return jsonify(result), 200
 
     if not current_user.is_authenticated:
         return jsonify({'message': 'Login required.'}), 401
@@ -59,3 +79,225 @@ def algorithm(algo_id):
         algo.delete()
         return jsonify(
             {'message': "'{}' was deleted.".format(title)}), 200
+
+
+@algo_bp.route('/<int:algo_id>/revisions', methods=['GET'])
+@cached('algorithm:{algo_id}')
+def revisions(algo_id):
+    """List the revisions of an algorithm."""
+    if not Algorithm.get(algo_id):
+        return jsonify({'message': 'Algorithm does not exist.'}), 404
+    return jsonify(list_revisions(db.session.connection(), algo_id)), 200
+
+
+def get_revision(algo_id, number):
+    """Return an algorithm's fields at a revision, or None."""
+    state = rebuild(db.session.connection(), algo_id, number)
+    return state and dict(state, number=number)
+
+
+@algo_bp.route('/<int:algo_id>/revisions/<int:number>', methods=['GET'])
+@cached('algorithm:{algo_id}')
+def revision(algo_id, number):
+    """Return an algorithm as it was at a revision."""
+    state = get_revision(algo_id, number)
+    if not state:
+        return jsonify({'message': 'Revision does not exist.'}), 404
+    return jsonify(state), 200
+
+
+@algo_bp.route('/<int:algo_id>/revisions/<int:old>/diff/<int:new>',
+               methods=['GET'])
+@cached('algorithm:{algo_id}')
+def revision_diff(algo_id, old, new):
+    """Compare two revisions of an algorithm."""
+    old_state, new_state = (get_revision(algo_id, old),
+                            get_revision(algo_id, new))
+    if not old_state or not new_state:
+        return jsonify({'message': 'Revision does not exist.'}), 404
+    return jsonify(diff_revisions(old_state, new_state)), 200
+
+
+@algo_bp.route('/algorithms/<int:algo_id>/similar', methods=['GET'])
+@cached('algorithm:{algo_id}', 'similar:{algo_id}', 'similarity')
+def similar(algo_id):
+    """Return the algorithms whose bodies are most like an algorithm's."""
+    if not Algorithm.get(algo_id):
+        return jsonify({'message': 'Algorithm does not exist.'}), 404
+    try:
+        limit = min(int(request.args.get('limit', 10)),
+                    current_app.config['MAX_PAGE_SIZE'])
+        threshold = float(request.args.get(
+            'min_similarity', current_app.config['SIMILARITY_THRESHOLD']))
+    except ValueError:
+        limit = threshold = -1
+    if limit < 1 or not 0 <= threshold <= 1:
+        return jsonify({'message': 'Invalid limit or similarity.'}), 400
+    return jsonify(similar_summaries(algo_id, limit, threshold)), 200
+
+
+@algo_bp.route('/algorithms/facets', methods=['GET'])
+@cached('algorithms')
+def facets():
+    """Count algorithms per category, sub category and access level."""
+    return algorithm_facets()
+
+
+@algo_bp.route('/search', methods=['GET'])
+def search():
+    """Return algorithms ranked by how well they match a search query."""
+    terms = request.args.get('q', '').strip()
+    try:
+        page = int(request.args.get('page', 1))
+        limit = min(int(request.args.get('limit', 20)),
+                    current_app.config['MAX_PAGE_SIZE'])
+    except ValueError:
+        page = limit = 0
+    if not terms or page < 1 or limit < 1:
+        return jsonify({'message': 'Invalid search query.'}), 400
+
+    hits = search_algorithms(terms, limit + 1, (page - 1) * limit)
+    if hits is None:
+        return jsonify({'message': 'Search is not available.'}), 503
+    query = Algorithm.query.filter(
+        Algorithm.id.in_([hit.id for hit in hits[:limit]]))
+    rows = db.session.execute(select_columns(query, SEARCH_FIELDS))
+    algos = {row.id: to_dict(SEARCH_FIELDS, row) for row in rows}
+    results = []
+    for hit in hits[:limit]:
+        result = algos[hit.id]
+        result.update(score=hit.score, snippet=hit.snippet)
+        results.append(result)
+    response = jsonify(results)
+    if len(hits) > limit:
+        response.headers['Link'] = '<{}>; rel="next"'.format(
+            next_page_url(page=page + 1))
+    return response
+
+
+@algo_bp.route('/algorithms/import', methods=['POST'])
+def bulk_import():
+    """Create algorithms from an NDJSON request body."""
+    if not current_user.is_authenticated:
+        return jsonify({'message': 'Login required.'}), 401
+    report = import_algorithms(request.stream, current_user.id,
+                               current_app.config['IMPORT_BATCH_SIZE'])
+    return jsonify(report.to_dict()), 200
+
+
+@algo_bp.route('/changes', methods=['GET'])
+def changes():
+    """Return the algorithms and categories changed after a sequence number.
+
+    With mine=1, only the current user's algorithms are included.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(int(request.args.get('limit', 500)),
+                    current_app.config['CHANGES_BATCH_SIZE'])
+    except ValueError:
+        since = limit = -1
+    if since < 0 or limit < 1:
+        return jsonify({'message': 'Invalid cursor or limit.'}), 400
+    user_id = None
+    if request.args.get('mine') in ('1', 'true'):
+        if not current_user.is_authenticated:
+            return jsonify({'message': 'Login required.'}), 401
+        user_id = current_user.id
+    return jsonify(read_changes(since, limit, user_id)), 200
+
+
+@algo_bp.route('/events', methods=['GET'])
+def events():
+    """Stream the current user's algorithm and category changes."""
+    if not current_user.is_authenticated:
+        return jsonify({'message': 'Login required.'}), 401
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    try:
+        since = None if since is None else int(since)
+    except ValueError:
+        since = -1
+    if since is not None and since < 0:
+        return jsonify({'message': 'Invalid event id.'}), 400
+    broker = current_app.extensions['events']
+    subscription = broker.subscribe(
+        ['user:{}'.format(current_user.id), CATEGORIES],
+        current_app.config['EVENTS_BUFFER_SIZE'])
+    if subscription is None:
+        return jsonify({'message': 'Too many event streams.'}), 503
+    if since is None:
+        since = latest_seq()
+    response = Response(
+        stream_with_context(
+            event_stream(subscription, current_user.id, since)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: broker.unsubscribe(subscription))
+    return response
+
+
+@algo_bp.route('/search/code', methods=['GET'])
+def search_code_route():
+    """Return algorithms whose bodies contain a substring or regex match."""
+    args = request.args
+    try:
+        limit = min(int(args.get('limit', 20)),
+                    current_app.config['MAX_PAGE_SIZE'])
+        after = int(args.get('after', 0))
+        if limit < 1 or after < 0:
+            raise ValueError('Invalid limit or cursor.')
+        query = CodeQuery(args.get('q', ''),
+                          regex=args.get('regex') in ('1', 'true'),
+                          ignore_case=args.get('ignore_case') in ('1', 'true'))
+    except ValueError as error:
+        return jsonify({'message': str(error)}), 400
+
+    try:
+        found = search_code(query, limit, after)
+    except QueryTimeout:
+        return jsonify({'message': 'Query took too long.'}), 400
+    if found is None:
+        return jsonify({'message': 'Search is not available.'}), 503
+    hits, cursor = found
+    titles = dict(db.session.query(Algorithm.id, Algorithm.title).filter(
+        Algorithm.id.in_([algo_id for algo_id, _ in hits]))) if hits else {}
+    response = jsonify([{'id': algo_id, 'title': titles.get(algo_id),
+                         'matches': matches} for algo_id, matches in hits])
+    if cursor is not None:
+        response.headers['X-Next-Cursor'] = str(cursor)
+        response.headers['Link'] = '<{}>; rel="next"'.format(
+            next_page_url(after=cursor))
+    return response
+
+
+@algo_bp.route('/algorithms/batch', methods=['POST'])
+def batch():
+    """Create, update or delete many algorithms in one transaction."""
+    if not current_user.is_authenticated:
+        return jsonify({'message': 'Login required.'}), 401
+    operations = request.get_json(silent=True)
+    if isinstance(operations, dict):
+        operations = operations.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'message': 'Expected a list of operations.'}), 400
+    if len(operations) > current_app.config['MAX_BATCH_OPERATIONS']:
+        return jsonify({'message': 'Too many operations.'}), 400
+    results, errors = apply_operations(operations, current_user.id)
+    if errors:
+        return jsonify({'message': 'No changes were saved.',
+                        'errors': errors}), 400
+    return jsonify({'results': results}), 200
+
+
+@algo_bp.route('/algorithms/export', methods=['GET'])
+def bulk_export():
+    """Stream the current user's algorithms as NDJSON."""
+    if not current_user.is_authenticated:
+        return jsonify({'message': 'Login required.'}), 401
+    query = Algorithm.query.filter_by(
+        user_id=current_user.id).order_by(Algorithm.id)
+    rows = stream_algorithms(query, 'ndjson', SECURE_FIELDS)
+    return Response(
+        stream_with_context(rows), mimetype='application/x-ndjson',
+        headers={'Content-Disposition':
+                 'attachment; filename=algorithms.ndjson'})
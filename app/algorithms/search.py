@@ -0,0 +1,251 @@
+"""Full-text search index over algorithm titles, bodies and sub categories.
+
+SQLite uses an FTS5 virtual table and Postgres a tsvector column with a GIN
+index. Mapper events keep the index in the same transaction as the write.
+"""
+import re
+import time
+from collections import namedtuple
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, inspect, select, text
+
+from app import db
+from app.algorithms.codesearch import rebuild_code_index
+from app.blobs import read_content
+from app.models import Algorithm, ContentBlob, load_contents
+
+INDEX_TABLE = 'algorithm_search'
+FIELDS = ('title', 'content', 'sub_category')
+# Mapped attributes whose changes alter the indexed fields.
+TRACKED = ('title', 'content_hash', 'inline_content', 'sub_category')
+
+# Seconds before a missing index table is looked for again.
+RECHECK_INTERVAL = 30
+
+Hit = namedtuple('Hit', ['id', 'score', 'snippet'])
+
+CREATE_INDEX = {
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS algorithm_search USING fts5("
+        "title, content, sub_category, tokenize='porter unicode61')"
+    ],
+    'postgresql': [
+        "CREATE TABLE IF NOT EXISTS algorithm_search ("
+        "algorithm_id INTEGER PRIMARY KEY "
+        "REFERENCES algorithm (id) ON DELETE CASCADE, "
+        "document TSVECTOR NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_algorithm_search_document "
+        "ON algorithm_search USING GIN (document)"
+    ]
+}
+
+INSERT_DOCUMENT = {
+    'sqlite': (
+        "INSERT INTO algorithm_search (rowid, title, content, sub_category) "
+        "VALUES (:id, :title, :content, :sub_category)"),
+    'postgresql': (
+        "INSERT INTO algorithm_search (algorithm_id, document) VALUES (:id, "
+        "setweight(to_tsvector('english', coalesce(:title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(:sub_category, '')), 'B')"
+        " || setweight(to_tsvector('english', coalesce(:content, '')), 'C'))"
+        " ON CONFLICT (algorithm_id) DO UPDATE SET document = "
+        "EXCLUDED.document")
+}
+
+DELETE_DOCUMENT = {
+    'sqlite': "DELETE FROM algorithm_search WHERE rowid = :id",
+    'postgresql': "DELETE FROM algorithm_search WHERE algorithm_id = :id"
+}
+
+SEARCH = {
+    'sqlite': (
+        "SELECT rowid AS id, -bm25(algorithm_search, 10.0, 1.0, 5.0) AS score,"
+        " snippet(algorithm_search, -1, '<mark>', '</mark>', '...', 16)"
+        " AS snippet FROM algorithm_search WHERE algorithm_search MATCH :q "
+        "ORDER BY bm25(algorithm_search, 10.0, 1.0, 5.0) "
+        "LIMIT :limit OFFSET :offset"),
+    'postgresql': (
+        "SELECT algorithm_id AS id, ts_rank_cd(document, query) AS score, "
+        "NULL AS snippet FROM algorithm_search, "
+        "plainto_tsquery('english', :q) query WHERE document @@ query "
+        "ORDER BY score DESC, algorithm_id LIMIT :limit OFFSET :offset")
+}
+
+# Postgres highlights bodies passed back in, as blobs may be compressed.
+HEADLINES = (
+    "SELECT body.id, ts_headline('english', coalesce(body.content, ''), "
+    "plainto_tsquery('english', :q), 'StartSel=<mark>, StopSel=</mark>, "
+    "MaxFragments=1') AS snippet "
+    "FROM unnest(CAST(:ids AS INTEGER[]), CAST(:contents AS TEXT[])) "
+    "AS body (id, content)")
+
+_ready = {}
+
+
+def supported(connection):
+    """Check whether the database has a search index implementation."""
+    return connection.dialect.name in CREATE_INDEX
+
+
+def index_ready(connection):
+    """Check whether the search index table exists.
+
+    A table found is remembered; a missing one is looked for again after
+    RECHECK_INTERVAL seconds, so workers notice it once migrations ran.
+    """
+    url = str(connection.engine.url)
+    ready, checked_at = _ready.get(url, (False, None))
+    if not ready and (checked_at is None or
+                      time.time() - checked_at >= RECHECK_INTERVAL):
+        ready = supported(connection) and connection.dialect.has_table(
+            connection, INDEX_TABLE)
+        _ready[url] = (ready, time.time())
+    return ready
+
+
+def create_index(connection):
+    """Create the search index table if it is missing."""
+    for statement in CREATE_INDEX[connection.dialect.name]:
+        connection.execute(text(statement))
+    _ready[str(connection.engine.url)] = (True, time.time())
+
+
+def drop_index(connection):
+    """Drop the search index table."""
+    connection.execute(text('DROP TABLE IF EXISTS ' + INDEX_TABLE))
+    _ready.pop(str(connection.engine.url), None)
+
+
+def index_documents(connection, documents):
+    """Add or replace documents, given as dicts of id and FIELDS."""
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        connection.execute(text(DELETE_DOCUMENT[dialect]), documents)
+    connection.execute(text(INSERT_DOCUMENT[dialect]), documents)
+
+
+def to_document(algo):
+    """Return the indexed fields of an algorithm."""
+    document = {name: getattr(algo, name) for name in FIELDS}
+    document['id'] = algo.id
+    return document
+
+
+@event.listens_for(Algorithm.__table__, 'after_create')
+def on_algorithm_table_create(target, connection, **kw):
+    """Create the search index alongside the algorithm table."""
+    if supported(connection):
+        create_index(connection)
+
+
+@event.listens_for(Algorithm.__table__, 'before_drop')
+def on_algorithm_table_drop(target, connection, **kw):
+    """Drop the search index before the algorithm table."""
+    if supported(connection):
+        drop_index(connection)
+
+
+@event.listens_for(Algorithm, 'after_insert')
+def on_algorithm_insert(mapper, connection, target):
+    """Index a new algorithm."""
+    if index_ready(connection):
+        index_documents(connection, [to_document(target)])
+
+
+@event.listens_for(Algorithm, 'after_update')
+def on_algorithm_update(mapper, connection, target):
+    """Reindex an algorithm when one of its indexed fields changed."""
+    attrs = inspect(target).attrs
+    changed = any(attrs[name].history.has_changes() for name in TRACKED)
+    if changed and index_ready(connection):
+        index_documents(connection, [to_document(target)])
+
+
+@event.listens_for(Algorithm, 'after_delete')
+def on_algorithm_delete(mapper, connection, target):
+    """Remove a deleted algorithm from the index."""
+    if index_ready(connection):
+        connection.execute(
+            text(DELETE_DOCUMENT[connection.dialect.name]), id=target.id)
+
+
+def to_match_query(terms):
+    """Quote each word so user input cannot break FTS5 query syntax."""
+    return ' '.join('"{}"'.format(word) for word in re.findall(r'\w+', terms))
+
+
+def search_algorithms(terms, limit, offset=0):
+    """Return ranked (id, score, snippet) rows, or None without an index."""
+    connection = db.session.connection()
+    if not index_ready(connection):
+        return None
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        terms = to_match_query(terms)
+        if not terms:
+            return []
+    hits = [Hit(*row) for row in connection.execute(
+        text(SEARCH[dialect]), q=terms, limit=limit, offset=offset)]
+    if dialect == 'postgresql' and hits:
+        contents = load_contents([hit.id for hit in hits])
+        ids = list(contents)
+        snippets = dict(connection.execute(
+            text(HEADLINES), q=terms, ids=ids,
+            contents=[contents[id_] for id_ in ids]).fetchall())
+        hits = [hit._replace(snippet=snippets.get(hit.id)) for hit in hits]
+    return hits
+
+
+def rebuild_index(batch_size=500):
+    """Recreate the search index from the algorithm table."""
+    table, blobs = Algorithm.__table__, ContentBlob.__table__
+    columns = [table.c.id, table.c.title, table.c.sub_category,
+               table.c.content, blobs.c.data, blobs.c.encoding]
+    joined = table.outerjoin(blobs, blobs.c.hash == table.c.content_hash)
+    count, last_id = 0, 0
+    with db.engine.begin() as connection:
+        drop_index(connection)
+        create_index(connection)
+        while True:
+            rows = connection.execute(
+                select(columns).select_from(joined)
+                .where(table.c.id > last_id)
+                .order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            index_documents(connection, [
+                {'id': row[0], 'title': row[1], 'sub_category': row[2],
+                 'content': read_content(*row[3:])} for row in rows])
+            count += len(rows)
+            last_id = rows[-1].id
+    return count
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    """Keep the search index tables out of autogenerated migrations.
+
+    This covers the code search tables, whose names share the prefix.
+    """
+    return not (type_ == 'table' and reflected and
+                name.startswith(INDEX_TABLE))
+
+
+search_cli = AppGroup('search', help='Manage the full-text search index.')
+
+
+@search_cli.command('rebuild')
+@click.option('--batch-size', default=500, help='Rows indexed per query.')
+def rebuild_command(batch_size):
+    """Rebuild the search index from scratch."""
+    count = rebuild_index(batch_size)
+    click.echo('Indexed {} algorithms.'.format(count))
+
+
+@search_cli.command('rebuild-code')
+@click.option('--batch-size', default=500, help='Rows indexed per query.')
+def rebuild_code_command(batch_size):
+    """Rebuild the trigram index of code search from scratch."""
+    count = rebuild_code_index(batch_size)
+    click.echo('Indexed {} algorithms.'.format(count))
@@ -0,0 +1,273 @@
+"""Near-duplicate detection with MinHash signatures and an LSH index.
+
+Bodies are split into shingles of SIMILARITY_SHINGLE_SIZE tokens, and each
+of SIMILARITY_PERMUTATIONS fixed hash permutations keeps its smallest value
+over them. The share of equal values in two signatures estimates the
+Jaccard similarity of the bodies. Signatures are cut into SIMILARITY_BANDS
+bands stored as buckets in an indexed table, so candidates are the
+algorithms sharing a bucket, found without scanning the others.
+Mapper events keep both tables in the same transaction as the write.
+Changing the permutations or bands needs
+`flask algorithms rebuild-similarity`.
+"""
+import hashlib
+import random
+import re
+import struct
+import zlib
+from functools import lru_cache
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import object_session
+
+from app import db
+from app.blobs import read_content
+from app.models import Algorithm, ContentBlob, Signature, SignatureBand
+from app.signals import record_change
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PRIME = (1 << 61) - 1
+MASK64 = (1 << 64) - 1
+MASK32 = (1 << 32) - 1
+# Permutations must never change between processes or restarts.
+SEED = 20180601
+# Mapped attributes whose changes alter the body.
+TRACKED = ('content_hash', 'inline_content')
+# Mapped attributes shown in the similar lists of other algorithms.
+SHOWN = ('title',)
+
+TOKEN = re.compile(r'\w+|[^\w\s]')
+
+
+def shingle_hashes(content, size):
+    """Return the distinct 32 bit hashes of a body's token shingles."""
+    tokens = TOKEN.findall((content or '').lower())
+    if not tokens:
+        return []
+    count = max(len(tokens) - size + 1, 1)
+    return sorted({zlib.crc32(' '.join(tokens[i:i + size]).encode())
+                   for i in range(count)})
+
+
+@lru_cache(maxsize=None)
+def permutations(count):
+    """Return the fixed (a, b) pairs of the hash permutations."""
+    rng = random.Random(SEED)
+    return tuple((rng.randrange(1, PRIME), rng.randrange(0, PRIME))
+                 for _ in range(count))
+
+
+@lru_cache(maxsize=None)
+def permutation_arrays(count):
+    """Return the permutation pairs as two NumPy arrays."""
+    pairs = permutations(count)
+    return (numpy.array([a for a, _ in pairs], dtype=numpy.uint64),
+            numpy.array([b for _, b in pairs], dtype=numpy.uint64))
+
+
+def minhash(hashes, count):
+    """Return the MinHash signature of shingle hashes as a list of ints.
+
+    Products wrap at 64 bits in both implementations, so NumPy and pure
+    Python signatures are identical.
+    """
+    if numpy is not None:
+        a, b = permutation_arrays(count)
+        values = numpy.array(hashes, dtype=numpy.uint64)
+        values = (numpy.outer(values, a) + b) % numpy.uint64(PRIME)
+        return (values & numpy.uint64(MASK32)).min(axis=0).tolist()
+    return [min((((a * value + b) & MASK64) % PRIME) & MASK32
+                for value in hashes) for a, b in permutations(count)]
+
+
+def pack(signature):
+    """Return a signature as stored bytes."""
+    return struct.pack('<{}I'.format(len(signature)), *signature)
+
+
+def unpack(data):
+    """Return the signature held by stored bytes."""
+    data = bytes(data)
+    return list(struct.unpack('<{}I'.format(len(data) // 4), data))
+
+
+def band_buckets(signature, bands):
+    """Return the bucket of every band of a signature."""
+    size = len(signature) // bands * 4
+    data = pack(signature)
+    return [int.from_bytes(hashlib.blake2b(
+        struct.pack('<H', band) + data[band * size:(band + 1) * size],
+        digest_size=8).digest(), 'big', signed=True)
+        for band in range(bands)]
+
+
+def signature_of(content):
+    """Return the signature of a body, or None when it has no tokens."""
+    config = current_app.config
+    hashes = shingle_hashes(content, config['SIMILARITY_SHINGLE_SIZE'])
+    if not hashes:
+        return None
+    return minhash(hashes, config['SIMILARITY_PERMUTATIONS'])
+
+
+def similarities(signature, others):
+    """Return the estimated similarity of a signature to each of others."""
+    if numpy is not None and others:
+        matrix = numpy.array(others, dtype=numpy.uint32)
+        return (matrix == numpy.array(signature, dtype=numpy.uint32)).mean(
+            axis=1).tolist()
+    return [sum(x == y for x, y in zip(signature, other)) / len(signature)
+            for other in others]
+
+
+def unindex(connection, ids):
+    """Remove algorithms from the index."""
+    for table in (Signature.__table__, SignatureBand.__table__):
+        connection.execute(
+            table.delete().where(table.c.algorithm_id.in_(ids)))
+
+
+def index_contents(connection, contents, replace=True):
+    """Add or replace the signatures of bodies keyed by algorithm id."""
+    bands = current_app.config['SIMILARITY_BANDS']
+    signatures, buckets = [], []
+    for algo_id, content in contents.items():
+        signature = signature_of(content)
+        if signature is None:
+            continue
+        signatures.append({'algorithm_id': algo_id, 'data': pack(signature)})
+        buckets.extend({'algorithm_id': algo_id, 'bucket': bucket}
+                       for bucket in set(band_buckets(signature, bands)))
+    if replace:
+        unindex(connection, list(contents))
+    if signatures:
+        connection.execute(Signature.__table__.insert(), signatures)
+        connection.execute(SignatureBand.__table__.insert(), buckets)
+
+
+def neighbours(connection, algo_id):
+    """Return the ids of the algorithms sharing a bucket with one."""
+    bands = SignatureBand.__table__
+    buckets = select([bands.c.bucket]).where(bands.c.algorithm_id == algo_id)
+    return {row[0] for row in connection.execute(
+        select([bands.c.algorithm_id]).distinct()
+        .where(bands.c.bucket.in_(buckets))
+        .where(bands.c.algorithm_id != algo_id))}
+
+
+def touch_neighbours(connection, target):
+    """Record that the similar lists of target's neighbours changed.
+
+    Similar lists only hold algorithms sharing a bucket, so these are the
+    only lists a write to target can alter; committing invalidates them.
+    """
+    session = object_session(target)
+    for id_ in neighbours(connection, target.id):
+        record_change(session, 'update', 'similar', id_)
+
+
+@event.listens_for(Algorithm, 'after_insert')
+def on_algorithm_insert(mapper, connection, target):
+    """Index the body of a new algorithm."""
+    index_contents(connection, {target.id: target.content}, replace=False)
+    touch_neighbours(connection, target)
+
+
+@event.listens_for(Algorithm, 'after_update')
+def on_algorithm_update(mapper, connection, target):
+    """Reindex an algorithm whose body changed."""
+    attrs = inspect(target).attrs
+    if any(attrs[name].history.has_changes() for name in TRACKED):
+        touch_neighbours(connection, target)
+        index_contents(connection, {target.id: target.content})
+        touch_neighbours(connection, target)
+    elif any(attrs[name].history.has_changes() for name in SHOWN):
+        touch_neighbours(connection, target)
+
+
+@event.listens_for(Algorithm, 'after_delete')
+def on_algorithm_delete(mapper, connection, target):
+    """Remove a deleted algorithm from the index."""
+    touch_neighbours(connection, target)
+    unindex(connection, [target.id])
+
+
+def similar_algorithms(algo_id, limit, threshold):
+    """Return (id, similarity) pairs of the algorithms most like one.
+
+    At most SIMILARITY_MAX_CANDIDATES algorithms sharing the most buckets
+    are compared, so the cost does not grow with the number stored.
+    """
+    config = current_app.config
+    connection = db.session.connection()
+    signatures, bands = Signature.__table__, SignatureBand.__table__
+    data = connection.execute(select([signatures.c.data]).where(
+        signatures.c.algorithm_id == algo_id)).scalar()
+    if data is None:
+        return []
+    signature = unpack(data)
+    if len(signature) != config['SIMILARITY_PERMUTATIONS']:
+        return []
+    buckets = band_buckets(signature, config['SIMILARITY_BANDS'])
+    shared = func.count().label('shared')
+    ids = [row[0] for row in connection.execute(
+        select([bands.c.algorithm_id, shared])
+        .where(bands.c.bucket.in_(buckets))
+        .where(bands.c.algorithm_id != algo_id)
+        .group_by(bands.c.algorithm_id)
+        .order_by(shared.desc(), bands.c.algorithm_id)
+        .limit(config['SIMILARITY_MAX_CANDIDATES']))]
+    if not ids:
+        return []
+    rows = connection.execute(
+        select([signatures.c.algorithm_id, signatures.c.data])
+        .where(signatures.c.algorithm_id.in_(ids))).fetchall()
+    others = [(row[0], unpack(row[1])) for row in rows]
+    others = [(id_, other) for id_, other in others
+              if len(other) == len(signature)]
+    scores = similarities(signature, [other for _, other in others])
+    ranked = sorted((-score, id_) for (id_, _), score in zip(others, scores)
+                    if score >= threshold)
+    return [(id_, -score) for score, id_ in ranked[:limit]]
+
+
+def similar_summaries(algo_id, limit, threshold):
+    """Return the id, title and similarity of the algorithms most like one."""
+    hits = similar_algorithms(algo_id, limit, threshold)
+    titles = dict(db.session.query(Algorithm.id, Algorithm.title).filter(
+        Algorithm.id.in_([id_ for id_, _ in hits]))) if hits else {}
+    return [{'id': id_, 'title': titles[id_], 'similarity': round(score, 3)}
+            for id_, score in hits if id_ in titles]
+
+
+def rebuild_similarity(batch_size=500):
+    """Recompute the signatures of every algorithm."""
+    table, blobs = Algorithm.__table__, ContentBlob.__table__
+    joined = table.outerjoin(blobs, blobs.c.hash == table.c.content_hash)
+    count, last_id = 0, 0
+    with db.engine.begin() as connection:
+        connection.execute(Signature.__table__.delete())
+        connection.execute(SignatureBand.__table__.delete())
+        while True:
+            rows = connection.execute(
+                select([table.c.id, table.c.content, blobs.c.data,
+                        blobs.c.encoding]).select_from(joined)
+                .where(table.c.id > last_id)
+                .order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            index_contents(connection, {
+                row[0]: read_content(*row[1:]) for row in rows},
+                replace=False)
+            count += len(rows)
+            last_id = rows[-1].id
+    cache = has_app_context() and current_app.extensions.get(
+        'response_cache')
+    if cache:
+        cache.invalidate('similarity')
+    return count
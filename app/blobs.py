@@ -0,0 +1,40 @@
+"""Encoding of algorithm bodies stored in the content blob table.
+
+Bodies are UTF-8 encoded and zlib compressed when they are at least
+BLOB_COMPRESS_MIN_SIZE bytes long and compression actually saves space.
+"""
+import zlib
+
+from flask import current_app
+
+
+def encode_blob(text):
+    """Return the stored bytes, encoding name and raw size of a body."""
+    data = text.encode('utf-8')
+    config = current_app.config
+    if len(data) >= config['BLOB_COMPRESS_MIN_SIZE']:
+        compressed = zlib.compress(data, config['BLOB_COMPRESS_LEVEL'])
+        if len(compressed) < len(data):
+            return compressed, 'zlib', len(data)
+    return data, None, len(data)
+
+
+def decode_blob(data, encoding):
+    """Return the body stored as data with an encoding."""
+    data = bytes(data)
+    if encoding == 'zlib':
+        data = zlib.decompress(data)
+    return data.decode('utf-8')
+
+
+def read_content(inline, data, encoding):
+    """Return a body from its row's inline column or its blob columns.
+
+    Rows written before blob storage keep their body inline until they
+    are migrated.
+    """
+    if inline is not None:
+        return inline
+    if data is None:
+        return None
+    return decode_blob(data, encoding)
@@ -0,0 +1,319 @@
+"""Server-side response cache and conditional GET handling.
+
+Entries are keyed by URL plus a generation number per tag. Committed writes
+bump the generations of the tags they touch, so stale entries are never
+served again and simply age out of the backend. Entries also keep their
+body compressed in each encoding clients asked for, so hits are not
+compressed again.
+"""
+import fnmatch
+import hashlib
+import pickle
+import queue
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import current_app, has_app_context, make_response, request
+
+from app.compression import choose_encoding, compress, mark_encoded
+from app.database import read_from_primary
+from app.signals import on_commit
+
+CachedResponse = namedtuple(
+    'CachedResponse', ['body', 'status', 'headers', 'etag', 'last_modified',
+                       'mimetype', 'encodings'])
+
+# Tags invalidated by a committed change, keyed by table name.
+CHANGE_TAGS = {
+    'algorithm': ('algorithms', 'algorithm:{}'),
+    'category': ('categories', 'category:{}'),
+    # Recorded by the similarity index for the lists a write altered.
+    'similar': ('similar:{}',)
+}
+
+SKIPPED_HEADERS = {'content-length', 'set-cookie', 'etag', 'last-modified'}
+
+
+class LRUBackend(object):
+    """In-process LRU store with a time-to-live per entry."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return a live entry or None."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[1] < time.time():
+                del self._entries[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value):
+        """Store an entry, evicting the least recently used ones."""
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove an entry."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def generations(self, tags):
+        """Return the current generation of each tag."""
+        return [self._generations.get(tag, 0) for tag in tags]
+
+    def bump(self, tag):
+        """Invalidate every entry stored under the tag."""
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+
+
+class SharedBackend(object):
+    """Store entries in a shared Redis-like store used by all workers."""
+
+    def __init__(self, client, ttl=300, prefix='response-cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        """Return a live entry or None."""
+        raw = self.client.get(self.prefix + key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value):
+        """Store an entry until its time-to-live runs out."""
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def generations(self, tags):
+        """Return the current generation of each tag."""
+        keys = [self.prefix + 'generation:' + tag for tag in tags]
+        return [int(value or 0) for value in self.client.mget(keys)]
+
+    def bump(self, tag):
+        """Invalidate every entry stored under the tag."""
+        self.client.incr(self.prefix + 'generation:' + tag)
+
+
+class LocalStore(object):
+    """Thread-safe in-memory stand-in for a Redis client."""
+
+    def __init__(self):
+        self._data = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        """Return the value of a key or None."""
+        with self._lock:
+            value, expires = self._data.get(key, (None, None))
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def mget(self, keys):
+        """Return the values of several keys."""
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        """Set a key, expiring after `ex` seconds if given."""
+        with self._lock:
+            self._data[key] = (value, time.time() + ex if ex else None)
+
+    def incr(self, key):
+        """Increment an integer key and return the new value."""
+        with self._lock:
+            value = int(self.get(key) or 0) + 1
+            self._data[key] = (value, None)
+            return value
+
+    def delete(self, *keys):
+        """Remove keys."""
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def publish(self, channel, message):
+        """Send a message to the listeners of matching patterns."""
+        with self._lock:
+            listeners = list(self._listeners)
+        return sum(listener.receive(channel, message)
+                   for listener in listeners)
+
+    def pubsub(self, **kwargs):
+        """Return a listener for published messages."""
+        return LocalPubSub(self)
+
+
+class LocalPubSub(object):
+    """Pattern subscriptions to a LocalStore, like a Redis PubSub."""
+
+    def __init__(self, store):
+        self.store = store
+        self.patterns = []
+        self._messages = queue.Queue()
+
+    def psubscribe(self, *patterns):
+        """Listen to the channels matching glob patterns."""
+        self.patterns.extend(patterns)
+        with self.store._lock:
+            if self not in self.store._listeners:
+                self.store._listeners.append(self)
+
+    def receive(self, channel, message):
+        """Queue a published message if a pattern matches its channel."""
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(channel, pattern):
+                self._messages.put({'type': 'pmessage', 'pattern': pattern,
+                                    'channel': channel, 'data': message})
+                return True
+        return False
+
+    def listen(self):
+        """Yield the queued messages, waiting for new ones."""
+        while True:
+            yield self._messages.get()
+
+
+class ResponseCache(object):
+    """Cache rendered responses under invalidation tags."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def key(self, tags):
+        """Return the cache key of the current request."""
+        generations = self.backend.generations(tags)
+        return '{}|{}'.format(request.url, ','.join(map(str, generations)))
+
+    def invalidate(self, *tags):
+        """Drop every entry stored under any of the tags."""
+        for tag in tags:
+            self.backend.bump(tag)
+
+
+def make_backend(config):
+    """Build the cache backend selected by RESPONSE_CACHE_BACKEND."""
+    name = config['RESPONSE_CACHE_BACKEND']
+    ttl = config['RESPONSE_CACHE_TTL']
+    if name == 'memory':
+        return LRUBackend(config['RESPONSE_CACHE_SIZE'], ttl)
+    if name == 'local':
+        return SharedBackend(LocalStore(), ttl)
+    if name == 'redis':
+        import redis
+        client = redis.StrictRedis.from_url(config['RESPONSE_CACHE_URL'])
+        return SharedBackend(client, ttl)
+    raise ValueError('Unknown cache backend: {}'.format(name))
+
+
+def init_cache(app):
+    """Attach a response cache to the app unless it is disabled."""
+    if app.config['RESPONSE_CACHE_BACKEND']:
+        backend = make_backend(app.config)
+        app.extensions['response_cache'] = ResponseCache(backend)
+
+
+def freeze(response, last_modified=None):
+    """Turn a response into a cacheable entry."""
+    body = response.get_data()
+    headers = [(name, value) for name, value in response.headers
+               if name.lower() not in SKIPPED_HEADERS]
+    return CachedResponse(body, response.status_code, headers,
+                          hashlib.sha1(body).hexdigest(), last_modified,
+                          response.mimetype, {})
+
+
+def thaw(entry, encoding=None):
+    """Rebuild a response from a cache entry, compressed if asked."""
+    body = entry.encodings[encoding] if encoding else entry.body
+    response = current_app.response_class(
+        body, status=entry.status, headers=entry.headers)
+    response.set_etag(entry.etag)
+    if encoding:
+        mark_encoded(response, encoding)
+    if entry.last_modified is not None:
+        response.last_modified = entry.last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def precompress(entry):
+    """Return the encoding to serve an entry with and whether it is new.
+
+    The body is compressed at most once per encoding.
+    """
+    if not current_app.config['COMPRESS_ENCODINGS']:
+        return None, False
+    encoding = choose_encoding(entry.mimetype, len(entry.body))
+    if encoding and encoding not in entry.encodings:
+        entry.encodings[encoding] = compress(entry.body, encoding)
+        return encoding, True
+    return encoding, False
+
+
+def cached(*tags):
+    """Cache GET responses of a view and answer conditional requests.
+
+    Tags are formatted with the view arguments, e.g. 'algorithm:{algo_id}'.
+    Misses read from the primary: the entry is stored under the
+    generations current when it was looked up, which a lagging replica
+    may not have caught up with.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            cache = current_app.extensions.get('response_cache')
+            key = cache and cache.key([tag.format(**kwargs) for tag in tags])
+            entry = cache and cache.backend.get(key)
+            if entry is None:
+                if cache:
+                    read_from_primary()
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                if not cache:
+                    return thaw(freeze(response)).make_conditional(request)
+                entry = freeze(response, int(time.time()))
+                encoding, _ = precompress(entry)
+                cache.backend.set(key, entry)
+            else:
+                encoding, added = precompress(entry)
+                if added:
+                    cache.backend.set(key, entry)
+            return thaw(entry, encoding).make_conditional(request)
+        return wrapper
+    return decorator
+
+
+@on_commit
+def invalidate_changes(changes):
+    """Invalidate cached responses showing committed changes."""
+    cache = has_app_context() and current_app.extensions.get('response_cache')
+    if not cache:
+        return
+    tags = set()
+    for change in changes:
+        for tag in CHANGE_TAGS.get(change.name, ()):
+            tags.add(tag.format(change.id))
+    cache.invalidate(*tags)
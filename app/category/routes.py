@@ -3,6 +3,7 @@
 from flask import request, Blueprint, jsonify
 from flask_login import login_required, current_user
 
+from app.cache import cached
 from app.models import Category
 
 
@@ -11,6 +12,7 @@ cat_bp = Blueprint('category', __name__)
 
 @cat_bp.route('', methods=['GET', 'POST'], strict_slashes=False)
 @login_required
+@cached('categories')
 def categories():
     """Create and retrieve categories."""
     if request.method == 'GET':
@@ -29,6 +31,7 @@ def categories():
 
 @cat_bp.route('/<int:cat_id>', methods=['GET', 'PUT', 'DELETE'])
 @login_required
+@cached('category:{cat_id}')
 def category(cat_id):
     """Update, retrieve and delete a category."""
     cat = Category.get(cat_id)
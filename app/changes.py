@@ -0,0 +1,124 @@
+"""Change feed of algorithms and categories for incremental sync.
+
+Every flush that writes an algorithm or category replaces that row's entry
+in the change log with a new one, so the log holds the latest change of
+each row, deletes included as tombstones, under an increasing sequence
+number. Clients keep the last number they saw and ask for what changed
+since. On Postgres, writers take a transaction lock before logging, so
+numbers become visible in order and no change is skipped by a reader.
+"""
+import datetime
+
+from sqlalchemy import event, null, or_, select, text
+from sqlalchemy.orm import Session
+
+from app import db
+from app.algorithms.listing import SECURE_FIELDS, select_columns, to_dict
+from app.models import Algorithm, Category, ChangeLog
+
+LOGGED = ('algorithm', 'category')
+# Key of the Postgres advisory lock ordering change log writes.
+LOCK_KEY = 7305201
+
+
+def log_entries(connection, entries):
+    """Replace the log entries of rows with new ones."""
+    if not entries:
+        return
+    if connection.dialect.name == 'postgresql':
+        connection.execute(
+            text('SELECT pg_advisory_xact_lock(:key)'), key=LOCK_KEY)
+    table = ChangeLog.__table__
+    for name in LOGGED:
+        ids = [entry['object_id'] for entry in entries
+               if entry['name'] == name]
+        if ids:
+            connection.execute(table.delete().where(
+                table.c.name == name).where(table.c.object_id.in_(ids)))
+    connection.execute(table.insert(), entries)
+
+
+@event.listens_for(Session, 'after_flush')
+def log_changes(session, flush_context):
+    """Log the algorithms and categories written by a flush."""
+    entries = {}
+    now = datetime.datetime.utcnow()
+    for action, items in (('upsert', session.new),
+                          ('upsert', session.dirty),
+                          ('delete', session.deleted)):
+        for item in items:
+            name = getattr(item, '__tablename__', None)
+            if name not in LOGGED or (item in session.dirty and
+                                      not session.is_modified(item)):
+                continue
+            entries[(name, item.id)] = {
+                'name': name, 'object_id': item.id, 'action': action,
+                'user_id': getattr(item, 'user_id', None), 'created_at': now}
+    log_entries(session.connection(), list(entries.values()))
+
+
+def current_data(rows):
+    """Return the current fields of changed rows keyed by (name, id)."""
+    ids = {name: [row.object_id for row in rows
+                  if row.name == name and row.action == 'upsert']
+           for name in LOGGED}
+    data = {}
+    if ids['algorithm']:
+        query = Algorithm.query.filter(Algorithm.id.in_(ids['algorithm']))
+        for row in db.session.execute(select_columns(query, SECURE_FIELDS)):
+            values = to_dict(SECURE_FIELDS, row)
+            data[('algorithm', values['id'])] = values
+    if ids['category']:
+        for cat in Category.query.filter(Category.id.in_(ids['category'])):
+            data[('category', cat.id)] = {'id': cat.id, 'name': cat.name}
+    return data
+
+
+def read_changes(since, limit, user_id=None):
+    """Return up to limit changes after a sequence number, oldest first.
+
+    Upserts carry the row's current fields. With a user id, only the
+    algorithms of that user are included, along with every category.
+    """
+    table = ChangeLog.__table__
+    statement = select([table.c.seq, table.c.name, table.c.object_id,
+                        table.c.action]).where(table.c.seq > since)
+    if user_id is not None:
+        statement = statement.where(or_(
+            table.c.user_id == user_id, table.c.name == 'category'))
+    rows = db.session.execute(
+        statement.order_by(table.c.seq).limit(limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    data = current_data(rows)
+    changes = [{'seq': row.seq, 'type': row.name, 'id': row.object_id,
+                'action': row.action,
+                'data': data.get((row.name, row.object_id))} for row in rows]
+    return {'changes': changes, 'next': rows[-1].seq if rows else since,
+            'more': more}
+
+
+def backfill_changes(batch_size=500):
+    """Log rows written before the change log, one batch at a time."""
+    table = ChangeLog.__table__
+    count = 0
+    for model, owner in ((Category, null()), (Algorithm, Algorithm.user_id)):
+        name, last_id = model.__tablename__, 0
+        while True:
+            with db.engine.begin() as connection:
+                logged = select([table.c.object_id]).where(
+                    table.c.name == name)
+                rows = connection.execute(
+                    select([model.id, owner])
+                    .where(model.id > last_id)
+                    .where(model.id.notin_(logged))
+                    .order_by(model.id).limit(batch_size)).fetchall()
+                if not rows:
+                    break
+                now = datetime.datetime.utcnow()
+                log_entries(connection, [
+                    {'name': name, 'object_id': row[0], 'action': 'upsert',
+                     'user_id': row[1], 'created_at': now} for row in rows])
+            count += len(rows)
+            last_id = rows[-1][0]
+    return count
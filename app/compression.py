@@ -0,0 +1,125 @@
+"""Response compression negotiated through Accept-Encoding.
+
+Buffered responses are compressed in one go when they reach
+COMPRESS_MIN_SIZE; streamed responses are compressed chunk by chunk and
+flushed after each one so clients still see rows as they are produced.
+brotli is used when the package is installed.
+"""
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def available_encodings():
+    """Return the configured encodings this process can produce."""
+    return [encoding for encoding in current_app.config['COMPRESS_ENCODINGS']
+            if encoding != 'br' or brotli is not None]
+
+
+def choose_encoding(mimetype, size=None):
+    """Return the best encoding the client accepts for a body, or None."""
+    config = current_app.config
+    if mimetype not in config['COMPRESS_MIMETYPES']:
+        return None
+    if size is not None and size < config['COMPRESS_MIN_SIZE']:
+        return None
+    return request.accept_encodings.best_match(available_encodings())
+
+
+class Compressor(object):
+    """Incremental compressor for one content coding."""
+
+    def __init__(self, encoding):
+        config = current_app.config
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(
+                quality=config['COMPRESS_BROTLI_QUALITY'])
+        else:
+            wbits = zlib.MAX_WBITS + (16 if encoding == 'gzip' else 0)
+            self._compressor = zlib.compressobj(
+                config['COMPRESS_LEVEL'], zlib.DEFLATED, wbits)
+
+    def compress(self, data, flush=False):
+        """Compress a chunk, flushing it to the output if asked."""
+        if self.encoding == 'br':
+            output = self._compressor.process(data)
+            return output + self._compressor.flush() if flush else output
+        output = self._compressor.compress(data)
+        if flush:
+            output += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return output
+
+    def finish(self):
+        """Return the end of the compressed stream."""
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress(data, encoding):
+    """Compress a whole body."""
+    compressor = Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_stream(chunks, compressor):
+    """Yield compressed chunks of a streamed body."""
+    try:
+        for chunk in chunks:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield compressor.compress(chunk, flush=True)
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def mark_encoded(response, encoding):
+    """Label a response body as compressed with an encoding.
+
+    The ETag is made weak because it was computed for the plain body.
+    """
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response):
+    """Compress a response when the client and the payload allow it."""
+    if (response.direct_passthrough or request.method == 'HEAD' or
+            'Content-Encoding' in response.headers or
+            response.status_code < 200 or
+            response.status_code in (204, 206, 304) or
+            response.mimetype not in current_app.config['COMPRESS_MIMETYPES']):
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed:
+        encoding = choose_encoding(response.mimetype)
+        if encoding:
+            response.response = compress_stream(
+                response.response, Compressor(encoding))
+            response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        encoding = choose_encoding(response.mimetype, len(data))
+        if encoding:
+            response.set_data(compress(data, encoding))
+    if encoding:
+        mark_encoded(response, encoding)
+    return response
+
+
+def init_compression(app):
+    """Compress responses of the app unless it is disabled."""
+    if app.config['COMPRESS_ENCODINGS']:
+        app.after_request(compress_response)
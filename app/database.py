@@ -0,0 +1,202 @@
+"""Flask-SQLAlchemy extension with engine tuning and read replicas."""
+import itertools
+import threading
+import time
+import weakref
+
+from flask import g, has_app_context, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+
+from app.metrics import registry
+from app.signals import on_commit
+
+READ_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class TimedQueuePool(QueuePool):
+    """Queue pool recording how long checkouts wait for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            registry.inc('db_pool_timeouts_total')
+            raise
+        finally:
+            registry.observe('db_pool_checkout_seconds', (),
+                             time.perf_counter() - start)
+
+
+def engine_options(config, drivername):
+    """Return create_engine options for the configured database."""
+    if drivername.startswith('sqlite'):
+        return {}
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING']
+    }
+
+
+class SQLitePragmas(object):
+    """Connect listener setting pragmas on new SQLite connections."""
+
+    def __init__(self, pragmas):
+        self.pragmas = dict(pragmas)
+
+    def __call__(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        cursor.close()
+
+
+class ReplicaSet(object):
+    """Round-robin over the replica binds that pass a periodic health check.
+
+    Replicas are the SQLALCHEMY_BINDS whose key starts with 'replica'.
+    """
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        self._health = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def binds(self):
+        """Return the configured replica bind keys."""
+        binds = self.app.config.get('SQLALCHEMY_BINDS') or {}
+        return sorted(key for key in binds if key.startswith('replica'))
+
+    def engine(self, preferred=None):
+        """Return the bind key and engine of a healthy replica, or None.
+
+        The preferred replica is kept while it is healthy; otherwise the
+        next healthy one is taken.
+        """
+        binds = self.binds
+        if preferred in binds and self.healthy(preferred):
+            return preferred, self.db.get_engine(self.app, preferred)
+        for _ in binds:
+            bind = binds[next(self._counter) % len(binds)]
+            if self.healthy(bind):
+                return bind, self.db.get_engine(self.app, bind)
+        return None
+
+    def healthy(self, bind):
+        """Check a replica, at most once per health check interval."""
+        now = time.time()
+        interval = self.app.config['DATABASE_REPLICA_CHECK_INTERVAL']
+        healthy, checked_at = self._health.get(bind, (False, 0))
+        if now - checked_at < interval:
+            return healthy
+        with self._lock:
+            try:
+                engine = self.db.get_engine(self.app, bind)
+                with engine.connect() as connection:
+                    connection.execute('SELECT 1')
+                healthy = True
+            except SQLAlchemyError:
+                healthy = False
+            self._health[bind] = (healthy, now)
+        return healthy
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the reads of read-only requests to a replica.
+
+    A session sticks to one replica, so the reads of a request never mix
+    replicas lagging by different amounts. Flushes always go to the
+    primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        """Return a replica engine when the request allows it."""
+        replicas = self.app.extensions.get('replicas')
+        if (replicas and not self._flushing and has_app_context() and
+                g.get('use_replica')):
+            chosen = replicas.engine(self.info.get('replica'))
+            if chosen is not None:
+                self.info['replica'], engine = chosen
+                return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+def init_replicas(db, app):
+    """Route read-only requests to replicas unless the client just wrote.
+
+    A client that commits a write is pinned to the primary for
+    DATABASE_READ_YOUR_WRITES seconds through its session cookie.
+    """
+    app.extensions['replicas'] = ReplicaSet(db, app)
+
+    @app.before_request
+    def choose_database():
+        """Decide whether this request may read from a replica."""
+        g.use_replica = (request.method in READ_METHODS and
+                         not g.get('wrote') and
+                         session.get('primary_until', 0) < time.time())
+
+    @app.after_request
+    def pin_to_primary(response):
+        """Pin clients that wrote to the primary for a while."""
+        if g.get('wrote'):
+            session['primary_until'] = (
+                time.time() + app.config['DATABASE_READ_YOUR_WRITES'])
+        return response
+
+
+def read_from_primary():
+    """Send the remaining reads of the current request to the primary."""
+    g.use_replica = False
+
+
+@on_commit
+def remember_write(changes):
+    """Flag requests that committed a write."""
+    if has_request_context():
+        g.wrote = True
+
+
+class SQLAlchemy(_SQLAlchemy):
+    """Apply pool settings and SQLite pragmas from the app config."""
+
+    def __init__(self, *args, **kwargs):
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+        self._pragma_listeners = weakref.WeakKeyDictionary()
+
+    def create_session(self, options):
+        """Use the replica-aware session."""
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        """Add the configured engine options."""
+        rv = super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        options.update(engine_options(app.config, info.drivername))
+        return rv
+
+    def dispose_engines(self, app=None):
+        """Close the pooled connections of the primary and every bind."""
+        app = self.get_app(app)
+        for bind in [None] + sorted(app.config['SQLALCHEMY_BINDS'] or ()):
+            self.get_engine(app, bind).dispose()
+
+    def get_engine(self, app=None, bind=None):
+        """Return an engine, installing the SQLite pragmas on first use."""
+        app = self.get_app(app)
+        engine = super(SQLAlchemy, self).get_engine(app, bind)
+        if (engine.dialect.name == 'sqlite' and
+                engine not in self._pragma_listeners):
+            listener = SQLitePragmas(app.config['SQLITE_PRAGMAS'])
+            event.listen(engine, 'connect', listener)
+            self._pragma_listeners[engine] = listener
+        return engine
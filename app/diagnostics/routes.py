@@ -0,0 +1,116 @@
+"""Diagnostics routes."""
+from flask import Blueprint, Response, current_app, jsonify
+from flask_login import current_user, login_required
+
+from app import db
+from app.database import engine_options
+from app.profiling import collapsed_stacks, statement_table
+
+
+diag_bp = Blueprint('diagnostics', __name__)
+
+
+def pool_status(pool):
+    """Return the counters a connection pool exposes."""
+    status = {'class': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            status[name] = getattr(pool, name)()
+    return status
+
+
+@diag_bp.route('/database', methods=['GET'])
+@login_required
+def database():
+    """Show the engine configuration and pool state."""
+    if current_user.role != 'admin':
+        return jsonify({'message': 'Unauthorized.'}), 403
+    engine = db.engine
+    config = current_app.config
+    options = engine_options(config, engine.url.drivername)
+    result = {
+        'url': repr(engine.url),
+        'dialect': engine.dialect.name,
+        'driver': engine.driver,
+        'options': {name: getattr(value, '__name__', value)
+                    for name, value in options.items()},
+        'pool': pool_status(engine.pool),
+        'replicas': {bind: current_app.extensions['replicas'].healthy(bind)
+                     for bind in current_app.extensions['replicas'].binds}
+    }
+    if engine.dialect.name == 'sqlite':
+        result['pragmas'] = {
+            name: db.session.execute('PRAGMA ' + name).scalar()
+            for name in config['SQLITE_PRAGMAS']}
+    return jsonify(result), 200
+
+
+@diag_bp.route('/rate-limits', methods=['GET'])
+@login_required
+def rate_limits():
+    """Show the configured limits and how many requests were shed."""
+    if current_user.role != 'admin':
+        return jsonify({'message': 'Unauthorized.'}), 403
+    limiter = current_app.extensions['rate_limiter']
+    result = {'enabled': limiter is not None,
+              'limits': current_app.config['RATE_LIMITS']}
+    if limiter is not None:
+        result.update(limiter.snapshot())
+    return jsonify(result), 200
+
+
+def profile_summary(profile):
+    """Return the listing fields of a stored profile."""
+    return {'id': profile['id'], 'method': profile['method'],
+            'path': profile['path'], 'endpoint': profile['endpoint'],
+            'status': profile['status'], 'started': profile['started'],
+            'duration_ms': profile['duration_ms'],
+            'statements': len(profile['statements'])}
+
+
+def find_profile(profile_id):
+    """Return a stored profile, or None."""
+    store = current_app.extensions.get('profiles')
+    return store and store.get(profile_id)
+
+
+@diag_bp.route('/profiles', methods=['GET'])
+@login_required
+def profiles():
+    """List the stored request profiles, newest first."""
+    if current_user.role != 'admin':
+        return jsonify({'message': 'Unauthorized.'}), 403
+    store = current_app.extensions.get('profiles')
+    return jsonify({
+        'enabled': store is not None,
+        'profiles': [profile_summary(profile)
+                     for profile in (store.all() if store else [])]
+    }), 200
+
+
+@diag_bp.route('/profiles/<int:profile_id>', methods=['GET'])
+@login_required
+def profile(profile_id):
+    """Show the function and SQL tables of a profile."""
+    if current_user.role != 'admin':
+        return jsonify({'message': 'Unauthorized.'}), 403
+    found = find_profile(profile_id)
+    if not found:
+        return jsonify({'message': 'Profile does not exist.'}), 404
+    result = profile_summary(found)
+    result.update(functions=found['functions'],
+                  queries=statement_table(found['statements']),
+                  statements=found['statements'])
+    return jsonify(result), 200
+
+
+@diag_bp.route('/profiles/<int:profile_id>/collapsed', methods=['GET'])
+@login_required
+def collapsed_profile(profile_id):
+    """Serve the sampled stacks of a profile for flame graph tools."""
+    if current_user.role != 'admin':
+        return jsonify({'message': 'Unauthorized.'}), 403
+    found = find_profile(profile_id)
+    if not found:
+        return jsonify({'message': 'Profile does not exist.'}), 404
+    return Response(collapsed_stacks(found), mimetype='text/plain')
@@ -0,0 +1,227 @@
+"""Server-sent events pushing a user's algorithm and category changes.
+
+Committed writes publish a message on the channel of each algorithm owner,
+and on a shared channel for categories. Messages only wake the streams
+listening to a channel, which then read the change feed from their last
+sequence number, so events carry change feed numbers as ids, streams
+resume from Last-Event-ID, and a full buffer can drop wake-ups without
+losing a change. EVENTS_BACKEND 'memory' reaches the streams of this
+process; 'redis' relays messages between workers.
+"""
+import json
+import os
+import queue
+import threading
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from app import db
+from app.changes import read_changes
+from app.models import Algorithm, Category, ChangeLog
+
+CATEGORIES = 'categories'
+
+
+class Subscription(object):
+    """Bounded buffer of the wake-ups of one stream."""
+
+    def __init__(self, channels, size):
+        self.channels = channels
+        self.closed = False
+        self._messages = queue.Queue(size)
+
+    def notify(self, message):
+        """Buffer a message, dropping it when the buffer is full."""
+        try:
+            self._messages.put_nowait(message)
+        except queue.Full:
+            pass
+
+    def wait(self, timeout):
+        """Wait for messages and drain them; return False on timeout."""
+        try:
+            self._messages.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        while True:
+            try:
+                self._messages.get_nowait()
+            except queue.Empty:
+                return True
+
+
+class Broker(object):
+    """Deliver messages to the subscriptions of a channel.
+
+    With a transport, messages go through it, and it hands them back to
+    the broker of every process.
+    """
+
+    def __init__(self, transport=None, max_streams=100):
+        self.transport = transport
+        self.max_streams = max_streams
+        self._channels = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels, size):
+        """Return a new subscription, or None when there are too many."""
+        subscription = Subscription(channels, size)
+        with self._lock:
+            if self._count >= self.max_streams:
+                return None
+            self._count += 1
+            for channel in channels:
+                self._channels.setdefault(channel, set()).add(subscription)
+        if self.transport is not None:
+            self.transport.start(self.deliver)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop delivering to a subscription."""
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            self._count -= 1
+            for channel in subscription.channels:
+                subscriptions = self._channels.get(channel, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self._channels.pop(channel, None)
+
+    def publish(self, channel, message=''):
+        """Send a message to the subscriptions of a channel."""
+        if self.transport is not None:
+            self.transport.publish(channel, message)
+        else:
+            self.deliver(channel, message)
+
+    def deliver(self, channel, message):
+        """Hand a message to this process's subscriptions of a channel."""
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.notify(message)
+
+
+class SharedTransport(object):
+    """Relay messages between processes through a Redis-like client."""
+
+    def __init__(self, client, prefix='events:'):
+        self.client = client
+        self.prefix = prefix
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        """Publish a message to every process."""
+        self.client.publish(self.prefix + channel, message)
+
+    def start(self, deliver):
+        """Start listening, once per process."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.psubscribe(self.prefix + '*')
+        thread = threading.Thread(target=self._listen, args=(pubsub, deliver))
+        thread.daemon = True
+        thread.start()
+
+    def _listen(self, pubsub, deliver):
+        for item in pubsub.listen():
+            if item['type'] != 'pmessage':
+                continue
+            channel, data = item['channel'], item['data']
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            if isinstance(data, bytes):
+                data = data.decode()
+            deliver(channel[len(self.prefix):], data)
+
+
+def make_broker(config):
+    """Build the broker selected by EVENTS_BACKEND."""
+    name = config['EVENTS_BACKEND']
+    max_streams = config['EVENTS_MAX_STREAMS']
+    if name == 'memory':
+        return Broker(max_streams=max_streams)
+    if name == 'local':
+        from app.cache import LocalStore
+        return Broker(SharedTransport(LocalStore()), max_streams)
+    if name == 'redis':
+        import redis
+        client = redis.StrictRedis.from_url(config['EVENTS_URL'])
+        return Broker(SharedTransport(client), max_streams)
+    raise ValueError('Unknown events backend: {}'.format(name))
+
+
+def init_events(app):
+    """Attach the event broker to the app."""
+    app.extensions['events'] = make_broker(app.config)
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_channels(session, flush_context):
+    """Note the channels of the algorithms and categories written."""
+    channels = session.info.setdefault('event_channels', set())
+    for item in list(session.new) + list(session.dirty) + list(
+            session.deleted):
+        if isinstance(item, Algorithm):
+            channels.add('user:{}'.format(item.user_id))
+        elif isinstance(item, Category):
+            channels.add(CATEGORIES)
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_channels(session):
+    """Wake the streams of the committed changes."""
+    channels = session.info.pop('event_channels', None)
+    broker = has_app_context() and current_app.extensions.get('events')
+    if channels and broker:
+        for channel in channels:
+            broker.publish(channel)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_channels(session):
+    """Publish nothing for rolled back changes."""
+    session.info.pop('event_channels', None)
+
+
+def latest_seq():
+    """Return the sequence number of the latest change."""
+    return db.session.execute(
+        select([func.max(ChangeLog.__table__.c.seq)])).scalar() or 0
+
+
+def format_event(change):
+    """Return a change as a server-sent event."""
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        change['seq'], change['type'],
+        json.dumps(change, separators=(',', ':'), sort_keys=True))
+
+
+def event_stream(subscription, user_id, since):
+    """Yield the changes after since, then new ones as they are committed.
+
+    Each pass reads the feed in CHANGES_BATCH_SIZE pages and ends its
+    transaction, so an idle stream holds no connection. A comment is sent
+    every EVENTS_HEARTBEAT seconds without changes.
+    """
+    config = current_app.config
+    yield 'retry: {}\n\n'.format(config['EVENTS_RETRY_MS'])
+    while True:
+        more = True
+        while more:
+            feed = read_changes(since, config['CHANGES_BATCH_SIZE'], user_id)
+            db.session.close()
+            for change in feed['changes']:
+                yield format_event(change)
+            since, more = feed['next'], feed['more']
+        if not subscription.wait(config['EVENTS_HEARTBEAT']):
+            yield ': heartbeat\n\n'
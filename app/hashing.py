@@ -0,0 +1,124 @@
+"""Password hashing on a bounded process pool.
+
+PBKDF2 holds the GIL for its whole run, so hashes are computed in worker
+processes. A semaphore bounds the jobs waiting on the pool so a login spike
+queues up here instead of growing the pool's unbounded work queue.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash)
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_slots = None
+
+
+class HashStats(object):
+    """Count hashing calls and the time spent in and waiting for them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Zero every counter."""
+        with self._lock:
+            self.counts = {'hash': 0, 'check': 0}
+            self.seconds = {'hash': 0.0, 'check': 0.0}
+            self.wait_seconds = 0.0
+
+    def record(self, kind, seconds, wait_seconds):
+        """Add one call of the given kind."""
+        with self._lock:
+            self.counts[kind] += 1
+            self.seconds[kind] += seconds
+            self.wait_seconds += wait_seconds
+
+    def snapshot(self):
+        """Return the counters as a Dict."""
+        with self._lock:
+            return {'counts': dict(self.counts),
+                    'seconds': dict(self.seconds),
+                    'wait_seconds': self.wait_seconds}
+
+
+stats = HashStats()
+
+
+def get_pool(workers, max_pending):
+    """Return the process pool, creating it after startup or a fork."""
+    global _pool, _pool_pid, _slots
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(max_pending)
+        return _pool, _slots
+
+
+def timed(func, *args):
+    """Call func and return its result with the seconds it took."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def run(kind, func, *args):
+    """Run a hashing function inline or on the pool and record its cost."""
+    config = current_app.config
+    start = time.perf_counter()
+    if config['PASSWORD_HASH_WORKERS']:
+        pool, slots = get_pool(config['PASSWORD_HASH_WORKERS'],
+                               config['PASSWORD_HASH_MAX_PENDING'])
+        with slots:
+            result, seconds = pool.submit(timed, func, *args).result()
+    else:
+        result, seconds = timed(func, *args)
+    stats.record(kind, seconds, time.perf_counter() - start - seconds)
+    return result
+
+
+def hash_password(password):
+    """Hash a password with the configured method and salt length."""
+    config = current_app.config
+    return run('hash', generate_password_hash, password,
+               config['PASSWORD_HASH_METHOD'],
+               config['PASSWORD_HASH_SALT_LENGTH'])
+
+
+def verify_password(pwhash, password):
+    """Check a password against a stored hash."""
+    return run('check', check_password_hash, pwhash, password)
+
+
+def parse_method(method):
+    """Return the algorithm and iteration count of a hash method.
+
+    PBKDF2 methods without a count use werkzeug's default one. Raise
+    ValueError for a count that is not a number.
+    """
+    parts = method.split(':')
+    if parts[0] != 'pbkdf2' or len(parts) < 2:
+        return method, None
+    iterations = int(parts[2]) if len(parts) > 2 else \
+        DEFAULT_PBKDF2_ITERATIONS
+    return 'pbkdf2:' + parts[1].lower(), iterations
+
+
+def needs_rehash(pwhash):
+    """Check whether a stored hash uses outdated parameters."""
+    config = current_app.config
+    method, _, rest = pwhash.partition('$')
+    salt = rest.partition('$')[0]
+    try:
+        outdated = parse_method(method) != parse_method(
+            config['PASSWORD_HASH_METHOD'])
+    except ValueError:
+        outdated = True
+    return outdated or len(salt) != config['PASSWORD_HASH_SALT_LENGTH']
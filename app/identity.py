@@ -0,0 +1,41 @@
+"""Per-process cache of the identities Flask-Login loads per request."""
+from collections import namedtuple
+
+from flask import current_app, has_app_context
+from flask_login import UserMixin
+
+from app.cache import LRUBackend
+from app.signals import on_commit
+
+
+class UserIdentity(UserMixin, namedtuple('UserIdentity', 'id email role')):
+    """Immutable snapshot of the user fields requests rely on."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_user(cls, user):
+        """Snapshot a User."""
+        return cls(user.id, user.email, user.role)
+
+
+def init_identity_cache(app):
+    """Attach an identity cache to the app."""
+    app.extensions['identity_cache'] = LRUBackend(
+        app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+
+
+def identity_cache():
+    """Return the identity cache of the current app."""
+    return current_app.extensions['identity_cache']
+
+
+@on_commit
+def invalidate_identities(changes):
+    """Forget identities of users that were updated or deleted."""
+    if not has_app_context():
+        return
+    cache = current_app.extensions.get('identity_cache')
+    for change in changes:
+        if cache and change.name == 'user' and change.action != 'insert':
+            cache.delete(str(change.id))
@@ -0,0 +1,345 @@
+"""Prometheus metrics of requests, SQL statements, the pool and caches.
+
+Each process keeps its own counters and histograms. With METRICS_DIR set,
+every process also writes them to a file of its own, at most once per
+METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the files of all
+gunicorn workers; otherwise /metrics shows the process serving it.
+"""
+import bisect
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, g, has_request_context, jsonify, \
+    request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Name: (type, help, histogram buckets).
+METRICS = OrderedDict([
+    ('http_requests_total',
+     ('counter', 'Requests served.', None)),
+    ('http_request_duration_seconds',
+     ('histogram', 'Time spent building responses.', LATENCY_BUCKETS)),
+    ('http_response_size_bytes',
+     ('histogram', 'Size of response bodies.', SIZE_BUCKETS)),
+    ('sql_statements_per_request',
+     ('histogram', 'SQL statements run by a request.', STATEMENT_BUCKETS)),
+    ('sql_seconds_per_request',
+     ('histogram', 'Time a request spent running SQL.', LATENCY_BUCKETS)),
+    ('sql_statements_total',
+     ('counter', 'SQL statements run.', None)),
+    ('db_pool_checkouts_total',
+     ('counter', 'Connections taken from a pool.', None)),
+    ('db_pool_checkins_total',
+     ('counter', 'Connections returned to a pool.', None)),
+    ('db_pool_connects_total',
+     ('counter', 'Database connections opened.', None)),
+    ('db_pool_checkout_seconds',
+     ('histogram', 'Time waiting for a pooled connection, including '
+      'opening one.', LATENCY_BUCKETS)),
+    ('db_pool_timeouts_total',
+     ('counter', 'Checkouts that gave up waiting for a connection.', None)),
+    ('cache_hits_total',
+     ('counter', 'Cache lookups that found an entry.', None)),
+    ('cache_misses_total',
+     ('counter', 'Cache lookups that found nothing.', None)),
+    ('cache_hit_ratio',
+     ('gauge', 'Share of cache lookups that found an entry.', None))
+])
+
+_listening = False
+
+
+class Registry(object):
+    """Counters and histograms of this process.
+
+    Samples are keyed by metric name and a tuple of (label, value) pairs.
+    Histograms keep a count per bucket, then the overflow count and the
+    sum of the observed values.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Drop every sample."""
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def inc(self, name, labels=(), amount=1):
+        """Add to a counter."""
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, labels, value):
+        """Set a counter maintained elsewhere."""
+        with self._lock:
+            self.counters[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        """Add a value to a histogram."""
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(buckets) + 2)
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        """Return the samples as JSON-compatible lists."""
+        with self._lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value
+                             in self.counters.items()],
+                'histograms': [[name, labels, list(counts)]
+                               for (name, labels), counts
+                               in self.histograms.items()]
+            }
+
+
+registry = Registry()
+
+
+def merge(snapshots):
+    """Add up the samples of several snapshots."""
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.setdefault(key, [0] * len(counts))
+            for i, count in enumerate(counts):
+                total[i] += count
+    return counters, histograms
+
+
+def format_labels(labels, extra=()):
+    """Return the label set of a sample in the exposition format."""
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs))
+
+
+def format_number(value):
+    """Return a sample value in the exposition format."""
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def add_ratios(counters):
+    """Add the hit ratio of every cache that was looked up."""
+    for (name, labels), hits in list(counters.items()):
+        if name != 'cache_hits_total':
+            continue
+        total = hits + counters.get(('cache_misses_total', labels), 0)
+        if total:
+            counters[('cache_hit_ratio', labels)] = hits / total
+
+
+def render(counters, histograms):
+    """Return samples in the Prometheus text exposition format."""
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind != 'histogram':
+            for (sample, labels), value in sorted(counters.items()):
+                if sample == name:
+                    lines.append('{}{} {}'.format(
+                        name, format_labels(labels), format_number(value)))
+            continue
+        for (sample, labels), counts in sorted(histograms.items()):
+            if sample != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels, [('le', bound)]),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(
+                name, format_labels(labels), format_number(counts[-1])))
+            lines.append('{}_count{} {}'.format(
+                name, format_labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def record_caches(app):
+    """Copy the hit and miss counters of the app's in-process caches."""
+    response_cache = app.extensions.get('response_cache')
+    caches = (('response', response_cache and response_cache.backend),
+              ('identity', app.extensions.get('identity_cache')),
+              ('revision', app.extensions.get('revision_cache')))
+    for name, cache in caches:
+        if hasattr(cache, 'hits'):
+            labels = (('cache', name),)
+            registry.set('cache_hits_total', labels, cache.hits)
+            registry.set('cache_misses_total', labels, cache.misses)
+
+
+def snapshot_path(directory, pid=None):
+    """Return the snapshot file of a process."""
+    return os.path.join(directory,
+                        'metrics-{}.json'.format(pid or os.getpid()))
+
+
+def write_snapshot(app):
+    """Write this process's samples to its file in METRICS_DIR."""
+    record_caches(app)
+    path = snapshot_path(app.config['METRICS_DIR'])
+    with open(path + '.tmp', 'w') as stream:
+        json.dump(registry.snapshot(), stream)
+    os.replace(path + '.tmp', path)
+    app.extensions['metrics_flushed'] = time.time()
+
+
+def collect(app):
+    """Return the samples of every process, added up."""
+    directory = app.config['METRICS_DIR']
+    if not directory:
+        record_caches(app)
+        return merge([registry.snapshot()])
+    write_snapshot(app)
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        try:
+            with open(path) as stream:
+                snapshots.append(json.load(stream))
+        except (OSError, ValueError):
+            continue
+    return merge(snapshots)
+
+
+def clear_snapshots(directory):
+    """Remove the files of earlier processes, e.g. when a server starts."""
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json*')):
+        os.remove(path)
+
+
+def start_timer():
+    """Start timing the request."""
+    g.metrics_started = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+
+
+def record_request(status, size=None):
+    """Record the request once, when its response or error is known."""
+    if 'metrics_started' not in g:
+        return
+    elapsed = time.perf_counter() - g.pop('metrics_started')
+    endpoint = (('endpoint', request.endpoint or 'none'),)
+    registry.inc('http_requests_total', endpoint + (
+        ('method', request.method), ('status', str(status))))
+    registry.observe('http_request_duration_seconds', endpoint, elapsed)
+    if size is not None:
+        registry.observe('http_response_size_bytes', endpoint, size)
+    registry.observe('sql_statements_per_request', endpoint,
+                     g.sql_statements)
+    registry.observe('sql_seconds_per_request', endpoint, g.sql_seconds)
+    app = current_app._get_current_object()
+    interval = app.config['METRICS_FLUSH_INTERVAL']
+    if (app.config['METRICS_DIR'] and time.time() - app.extensions.get(
+            'metrics_flushed', 0) >= interval):
+        write_snapshot(app)
+
+
+def finish_timer(response):
+    """Record a request that returned a response."""
+    size = response.content_length
+    if size is None and not response.is_streamed:
+        size = len(response.get_data())
+    record_request(response.status_code, size)
+    return response
+
+
+def record_error(error):
+    """Record a request that raised."""
+    record_request(500)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    """Start timing a statement."""
+    context._metrics_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    """Count a statement, and add it to the request running it."""
+    registry.inc('sql_statements_total')
+    started = getattr(context, '_metrics_started', None)
+    if started is not None and has_request_context() and \
+            'sql_statements' in g:
+        g.sql_statements += 1
+        g.sql_seconds += time.perf_counter() - started
+
+
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    """Count a connection taken from a pool."""
+    registry.inc('db_pool_checkouts_total')
+
+
+def count_checkin(dbapi_connection, connection_record):
+    """Count a connection returned to a pool."""
+    registry.inc('db_pool_checkins_total')
+
+
+def count_connect(dbapi_connection, connection_record):
+    """Count a new database connection."""
+    registry.inc('db_pool_connects_total')
+
+
+def metrics():
+    """Serve the metrics in the Prometheus text format."""
+    app = current_app._get_current_object()
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(
+            request.headers.get('Authorization', ''),
+            'Bearer {}'.format(token)):
+        return jsonify({'message': 'Unauthorized.'}), 401
+    counters, histograms = collect(app)
+    add_ratios(counters)
+    return Response(render(counters, histograms),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    """Instrument requests and the database, and serve /metrics."""
+    global _listening
+    if not app.config['METRICS_ENABLED']:
+        return
+    app.before_request(start_timer)
+    app.after_request(finish_timer)
+    app.teardown_request(record_error)
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Pool, 'checkout', count_checkout)
+        event.listen(Pool, 'checkin', count_checkin)
+        event.listen(Pool, 'connect', count_connect)
+        _listening = True
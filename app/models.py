@@ -1,26 +1,79 @@
 """Application models."""
+import datetime
+import hashlib
 import os
+from contextlib import contextmanager
 
+from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
 
 from app import db, login_manager
+from app.blobs import decode_blob, encode_blob, read_content
+from app.hashing import hash_password, needs_rehash, verify_password
+from app.identity import UserIdentity, identity_cache
+
+
+class Batch(object):
+    """Pending writes of a db_batch block."""
+
+    def __init__(self, flush_size):
+        self.flush_size = flush_size
+        self.pending = 0
+
+
+@contextmanager
+def db_batch(flush_size=None):
+    """Defer DBHelper commits to the end of the block.
+
+    Writes are flushed every `flush_size` items (DB_BATCH_FLUSH_SIZE by
+    default) and committed once when the block exits, or all rolled back
+    if it raises. Nested blocks join the outermost one.
+    """
+    session = db.session()
+    batch = session.info.get('batch')
+    if batch is not None:
+        yield batch
+        return
+    batch = Batch(flush_size or current_app.config['DB_BATCH_FLUSH_SIZE'])
+    session.info['batch'] = batch
+    try:
+        yield batch
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.info.pop('batch', None)
 
 
 class DBHelper(object):
     """Perform common SQLAlchemy tasks."""
 
+    @staticmethod
+    def commit():
+        """Commit, or count the write towards a flush inside db_batch."""
+        batch = db.session().info.get('batch')
+        if batch is None:
+            db.session.commit()
+            return
+        batch.pending += 1
+        if batch.pending % batch.flush_size == 0:
+            db.session.flush()
+
     @staticmethod
     def add(item):
         """Add item to database."""
         db.session.add(item)
-        db.session.commit()
+        DBHelper.commit()
 
     @staticmethod
     def delete(item):
         """Delete an item from the database."""
         db.session.delete(item)
-        db.session.commit()
+        DBHelper.commit()
 
 
 class User(UserMixin, db.Model):
@@ -35,11 +88,11 @@ class User(UserMixin, db.Model):
 
     def set_password(self, password):
         """Set user password hash."""
-        self.password = generate_password_hash(password)
+        self.password = hash_password(password)
 
     def check_password(self, password):
         """Verify user's password."""
-        return check_password_hash(self.password, password)
+        return verify_password(self.password, password)
 
     @staticmethod
     def register(email, password, username=None, role='user'):
@@ -55,9 +108,12 @@ class User(UserMixin, db.Model):
 
     @staticmethod
     def get_user(email, password):
-        """Find and authenticate a user."""
+        """Find and authenticate a user, upgrading an outdated hash."""
         user = User.query.filter_by(email=email).first()
         if user and user.check_password(password):
+            if needs_rehash(user.password):
+                user.set_password(password)
+                DBHelper.add(user)
             return user
         return None
 
@@ -65,13 +121,48 @@ class User(UserMixin, db.Model):
 class Algorithm(db.Model):
     """Algorithm model."""
 
+    __table_args__ = (
+        db.Index('ix_algorithm_user_id_id', 'user_id', 'id'),
+        db.Index('ix_algorithm_user_id_title_id', 'user_id', 'title', 'id'),
+        db.Index('ix_algorithm_category_id_sub_category_id',
+                 'category_id', 'sub_category', 'id'),
+        db.Index('ix_algorithm_access_id', 'access', 'id'),
+        db.Index('ix_algorithm_title_id', 'title', 'id'),
+        db.Index('ix_algorithm_content_hash', 'content_hash')
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
-    content = db.Column(db.String())
+    # Bodies live in content_blob; rows written before that keep them here
+    # until `flask algorithms migrate-blobs` moves them.
+    inline_content = db.Column('content', db.String())
     sub_category = db.Column(db.String(255))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
     access = db.Column(db.String(100), default='public')
+    content_hash = db.Column(db.String(64))
+    content_length = db.Column(db.Integer, default=0)
+
+    @property
+    def content(self):
+        """Return the body, reading its blob on first access."""
+        if self.inline_content is not None:
+            return self.inline_content
+        loaded = self.__dict__.get('_loaded_content')
+        if loaded is not None and loaded[0] == self.content_hash:
+            return loaded[1]
+        blob = self.content_hash and ContentBlob.query.get(self.content_hash)
+        content = blob.text if blob else None
+        self._loaded_content = (self.content_hash, content)
+        return content
+
+    @content.setter
+    def content(self, content):
+        """Point the algorithm at the blob of a body, created on flush."""
+        self.content_hash, self.content_length = hash_content(content)
+        self.inline_content = None
+        self._loaded_content = (self.content_hash, content)
+        self._unsaved_content = content is not None
 
     def save(self):
         DBHelper.add(self)
@@ -102,6 +193,143 @@ class Algorithm(db.Model):
             'access': self.access
         }
 
+    def get_attributes(self, fields):
+        """Return the given attributes as a Dict."""
+        return {field: getattr(self, field) for field in fields}
+
+
+class ContentBlob(db.Model):
+    """A distinct algorithm body, keyed by its SHA-256 hex digest."""
+
+    hash = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+    # 'zlib' when compressed, None for plain UTF-8.
+    encoding = db.Column(db.String(16))
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    @property
+    def text(self):
+        """Return the decoded body."""
+        return decode_blob(self.data, self.encoding)
+
+
+def store_blobs(connection, contents):
+    """Insert the blobs of bodies keyed by hash, skipping existing ones."""
+    if not contents:
+        return
+    table = ContentBlob.__table__
+    now = datetime.datetime.utcnow()
+    rows = []
+    for content_hash, content in contents.items():
+        data, encoding, size = encode_blob(content)
+        rows.append({'hash': content_hash, 'data': data, 'encoding': encoding,
+                     'size': size, 'created_at': now})
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE')
+    else:
+        existing = {content_hash for content_hash, in connection.execute(
+            select([table.c.hash]).where(table.c.hash.in_(list(contents))))}
+        rows = [row for row in rows if row['hash'] not in existing]
+        statement = table.insert()
+    if rows:
+        connection.execute(statement, rows)
+
+
+def load_contents(ids):
+    """Return the bodies of the given algorithms keyed by id."""
+    if not ids:
+        return {}
+    table, blobs = Algorithm.__table__, ContentBlob.__table__
+    rows = db.session.execute(
+        select([table.c.id, table.c.content, blobs.c.data, blobs.c.encoding])
+        .select_from(table.outerjoin(
+            blobs, blobs.c.hash == table.c.content_hash))
+        .where(table.c.id.in_(list(ids))))
+    return {row[0]: read_content(*row[1:]) for row in rows}
+
+
+@event.listens_for(Session, 'before_flush')
+def store_pending_contents(session, flush_context, instances):
+    """Write the blobs of algorithm bodies set since the last flush."""
+    contents = {}
+    for item in list(session.new) + list(session.dirty):
+        if getattr(item, '_unsaved_content', False):
+            contents[item.content_hash] = item._loaded_content[1]
+    if contents:
+        store_blobs(session.connection(), contents)
+
+
+class Revision(db.Model):
+    """A version of an algorithm, stored whole or as a delta."""
+
+    __tablename__ = 'algorithm_revision'
+    __table_args__ = (
+        db.UniqueConstraint('algorithm_id', 'number'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    algorithm_id = db.Column(
+        db.Integer, db.ForeignKey('algorithm.id', ondelete='CASCADE'),
+        nullable=False)
+    number = db.Column(db.Integer, nullable=False)
+    # Deltas since the last snapshot; 0 for a snapshot.
+    chain = db.Column(db.Integer, nullable=False)
+    # zlib compressed JSON.
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+
+class Signature(db.Model):
+    """The MinHash signature of an algorithm's body."""
+
+    __tablename__ = 'algorithm_signature'
+
+    algorithm_id = db.Column(
+        db.Integer, db.ForeignKey('algorithm.id', ondelete='CASCADE'),
+        primary_key=True)
+    # Little-endian 32 bit hash minimums, one per permutation.
+    data = db.Column(db.LargeBinary, nullable=False)
+
+
+class SignatureBand(db.Model):
+    """An LSH bucket holding an algorithm, one per band of its signature."""
+
+    __tablename__ = 'algorithm_band'
+    __table_args__ = (
+        db.Index('ix_algorithm_band_algorithm_id', 'algorithm_id'),
+    )
+
+    bucket = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    algorithm_id = db.Column(
+        db.Integer, db.ForeignKey('algorithm.id', ondelete='CASCADE'),
+        primary_key=True, autoincrement=False)
+
+
+class ChangeLog(db.Model):
+    """The latest change of an algorithm or category, in commit order."""
+
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        db.Index('ix_change_log_name_object_id', 'name', 'object_id'),
+        db.Index('ix_change_log_user_id_seq', 'user_id', 'seq'),
+        # Sequence numbers of deleted rows are never handed out again.
+        {'sqlite_autoincrement': True}
+    )
+
+    seq = db.Column(db.Integer, primary_key=True)
+    # Table name of the changed row.
+    name = db.Column(db.String(32), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    # 'upsert', or 'delete' for a tombstone.
+    action = db.Column(db.String(16), nullable=False)
+    # Owner of a changed algorithm.
+    user_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
 
 class Category(db.Model):
     """Category model."""
@@ -130,10 +358,25 @@ class Category(db.Model):
         return category
 
 
+def hash_content(content):
+    """Return the SHA-256 hex digest and length of an algorithm body."""
+    if content is None:
+        return None, 0
+    return hashlib.sha256(content.encode()).hexdigest(), len(content)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    """User loader for Flask-Login."""
-    return User.query.get(user_id)
+    """User loader for Flask-Login, served from the identity cache."""
+    cache = identity_cache()
+    identity = cache.get(user_id)
+    if identity is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        identity = UserIdentity.from_user(user)
+        cache.set(user_id, identity)
+    return identity
 
 
 def seed_db():
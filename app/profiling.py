@@ -0,0 +1,215 @@
+"""Opt-in profiling of single requests.
+
+With PROFILING_ENABLED, a request is profiled when an admin sends the
+PROFILE_HEADER header or when it is picked at PROFILE_SAMPLE_RATE. A
+profiled request records a cProfile call profile, its sampled stacks and
+every SQL statement it ran; the last PROFILE_BUFFER_SIZE profiles are kept
+for /debug/profiles. Nothing is registered when profiling is disabled.
+"""
+import collections
+import cProfile
+import itertools
+import pstats
+import random
+import sys
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_listening = False
+
+
+class StackSampler(object):
+    """Count the stacks of one thread, sampled at a fixed interval."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start sampling."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling and wait for the sampler thread."""
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append('{}:{}'.format(
+                    frame.f_globals.get('__name__', '?'),
+                    frame.f_code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+
+class ProfileStore(object):
+    """Ring buffer of the most recent profiles."""
+
+    def __init__(self, size):
+        self._profiles = collections.deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        """Store a profile and return its id."""
+        with self._lock:
+            profile['id'] = next(self._ids)
+            self._profiles.append(profile)
+        return profile['id']
+
+    def get(self, profile_id):
+        """Return a stored profile or None."""
+        with self._lock:
+            for profile in self._profiles:
+                if profile['id'] == profile_id:
+                    return profile
+        return None
+
+    def all(self):
+        """Return the stored profiles, newest first."""
+        with self._lock:
+            return list(reversed(self._profiles))
+
+
+class RequestProfile(object):
+    """The profilers running for one request."""
+
+    def __init__(self, config):
+        self.started = time.time()
+        self.statements = []
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(),
+                                    config['PROFILE_SAMPLE_INTERVAL'])
+        self.sampler.start()
+        self.profiler.enable()
+
+    def finish(self, status, top):
+        """Stop profiling and return the profile as a Dict."""
+        self.profiler.disable()
+        self.sampler.stop()
+        return {
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': status,
+            'started': self.started,
+            'duration_ms': (time.time() - self.started) * 1000,
+            'functions': function_table(self.profiler, top),
+            'statements': self.statements,
+            'stacks': dict(self.sampler.counts)
+        }
+
+
+def function_table(profiler, top):
+    """Return the functions with the highest cumulative time."""
+    rows = []
+    for (filename, line, name), (_, calls, total, cumulative, _) in \
+            pstats.Stats(profiler).stats.items():
+        rows.append({'function': '{}:{}({})'.format(filename, line, name),
+                     'calls': calls, 'total_ms': total * 1000,
+                     'cumulative_ms': cumulative * 1000})
+    rows.sort(key=lambda row: -row['cumulative_ms'])
+    return rows[:top]
+
+
+def statement_table(statements):
+    """Return the statements of a profile grouped by their SQL."""
+    groups = collections.OrderedDict()
+    for statement in statements:
+        group = groups.setdefault(statement['sql'], {
+            'sql': statement['sql'], 'count': 0, 'total_ms': 0.0,
+            'max_ms': 0.0})
+        group['count'] += 1
+        group['total_ms'] += statement['duration_ms']
+        group['max_ms'] = max(group['max_ms'], statement['duration_ms'])
+    return sorted(groups.values(), key=lambda group: -group['total_ms'])
+
+
+def collapsed_stacks(profile):
+    """Return the sampled stacks in the collapsed flame graph format."""
+    return ''.join('{} {}\n'.format(stack, count)
+                   for stack, count in sorted(profile['stacks'].items()))
+
+
+def wants_profile():
+    """Check whether the current request should be profiled."""
+    config = current_app.config
+    if request.blueprint == 'diagnostics':
+        return False
+    if request.headers.get(config['PROFILE_HEADER']):
+        return (current_user.is_authenticated and
+                current_user.role == 'admin')
+    return random.random() < config['PROFILE_SAMPLE_RATE']
+
+
+def start_profile():
+    """Start profiling the request if it is selected."""
+    if wants_profile():
+        g.profile = RequestProfile(current_app.config)
+
+
+def store_profile(status):
+    """Stop the request's profilers and keep the result."""
+    profile = g.pop('profile').finish(
+        status, current_app.config['PROFILE_TOP_FUNCTIONS'])
+    return current_app.extensions['profiles'].add(profile)
+
+
+def finish_profile(response):
+    """Store the profile of a request and point to it in a header."""
+    if 'profile' in g:
+        response.headers['X-Profile-Id'] = str(
+            store_profile(response.status_code))
+    return response
+
+
+def abandon_profile(error):
+    """Store the profile of a request that raised."""
+    if 'profile' in g:
+        store_profile(500)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    """Time statements run by profiled requests."""
+    if has_request_context() and 'profile' in g:
+        context._profile_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    """Log statements run by profiled requests."""
+    started = getattr(context, '_profile_started', None)
+    if started is not None and has_request_context() and 'profile' in g:
+        g.profile.statements.append({
+            'sql': statement, 'parameters': repr(parameters)[:200],
+            'duration_ms': (time.perf_counter() - started) * 1000})
+
+
+def init_profiling(app):
+    """Register the profiling hooks when PROFILING_ENABLED is set."""
+    global _listening
+    if not app.config['PROFILING_ENABLED']:
+        return
+    app.extensions['profiles'] = ProfileStore(
+        app.config['PROFILE_BUFFER_SIZE'])
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(abandon_profile)
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        _listening = True
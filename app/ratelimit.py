@@ -0,0 +1,208 @@
+"""Token-bucket rate limiting per client IP, user and login email.
+
+Limits are looked up by endpoint, then blueprint, then 'default' in
+RATE_LIMITS, e.g. {'auth.login': '10/minute', 'auth': '60/minute'}; a
+limit of None exempts that scope. Each scope has its own buckets, which
+hold up to the limit's count of tokens and refill at count per period.
+Logins also take a token from a bucket per email and client IP, limited
+by RATE_LIMITS['auth.login:email'].
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, jsonify, request
+from flask_login import current_user
+
+Limit = namedtuple('Limit', ['capacity', 'rate'])
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+LOGIN_EMAIL_SCOPE = 'auth.login:email'
+
+
+def parse_limit(spec):
+    """Return the Limit of a spec such as '10/minute'."""
+    count, _, period = spec.partition('/')
+    count = int(count)
+    return Limit(count, count / PERIODS[period])
+
+
+def refill(state, limit, now):
+    """Take a token from a bucket state.
+
+    Return the new state and the seconds to wait, 0 if a token was taken.
+    """
+    tokens, stamp = state or (limit.capacity, now)
+    tokens = min(limit.capacity, tokens + (now - stamp) * limit.rate)
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+    return (tokens, now), (1 - tokens) / limit.rate
+
+
+class MemoryBuckets(object):
+    """Buckets of this process, dropping the least recently used ones."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, buckets, now):
+        """Take a token from each (key, Limit) bucket if all have one.
+
+        Return the seconds to wait, 0 if the tokens were taken.
+        """
+        with self._lock:
+            states = [refill(self._buckets.get(key), limit, now)
+                      for key, limit in buckets]
+            wait = max(wait for _, wait in states)
+            if not wait:
+                for (key, _), (state, _) in zip(buckets, states):
+                    self._buckets[key] = state
+                    self._buckets.move_to_end(key)
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+        return wait
+
+
+class SharedBuckets(object):
+    """Buckets in a Redis-like store shared by every worker.
+
+    Reads and writes are not atomic, so concurrent requests of one client
+    on several workers may occasionally get an extra token.
+    """
+
+    def __init__(self, client, prefix='rate-limit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def read(self, key):
+        """Return the stored state of a bucket, or None."""
+        raw = self.client.get(self.prefix + key)
+        if isinstance(raw, bytes):
+            raw = raw.decode()
+        return tuple(map(float, raw.split(':'))) if raw else None
+
+    def take(self, buckets, now):
+        """Take a token from each (key, Limit) bucket if all have one.
+
+        Return the seconds to wait, 0 if the tokens were taken.
+        """
+        states = [refill(self.read(key), limit, now)
+                  for key, limit in buckets]
+        wait = max(wait for _, wait in states)
+        if not wait:
+            for (key, limit), (state, _) in zip(buckets, states):
+                self.client.set(
+                    self.prefix + key, '{}:{}'.format(*state),
+                    ex=int(math.ceil(limit.capacity / limit.rate)))
+        return wait
+
+
+class RateLimiter(object):
+    """Apply the configured limits and count the requests shed."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.shed = {}
+
+    def limit_for(self, endpoint, limits):
+        """Return the scope and Limit of an endpoint, or (None, None)."""
+        blueprint = endpoint.rpartition('.')[0]
+        for scope in (endpoint, blueprint, 'default'):
+            if scope in limits:
+                spec = limits[scope]
+                return (scope, parse_limit(spec)) if spec else (None, None)
+        return None, None
+
+    def check(self, scope, buckets):
+        """Take a token from every (key, Limit) bucket, or none of them.
+
+        A request refused by one bucket leaves the others untouched.
+        Return the seconds to wait, 0 if the request is allowed.
+        """
+        wait = self.buckets.take(buckets, time.time())
+        with self._lock:
+            if wait:
+                self.shed[scope] = self.shed.get(scope, 0) + 1
+            else:
+                self.allowed += 1
+        return wait
+
+    def snapshot(self):
+        """Return the counters as a Dict."""
+        with self._lock:
+            return {'allowed': self.allowed, 'shed': dict(self.shed)}
+
+
+def make_limiter(config):
+    """Build the limiter selected by RATE_LIMIT_BACKEND, or None."""
+    name = config['RATE_LIMIT_BACKEND']
+    if not name:
+        return None
+    if name == 'memory':
+        return RateLimiter(MemoryBuckets(config['RATE_LIMIT_MEMORY_SIZE']))
+    if name == 'local':
+        from app.cache import LocalStore
+        return RateLimiter(SharedBuckets(LocalStore()))
+    if name == 'redis':
+        import redis
+        client = redis.StrictRedis.from_url(config['RATE_LIMIT_URL'])
+        return RateLimiter(SharedBuckets(client))
+    raise ValueError('Unknown rate limit backend: {}'.format(name))
+
+
+def client_ip():
+    """Return the client address, skipping RATE_LIMIT_PROXY_COUNT proxies."""
+    count = current_app.config['RATE_LIMIT_PROXY_COUNT']
+    route = request.access_route
+    if count and len(route) >= count:
+        return route[-count]
+    return request.remote_addr
+
+
+def client_buckets(scope, limit):
+    """Return the (key, Limit) buckets of the current request."""
+    ip = client_ip()
+    keys = ['ip:{}'.format(ip)]
+    if current_user.is_authenticated:
+        keys.append('user:{}'.format(current_user.id))
+    buckets = [('{}|{}'.format(scope, key), limit) for key in keys]
+    spec = current_app.config['RATE_LIMITS'].get(LOGIN_EMAIL_SCOPE)
+    email = (request.form.get('email')
+             if request.endpoint == 'auth.login' else None)
+    if email and spec:
+        # Keyed by address too, so no one else can lock an account out.
+        digest = hashlib.sha1('{}|{}'.format(
+            email.strip().lower(), ip).encode()).hexdigest()
+        buckets.append(('{}|{}'.format(LOGIN_EMAIL_SCOPE, digest),
+                        parse_limit(spec)))
+    return buckets
+
+
+def check_rate_limit():
+    """Answer 429 when the client has no token left for this endpoint."""
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None or request.endpoint is None:
+        return None
+    scope, limit = limiter.limit_for(
+        request.endpoint, current_app.config['RATE_LIMITS'])
+    if limit is None:
+        return None
+    wait = limiter.check(scope, client_buckets(scope, limit))
+    if not wait:
+        return None
+    response = jsonify({'message': 'Too many requests.'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(math.ceil(wait)))
+    return response
+
+
+def init_rate_limits(app):
+    """Rate limit the app's requests unless RATE_LIMIT_BACKEND is empty."""
+    app.extensions['rate_limiter'] = make_limiter(app.config)
+    app.before_request(check_rate_limit)
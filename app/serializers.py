@@ -0,0 +1,63 @@
+"""JSON encoding with an optional fast backend.
+
+`json_response` produces the same bytes as `jsonify`: compact, with sorted
+keys, ASCII-escaped and with a trailing newline. orjson is used when it is
+installed and JSON_BACKEND allows it; other settings fall back to the
+standard library.
+"""
+import json
+
+from flask import current_app, jsonify
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def fast_backend():
+    """Check whether the fast backend is available and enabled."""
+    return orjson is not None and current_app.config['JSON_BACKEND'] in (
+        'auto', 'orjson')
+
+
+def json_setting(key, attribute):
+    """Return a JSON config value, or its app.json default on newer Flask."""
+    value = current_app.config.get(key)
+    if value is None:
+        value = getattr(getattr(current_app, 'json', None), attribute, True)
+    return value
+
+
+def dumps(obj, newline=False):
+    """Encode obj as compact JSON bytes the way jsonify does."""
+    sort_keys = json_setting('JSON_SORT_KEYS', 'sort_keys')
+    ascii_only = json_setting('JSON_AS_ASCII', 'ensure_ascii')
+    if fast_backend() and sort_keys:
+        option = orjson.OPT_SORT_KEYS
+        if newline:
+            option |= orjson.OPT_APPEND_NEWLINE
+        data = orjson.dumps(obj, option=option)
+        if not ascii_only:
+            return data
+        try:
+            data.decode('ascii')
+            return data
+        except UnicodeDecodeError:
+            pass
+    data = json.dumps(obj, separators=(',', ':'), sort_keys=sort_keys,
+                      ensure_ascii=ascii_only)
+    return (data + '\n' if newline else data).encode()
+
+
+def json_response(obj, status=200):
+    """Return a JSON response, like jsonify but through `dumps`."""
+    if current_app.debug:
+        response = jsonify(obj)
+        response.status_code = status
+        return response
+    mimetype = (current_app.config.get('JSONIFY_MIMETYPE') or
+                getattr(getattr(current_app, 'json', None), 'mimetype',
+                        'application/json'))
+    return current_app.response_class(
+        dumps(obj, newline=True), status=status, mimetype=mimetype)
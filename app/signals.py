@@ -0,0 +1,46 @@
+"""Notify subscribers about model changes once they are committed."""
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+Change = namedtuple('Change', ['action', 'name', 'id'])
+
+_subscribers = []
+
+
+def on_commit(callback):
+    """Register a callback receiving the list of changes of each commit."""
+    _subscribers.append(callback)
+    return callback
+
+
+def record_change(session, action, name, id):
+    """Record a change to pass to the subscribers once session commits."""
+    session.info.setdefault('changes', []).append(Change(action, name, id))
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_changes(session, flush_context):
+    """Record the rows written by a flush until the transaction ends."""
+    for action, items in (('insert', session.new),
+                          ('update', session.dirty),
+                          ('delete', session.deleted)):
+        for item in items:
+            if action != 'update' or session.is_modified(item):
+                record_change(session, action, item.__tablename__, item.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def dispatch_changes(session):
+    """Pass committed changes to the subscribers."""
+    changes = session.info.pop('changes', None)
+    if changes:
+        for callback in _subscribers:
+            callback(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changes(session):
+    """Forget changes that were rolled back."""
+    session.info.pop('changes', None)
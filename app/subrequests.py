@@ -0,0 +1,215 @@
+"""Several API requests answered by one POST /batch round trip.
+
+Sub-requests are dispatched through the app's own routing and hooks, in
+order, and share the batch's login and database session. Runs of
+consecutive reads go to a thread pool of BATCH_WORKERS instead, each with
+its own session, unless the database is an in-memory SQLite one.
+"""
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g, jsonify, request
+from flask_login import current_user
+from werkzeug.test import EnvironBuilder
+
+from app import db
+
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE')
+READ_METHODS = ('GET', 'HEAD')
+# Request headers sub-requests inherit from the batch.
+INHERITED_HEADERS = ('Authorization', 'Cookie', 'User-Agent',
+                     'X-Forwarded-For')
+# Request headers sub-requests may not set: their bodies are embedded in
+# the batch's JSON, so they must not be compressed.
+REFUSED_HEADERS = ('accept-encoding',)
+# Response headers left out of sub-responses.
+DROPPED_HEADERS = ('content-length', 'set-cookie', 'vary')
+# Request globals sub-requests share with the batch.
+SHARED_GLOBALS = ('_login_user', 'wrote')
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+
+def get_pool(workers):
+    """Return the thread pool, creating it after startup or a fork."""
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=workers)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def validate(items):
+    """Return an error message for a malformed batch, or None."""
+    if not isinstance(items, list) or not items:
+        return 'Expected a list of requests.'
+    if len(items) > current_app.config['BATCH_MAX_REQUESTS']:
+        return 'Too many requests.'
+    for index, item in enumerate(items):
+        if not (isinstance(item, dict) and item.get('method') in METHODS and
+                isinstance(item.get('path'), str) and
+                item['path'].startswith('/')):
+            return 'Request {} needs a method and a path.'.format(index)
+        if not isinstance(item.get('headers', {}), dict) or not isinstance(
+                item.get('body', {}), dict):
+            return 'Request {} has invalid headers or body.'.format(index)
+    return None
+
+
+def build_environ(item):
+    """Return the WSGI environ of a sub-request."""
+    headers = [(name, request.headers[name]) for name in INHERITED_HEADERS
+               if name in request.headers]
+    headers.extend((str(name), str(value))
+                   for name, value in item.get('headers', {}).items()
+                   if str(name).lower() not in REFUSED_HEADERS)
+    options = {'data': item['body']} if 'body' in item else {}
+    if 'json' in item:
+        options = {'json': item['json']}
+    builder = EnvironBuilder(
+        path=item['path'], method=item['method'], base_url=request.host_url,
+        headers=headers,
+        environ_base={'REMOTE_ADDR': request.environ.get('REMOTE_ADDR', '')},
+        **options)
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def to_result(response):
+    """Return a sub-response as a Dict, and the size of its body."""
+    if response.is_streamed and response.content_length is None:
+        response.close()
+        return error_result(400, 'Streamed responses cannot be batched.')
+    data = response.get_data()
+    body = json.loads(data) if response.is_json and data else \
+        data.decode('utf-8', 'replace')
+    headers = {name: value for name, value in response.headers
+               if name.lower() not in DROPPED_HEADERS}
+    return {'status': response.status_code, 'headers': headers,
+            'body': body}, len(data)
+
+
+def error_result(status, message):
+    """Return a sub-request error as a Dict, and its size."""
+    return {'status': status, 'headers': {},
+            'body': {'message': message}}, 0
+
+
+def dispatch(app, environ):
+    """Run a sub-request through the app in the current app context."""
+    with app.request_context(environ):
+        if request.endpoint == 'batch_requests':
+            return error_result(400, 'Batches cannot be nested.')
+        try:
+            return to_result(app.full_dispatch_request())
+        except Exception:
+            app.log_exception(sys.exc_info())
+            db.session.rollback()
+            return error_result(500, 'Internal server error.')
+
+
+def dispatch_shared(app, environ):
+    """Run a sub-request that shares the batch's globals."""
+    saved = dict(vars(g))
+    vars(g).clear()
+    vars(g).update((name, saved[name]) for name in SHARED_GLOBALS
+                   if name in saved)
+    try:
+        return dispatch(app, environ)
+    finally:
+        shared = {name: vars(g)[name] for name in SHARED_GLOBALS
+                  if name in vars(g)}
+        vars(g).clear()
+        vars(g).update(saved)
+        vars(g).update(shared)
+
+
+def dispatch_read(app, environ, shared):
+    """Run a read sub-request in a fresh app context of a pool thread."""
+    with app.app_context():
+        vars(g).update(shared)
+        return dispatch(app, environ)
+
+
+def concurrent_reads():
+    """Check whether reads may run on pool threads with their own session."""
+    url = db.engine.url
+    return current_app.config['BATCH_WORKERS'] > 1 and not (
+        url.get_backend_name() == 'sqlite' and
+        url.database in (None, '', ':memory:'))
+
+
+def groups(items, concurrent):
+    """Split items into runs of reads and single writes."""
+    run = []
+    for index, item in enumerate(items):
+        if concurrent and item['method'] in READ_METHODS:
+            run.append(index)
+            continue
+        if run:
+            yield run
+            run = []
+        yield [index]
+    if run:
+        yield run
+
+
+def run_batch(items):
+    """Dispatch sub-requests and return their results in order.
+
+    A request whose body would take the bodies past
+    BATCH_MAX_RESPONSE_SIZE keeps its status but is marked truncated
+    instead of carrying its body. No request is started after that; those
+    left are answered with 413, so retrying them is safe.
+    """
+    app = current_app._get_current_object()
+    limit = app.config['BATCH_MAX_RESPONSE_SIZE']
+    environs = [build_environ(item) for item in items]
+    current_user._get_current_object()
+    results, size = [], 0
+    for indexes in groups(items, concurrent_reads()):
+        if size > limit:
+            break
+        if len(indexes) > 1:
+            shared = {name: vars(g)[name] for name in SHARED_GLOBALS
+                      if name in vars(g)}
+            pool = get_pool(app.config['BATCH_WORKERS'])
+            done = list(pool.map(
+                lambda index: dispatch_read(app, environs[index], shared),
+                indexes))
+        else:
+            done = [dispatch_shared(app, environs[indexes[0]])]
+        for result, result_size in done:
+            size += result_size
+            if size > limit:
+                result = dict(result, body=None, truncated=True)
+            results.append(result)
+    while len(results) < len(items):
+        results.append(error_result(
+            413, 'Batch response is too large; not run.')[0])
+    return results
+
+
+def batch_requests():
+    """Answer a list of API requests in one response."""
+    items = request.get_json(silent=True)
+    if isinstance(items, dict):
+        items = items.get('requests')
+    message = validate(items)
+    if message:
+        return jsonify({'message': message}), 400
+    return jsonify({'responses': run_batch(items)}), 200
+
+
+def init_batch_requests(app):
+    """Serve POST /batch."""
+    app.add_url_rule('/batch', 'batch_requests', batch_requests,
+                     methods=['POST'])
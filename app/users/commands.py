@@ -0,0 +1,16 @@
+"""User management commands."""
+import click
+from flask.cli import with_appcontext
+
+from app.models import User, seed_db
+
+
+@click.command('seed')
+@with_appcontext
+def seed_command():
+    """Create the admin user from ADMIN_EMAIL and ADMIN_PASSWORD."""
+    seed_db()
+    if User.query.filter_by(username='admin').first():
+        click.echo('The admin user is ready.')
+    else:
+        click.echo('Set ADMIN_EMAIL and ADMIN_PASSWORD to create the admin.')
@@ -4,6 +4,7 @@ from flask import request, Blueprint, jsonify
 from flask_login import login_user, logout_user, login_required, current_user
 
 from app.models import User, Algorithm
+from app.algorithms.listing import algorithm_facets, algorithm_list
 
 
 auth_bp = Blueprint('auth', __name__)
@@ -45,6 +46,13 @@ def logout():
 def user_algorithms(user_id=None):
     """Get a user's algorithms or add one."""
     user_id = user_id or current_user.id
-    user_algos = Algorithm.query.filter_by(user_id=user_id)
-    user_algos = [algo.get_secure_attributes() for algo in user_algos]
-    return jsonify(user_algos)
+    return algorithm_list(Algorithm.query.filter_by(user_id=user_id))
+
+
+@auth_bp.route('/algorithms/facets', methods=['GET'])
+@auth_bp.route('/<int:user_id>/algorithms/facets', methods=['GET'])
+@login_required
+def user_algorithm_facets(user_id=None):
+    """Count a user's algorithms per category, sub category and access."""
+    user_id = user_id or current_user.id
+    return algorithm_facets(Algorithm.user_id == user_id)
@@ -0,0 +1,311 @@
+"""Measure API latency, throughput, SQL statements and memory per endpoint.
+
+Examples:
+    python -m benchmarks.run --size 1k --output results.json
+    python -m benchmarks.run --size 100k --server wsgi --concurrency 4 \\
+        --database-url postgresql://localhost/algo_bench \\
+        --baseline baseline.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+from sqlalchemy import event
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import create_app, db
+from benchmarks.seed import (
+    PASSWORD, SIZES, seed, seeded_size, user_count, user_email)
+from config import Config, app_config, get_sqlite_url
+
+# Every client logs in first, so each endpoint sees an authenticated user.
+ENDPOINTS = {
+    'home': ('GET', '/?limit=50'),
+    'algorithm': ('GET', '/{algo_id}'),
+    'login': ('POST', '/users/login'),
+    'categories': ('GET', '/categories'),
+    'user_algorithms': ('GET', '/users/algorithms?limit=50')
+}
+# Run settings that must match for two result files to be comparable.
+COMPARABLE = ('size', 'database', 'server', 'concurrency', 'cache')
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler that does not log every request."""
+
+    def log_request(self, *args, **kwargs):
+        """Skip the access log."""
+
+
+class InProcessClient(object):
+    """Drive the app through the Flask test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        """Send a request and return its status and body size."""
+        res = self.client.open(path, method=method, data=data)
+        return res.status_code, len(res.get_data())
+
+
+class WSGIClient(object):
+    """Drive the app over HTTP, keeping the session cookie."""
+
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port)
+        self.cookie = None
+
+    def request(self, method, path, data=None):
+        """Send a request and return its status and body size."""
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.connection.request(method, path, body=body, headers=headers)
+        res = self.connection.getresponse()
+        payload = res.read()
+        cookie = res.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return res.status, len(payload)
+
+
+class StatementCounter(object):
+    """Count SQL statements sent through an engine."""
+
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.increment)
+
+    def increment(self, *args):
+        """Count one statement."""
+        with self._lock:
+            self.count += 1
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size where the kernel allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in KiB."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    index = max(0, int(round(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def make_client(args, app, port, user_number):
+    """Return a client logged in as the given seeded user."""
+    client = WSGIClient(port) if port else InProcessClient(app)
+    status, _ = client.request('POST', '/users/login', {
+        'email': user_email(user_number), 'password': PASSWORD})
+    if status != 200:
+        raise RuntimeError('Benchmark login failed with {}.'.format(status))
+    return client
+
+
+def run_endpoint(args, app, port, name, counter):
+    """Benchmark one endpoint and return its measurements."""
+    method, path = ENDPOINTS[name]
+    rng = random.Random(args.seed)
+    size = SIZES[args.size]
+    data = {'email': user_email(1), 'password': PASSWORD}
+    clients = [make_client(args, app, port, number % user_count(size) + 1)
+               for number in range(args.concurrency)]
+    per_client = max(1, args.requests // args.concurrency)
+    latencies, errors, sizes = [], [0], []
+    lock = threading.Lock()
+
+    def work(client, iterations, record):
+        local = []
+        for _ in range(iterations):
+            target = path.format(algo_id=rng.randint(1, size))
+            start = time.perf_counter()
+            status, nbytes = client.request(
+                method, target, data if method == 'POST' else None)
+            elapsed = time.perf_counter() - start
+            if record:
+                local.append(elapsed)
+                sizes.append(nbytes)
+                if status >= 400:
+                    with lock:
+                        errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    for client in clients:
+        work(client, args.warmup, False)
+    latencies.clear()
+    reset_peak_rss()
+    statements = counter.count
+    started = time.perf_counter()
+    threads = [threading.Thread(target=work, args=(client, per_client, True))
+               for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    total = len(latencies)
+    return {
+        'requests': total,
+        'errors': errors[0],
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': sum(latencies) / total * 1000,
+        'throughput_rps': total / wall,
+        'statements_per_request': (counter.count - statements) / total,
+        'mean_response_bytes': sum(sizes) / len(sizes),
+        'peak_rss_kb': peak_rss_kb()
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return regressions of p95 latency or statement counts."""
+    regressions = []
+    for key in COMPARABLE:
+        if baseline['meta'].get(key) != results['meta'][key]:
+            print('WARNING baseline {} was {!r}, now {!r}'.format(
+                key, baseline['meta'].get(key), results['meta'][key]))
+    for name, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.2f}ms -> {:.2f}ms'.format(
+                name, previous['p95_ms'], current['p95_ms']))
+        if (current['statements_per_request'] >
+                previous['statements_per_request']):
+            regressions.append('{}: {:.1f} -> {:.1f} statements'.format(
+                name, previous['statements_per_request'],
+                current['statements_per_request']))
+    return regressions
+
+
+def make_app(args):
+    """Create the app against the benchmark database."""
+    class Benchmark(Config):
+        SQLALCHEMY_DATABASE_URI = args.database_url or get_sqlite_url(
+            os.path.join('benchmarks', 'data', args.size + '.db'))
+        RESPONSE_CACHE_BACKEND = 'memory' if args.cache else None
+        RATE_LIMIT_BACKEND = None
+
+    os.makedirs(os.path.join(os.path.dirname(__file__), 'data'),
+                exist_ok=True)
+    app_config['benchmark'] = Benchmark
+    return create_app('benchmark')
+
+
+def parse_args(argv=None):
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', choices=sorted(SIZES), default='1k')
+    parser.add_argument('--database-url',
+                        help='Database to seed, e.g. a local Postgres. '
+                             'Defaults to benchmarks/data/<size>.db.')
+    parser.add_argument('--server', choices=('inprocess', 'wsgi'),
+                        default='inprocess')
+    parser.add_argument('--endpoints', nargs='+', choices=sorted(ENDPOINTS),
+                        default=sorted(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--cache', action='store_true',
+                        help='Keep the response cache enabled.')
+    parser.add_argument('--reseed', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare with a results file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed relative p95 slowdown.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the benchmarks and return the process exit code."""
+    args = parse_args(argv)
+    app = make_app(args)
+    with app.app_context():
+        if args.reseed or not seeded_size(SIZES[args.size]):
+            seed(SIZES[args.size], seed=args.seed)
+        counter = StatementCounter(db.engine)
+
+    server, port = None, None
+    if args.server == 'wsgi':
+        server = make_server('127.0.0.1', 0, app, threaded=True,
+                             request_handler=QuietRequestHandler)
+        port = server.server_port
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = {
+        'meta': {
+            'size': args.size,
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+            'server': args.server,
+            'concurrency': args.concurrency,
+            'cache': args.cache,
+            'python': platform.python_version(),
+            'timestamp': time.time()
+        },
+        'endpoints': {}
+    }
+    try:
+        for name in args.endpoints:
+            results['endpoints'][name] = measured = run_endpoint(
+                args, app, port, name, counter)
+            print('{:<16} p50 {p50_ms:8.2f}ms  p95 {p95_ms:8.2f}ms  '
+                  'p99 {p99_ms:8.2f}ms  {throughput_rps:8.1f} req/s  '
+                  '{statements_per_request:5.1f} SQL/req  '
+                  '{peak_rss_kb} KiB'.format(name, **measured))
+    finally:
+        if server:
+            server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
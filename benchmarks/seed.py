@@ -0,0 +1,136 @@
+"""Seed reproducible synthetic datasets for the benchmarks."""
+import random
+
+from sqlalchemy import inspect
+
+from app import db
+from app.algorithms import codesearch, search
+from app.algorithms.codesearch import rebuild_code_index
+from app.algorithms.search import rebuild_index
+from app.algorithms.similarity import rebuild_similarity
+from app.changes import backfill_changes
+from app.hashing import hash_password
+from app.models import Algorithm, Category, User, hash_content, store_blobs
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+PASSWORD = 'benchmark'
+CATEGORIES = 20
+SUB_CATEGORIES = ('sorting', 'searching', 'graphs', 'dynamic-programming',
+                  'strings', 'math', 'trees', 'greedy')
+WORDS = ('def', 'return', 'for', 'in', 'range', 'if', 'else', 'while',
+         'heapq.heappush(heap,', 'dp[i][j]', 'left', 'right', 'mid', 'graph',
+         'node', 'visited', '.append(', '.pop()', 'len(', 'sorted(', '+=',
+         '==', 'None', 'True', 'memo', 'queue', 'stack', 'count', 'i', 'j')
+# Share of bodies copied from a small pool, like pasted boilerplate.
+DUPLICATE_RATIO = 0.2
+TEMPLATES = 100
+
+
+def user_email(number):
+    """Return the email of a seeded user."""
+    return 'user{}@bench.local'.format(number)
+
+
+def user_count(size):
+    """Return how many users own a dataset of the given size."""
+    return max(10, size // 100)
+
+
+def make_content(rng):
+    """Return a synthetic solution body."""
+    lines = []
+    for _ in range(rng.randint(5, 60)):
+        indent = '    ' * rng.randint(0, 3)
+        words = [rng.choice(WORDS) for _ in range(rng.randint(2, 10))]
+        lines.append(indent + ' '.join(words))
+    return '\n'.join(lines)
+
+
+def schema_current():
+    """Check whether every table and column the app uses exists."""
+    inspector = inspect(db.engine)
+    existing = set(inspector.get_table_names())
+    dialect = db.engine.dialect.name
+    indexes = (search.INDEX_TABLE, codesearch.INDEX_TABLE)
+    if dialect in search.CREATE_INDEX and not existing.issuperset(indexes):
+        return False
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            return False
+        columns = {column['name']
+                   for column in inspector.get_columns(table.name)}
+        if not columns.issuperset(column.name for column in table.columns):
+            return False
+    return True
+
+
+def seeded_size(size):
+    """Check whether the database holds a dataset of this size.
+
+    Databases seeded before a schema change are not reused.
+    """
+    if not schema_current():
+        return False
+    return Algorithm.query.count() == size
+
+
+def seed(size, batch_size=10000, seed=0, log=print):
+    """Replace the database content with `size` synthetic algorithms.
+
+    Must run inside an app context. Rows and their content blobs are
+    inserted with Core statements in batches, which skips the mapper and
+    session events, so the search, code and similarity indexes and the
+    change log are then built in one pass each.
+    """
+    rng = random.Random(seed)
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    users = user_count(size)
+    password = hash_password(PASSWORD)
+    db.session.execute(User.__table__.insert(), [
+        {'id': number, 'email': user_email(number),
+         'username': 'user{}'.format(number), 'role': 'user',
+         'password': password} for number in range(1, users + 1)])
+    db.session.execute(Category.__table__.insert(), [
+        {'id': number, 'name': 'category-{}'.format(number)}
+        for number in range(1, CATEGORIES + 1)])
+    db.session.commit()
+
+    templates = [make_content(rng) for _ in range(TEMPLATES)]
+    table = Algorithm.__table__
+    for start in range(1, size + 1, batch_size):
+        rows, contents = [], {}
+        for number in range(start, min(start + batch_size, size + 1)):
+            if rng.random() < DUPLICATE_RATIO:
+                content = rng.choice(templates)
+            else:
+                content = make_content(rng)
+            content_hash, content_length = hash_content(content)
+            contents[content_hash] = content
+            rows.append({
+                'id': number,
+                'title': 'Solution {}'.format(number),
+                'content_hash': content_hash,
+                'content_length': content_length,
+                'sub_category': rng.choice(SUB_CATEGORIES),
+                'user_id': rng.randint(1, users),
+                'category_id': rng.randint(1, CATEGORIES),
+                'access': 'public' if rng.random() < 0.8 else 'private'
+            })
+        store_blobs(db.session.connection(), contents)
+        db.session.execute(table.insert(), rows)
+        db.session.commit()
+        log('Seeded {} of {} algorithms.'.format(rows[-1]['id'], size))
+
+    rebuild_index()
+    rebuild_code_index()
+    rebuild_similarity()
+    backfill_changes()
+    if db.engine.dialect.name == 'postgresql':
+        for name in ('user', 'category', 'algorithm'):
+            db.session.execute(
+                "SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), "
+                "(SELECT max(id) FROM \"{0}\"))".format(name))
+        db.session.commit()
@@ -0,0 +1,101 @@
+"""Report cold start time: import, app creation and the first requests.
+
+Every run starts a fresh interpreter so imports are not cached.
+
+Examples:
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --preload --output startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.run import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Runs in the child; prints one JSON line of timings in seconds.
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app('production')
+created = time.perf_counter()
+if {preload}:
+    app.preload(application)
+    app.after_fork(application)
+preloaded = time.perf_counter()
+client = application.test_client()
+client.get('/')
+first = time.perf_counter()
+client.get('/')
+second = time.perf_counter()
+print(json.dumps({{
+    'import': imported - start,
+    'create_app': created - imported,
+    'preload': preloaded - created,
+    'first_request': first - preloaded,
+    'second_request': second - first}}))
+'''
+STAGES = ('import', 'create_app', 'preload', 'first_request',
+          'second_request')
+
+
+def prepare_database(path):
+    """Create the schema in an empty SQLite database."""
+    from app import create_app, db
+    from config import get_sqlite_url
+    app = create_app('production')
+    app.config['SQLALCHEMY_DATABASE_URI'] = get_sqlite_url(path)
+    with app.app_context():
+        db.create_all()
+
+
+def run_once(database_url, preload):
+    """Start a fresh interpreter and return its timings."""
+    env = dict(os.environ, DATABASE_URL=database_url,
+               RESPONSE_CACHE_BACKEND='')
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHILD.format(preload=preload)],
+        cwd=ROOT, env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def parse_args(argv=None):
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--preload', action='store_true',
+                        help='Also time preload() and after_fork().')
+    parser.add_argument('--output', help='Write results to this JSON file.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the startup benchmark and return the process exit code."""
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'startup.db')
+        prepare_database(path)
+        runs = [run_once('sqlite:///' + path, args.preload)
+                for _ in range(args.runs)]
+
+    results = {}
+    for stage in STAGES:
+        values = sorted(run[stage] * 1000 for run in runs)
+        results[stage] = {'p50_ms': percentile(values, 0.50),
+                          'max_ms': values[-1]}
+        print('{:<16} p50 {p50_ms:8.2f}ms  max {max_ms:8.2f}ms'.format(
+            stage, **results[stage]))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'runs': args.runs, 'preload': args.preload,
+                       'stages': results}, output, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,6 +13,12 @@ def get_sqlite_url(db_name):
     return 'sqlite:///' + join(basedir, db_name)
 
 
+def get_replica_binds(urls):
+    """Return replica binds from a comma separated list of database urls."""
+    urls = [url.strip() for url in (urls or '').split(',') if url.strip()]
+    return {'replica_{}'.format(i): url for i, url in enumerate(urls)}
+
+
 class Config(object):
     """Default configuration."""
 
@@ -20,12 +26,130 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = (
             os.getenv('DATABASE_URL') or get_sqlite_url('app.db'))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Read-only requests are spread over these; writes use the primary.
+    SQLALCHEMY_BINDS = get_replica_binds(os.getenv('DATABASE_REPLICA_URLS'))
+    DATABASE_REPLICA_CHECK_INTERVAL = 10
+    DATABASE_READ_YOUR_WRITES = 5
+    # Connection pool of server databases such as Postgres.
+    DATABASE_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 5))
+    DATABASE_MAX_OVERFLOW = int(os.getenv('DATABASE_MAX_OVERFLOW', 10))
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_PRE_PING = True
+    # Set on every new SQLite connection; WAL lets reads run during writes.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'busy_timeout': 5000,
+        'cache_size': -64000,
+        'mmap_size': 268435456
+    }
+    MAX_PAGE_SIZE = 1000
+    STREAM_BATCH_SIZE = 500
+    IMPORT_BATCH_SIZE = 500
+    # Algorithm bodies at least this many bytes long are stored compressed.
+    BLOB_COMPRESS_MIN_SIZE = 256
+    BLOB_COMPRESS_LEVEL = 6
+    # Revisions between full snapshots, bounding delta chains.
+    REVISION_SNAPSHOT_INTERVAL = 20
+    REVISION_CACHE_SIZE = 512
+    REVISION_CACHE_TTL = 3600
+    # Largest page of GET /changes.
+    CHANGES_BATCH_SIZE = 500
+    # POST /batch: requests per batch, total size of their bodies, and the
+    # threads running consecutive reads; 1 runs everything in order.
+    BATCH_MAX_REQUESTS = 20
+    BATCH_MAX_RESPONSE_SIZE = 1 << 20
+    BATCH_WORKERS = 4
+    # Server-sent events at /events. Each stream holds a worker thread, so
+    # serve them with threaded or async workers. 'memory' only reaches the
+    # streams of one worker; 'redis' relays messages between them.
+    EVENTS_BACKEND = os.getenv('EVENTS_BACKEND', 'memory')
+    EVENTS_URL = os.getenv('EVENTS_URL')
+    EVENTS_MAX_STREAMS = 100
+    EVENTS_BUFFER_SIZE = 16
+    EVENTS_HEARTBEAT = 15
+    EVENTS_RETRY_MS = 3000
+    # Code search checks candidates in batches, at most MAX_CANDIDATES per
+    # request, and returns a cursor to continue from.
+    CODE_SEARCH_MAX_QUERY = 200
+    CODE_SEARCH_BATCH_SIZE = 200
+    CODE_SEARCH_MAX_CANDIDATES = 2000
+    CODE_SEARCH_MAX_MATCHES = 20
+    # Seconds a code search may spend matching its candidates.
+    CODE_SEARCH_TIMEOUT = 1
+    # MinHash signatures of algorithm bodies; 32 bands of 4 rows find most
+    # pairs above about 0.5 similarity. Changing these needs
+    # `flask algorithms rebuild-similarity`.
+    SIMILARITY_SHINGLE_SIZE = 4
+    SIMILARITY_PERMUTATIONS = 128
+    SIMILARITY_BANDS = 32
+    SIMILARITY_MAX_CANDIDATES = 200
+    SIMILARITY_THRESHOLD = 0.5
+    # Similar algorithms listed with each algorithm.
+    SIMILARITY_SHOWN = 5
+    # Writes per flush inside db_batch, and items per POST /algorithms/batch.
+    DB_BATCH_FLUSH_SIZE = 100
+    MAX_BATCH_OPERATIONS = 1000
+    # Response compression; 'br' is skipped unless brotli is installed.
+    COMPRESS_ENCODINGS = ('br', 'gzip', 'deflate')
+    COMPRESS_MIMETYPES = ('application/json', 'application/x-ndjson',
+                          'text/html', 'text/plain')
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+    # 'auto' uses orjson for list responses when it is installed.
+    JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+    # 'memory' is per worker; use a shared backend with several workers.
+    RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+    RESPONSE_CACHE_URL = os.getenv('RESPONSE_CACHE_URL')
+    RESPONSE_CACHE_SIZE = 1024
+    RESPONSE_CACHE_TTL = 300
+    # Token buckets per client IP, user and login email; see app/ratelimit.py.
+    # 'memory' is per worker; 'redis' shares them between workers.
+    RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_URL = os.getenv('RATE_LIMIT_URL')
+    RATE_LIMIT_MEMORY_SIZE = 10000
+    # Reverse proxies in front of the app that append to X-Forwarded-For.
+    RATE_LIMIT_PROXY_COUNT = int(os.getenv('RATE_LIMIT_PROXY_COUNT', 0))
+    RATE_LIMITS = {
+        'default': '300/minute',
+        'auth.login': '10/minute',
+        'auth.login:email': '5/minute',
+        'auth.register': '5/minute',
+        'algorithm.search_code_route': '30/minute'
+    }
+    # Stored hashes using other parameters are upgraded on login.
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:150000'
+    PASSWORD_HASH_SALT_LENGTH = 16
+    # Hashing processes per worker; 0 hashes on the request thread.
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_MAX_PENDING = 8
+    IDENTITY_CACHE_SIZE = 4096
+    IDENTITY_CACHE_TTL = 60
+    # Prometheus metrics at /metrics; with several workers, each writes its
+    # samples to METRICS_DIR, which must be shared by them and start empty.
+    METRICS_ENABLED = True
+    METRICS_DIR = os.getenv('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = 5
+    # When set, scrapes must send 'Authorization: Bearer <token>'.
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    # Per-request profiles, served at /debug/profiles; see app/profiling.py.
+    # Admins ask for one with PROFILE_HEADER; others are sampled at random.
+    PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '') == '1'
+    PROFILE_HEADER = 'X-Profile'
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_SAMPLE_INTERVAL = 0.001
+    PROFILE_BUFFER_SIZE = 50
+    PROFILE_TOP_FUNCTIONS = 40
 
 
 class Development(Config):
     """Development configuration."""
 
     DEBUG = True
+    DATABASE_POOL_SIZE = 2
+    DATABASE_MAX_OVERFLOW = 2
 
 
 class Testing(Config):
@@ -34,6 +158,10 @@ class Testing(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = (
             os.getenv('DATABASE_TEST_URL') or get_sqlite_url('test.db'))
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    PASSWORD_HASH_WORKERS = 0
+    RATE_LIMIT_BACKEND = None
+    SQLITE_PRAGMAS = dict(Config.SQLITE_PRAGMAS, synchronous='off')
 
 
 app_config = {
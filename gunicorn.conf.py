@@ -0,0 +1,25 @@
+"""Gunicorn settings.
+
+The app is imported once in the master and forked into the workers, which
+share its memory copy-on-write and start without importing anything.
+"""
+preload_app = True
+
+
+def on_starting(server):
+    """Drop the previous run's metrics files; warn of per-worker caches."""
+    from config import Config
+    if Config.METRICS_DIR:
+        from app.metrics import clear_snapshots
+        clear_snapshots(Config.METRICS_DIR)
+    if server.cfg.workers > 1 and Config.RESPONSE_CACHE_BACKEND == 'memory':
+        server.log.warning(
+            'The memory response cache is per worker; writes leave other '
+            'workers serving stale pages. Set RESPONSE_CACHE_BACKEND=redis.')
+
+
+def post_fork(server, worker):
+    """Drop database connections inherited from the master."""
+    from app import after_fork
+    from run import app
+    after_fork(app)
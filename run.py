@@ -1,9 +1,10 @@
 """Flask app entry point."""
 import os
 
-from app import create_app
+from app import create_app, preload
 
 app = create_app(os.getenv('ENV', 'production'))
+preload(app)
 
 if __name__ == '__main__':
     app.run()
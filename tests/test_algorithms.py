@@ -3,10 +3,20 @@
 import os
 import unittest
 import json
+from unittest import mock
 
 import pytest
+from flask import jsonify
+from sqlalchemy import event, text
 
 from app import create_app, db
+from app.algorithms import codesearch, search, similarity
+from app.algorithms.search import rebuild_index
+from app.algorithms.codesearch import rebuild_code_index
+from app.algorithms.commands import migrate_contents, prune_blobs
+from app.algorithms.similarity import rebuild_similarity
+from app.changes import backfill_changes
+from app.models import Algorithm, ContentBlob, db_batch, seed_db
 from tests.helpers import admin, user2, algo1, algo2, cat1, get_json
 
 
@@ -22,6 +32,7 @@ class AlgorithmTestCase(unittest.TestCase):
             db.session.close()
             db.drop_all()
             db.create_all()
+            seed_db()
 
     def login(self):
         """Login a user for other tests."""
@@ -154,6 +165,570 @@ class AlgorithmTestCase(unittest.TestCase):
         assert update.status_code == 403
         assert get_json(update)['message'] == 'Unauthorized.'
 
+    def test_paginate_algorithms(self):
+        """Page through algorithms with limit and an opaque cursor."""
+        self.create_algorithm()
+        self.client.post('/', data=dict(algo1, title='Binary Search'))
+        res = self.client.get('/?limit=1')
+        assert res.status_code == 200
+        assert [a['title'] for a in get_json(res)] == ['Binary Sort']
+        cursor = res.headers['X-Next-Cursor']
+        assert 'rel="next"' in res.headers['Link']
+
+        res = self.client.get('/?limit=1&after=' + cursor)
+        assert [a['title'] for a in get_json(res)] == ['Binary Search']
+        assert 'X-Next-Cursor' not in res.headers
+
+        res = self.client.get('/users/algorithms?limit=1&after=' + cursor)
+        assert [a['title'] for a in get_json(res)] == ['Binary Search']
+
+    def test_invalid_pagination_parameters(self):
+        """Reject malformed cursors, limits and stream formats."""
+        res = self.client.get('/?after=not-a-cursor')
+        assert res.status_code == 400
+        assert get_json(res)['message'] == 'Invalid cursor.'
+        assert self.client.get('/?limit=0').status_code == 400
+        assert self.client.get('/?stream=xml').status_code == 400
+
+    def test_stream_algorithms(self):
+        """Stream algorithms as NDJSON or as a JSON array."""
+        self.create_algorithm()
+        self.client.post('/', data=dict(algo1, title='Binary Search'))
+        res = self.client.get('/?stream=ndjson')
+        assert res.mimetype == 'application/x-ndjson'
+        lines = res.data.decode().splitlines()
+        assert [json.loads(line)['title'] for line in lines] == [
+            'Binary Sort', 'Binary Search']
+
+        res = self.client.get('/?stream=array')
+        assert [a['title'] for a in get_json(res)] == [
+            'Binary Sort', 'Binary Search']
+
+    def test_search_algorithms(self):
+        """Search returns ranked matches with snippets."""
+        self.create_algorithm()
+        self.client.post('/', data=dict(
+            algo1, title='Heap Sort', content='import heapq'))
+        res = self.client.get('/search?q=heapq')
+        assert res.status_code == 200
+        result = get_json(res)
+        assert [algo['title'] for algo in result] == ['Heap Sort']
+        assert '<mark>heapq</mark>' in result[0]['snippet']
+
+        res = self.client.get('/search?q=sort&limit=1')
+        assert len(get_json(res)) == 1
+        assert 'page=2' in res.headers['Link']
+        assert self.client.get('/search?q=').status_code == 400
+
+    def test_search_reads_no_bodies(self):
+        """Search results are read without loading each body."""
+        self.create_algorithm()
+        self.client.post('/', data=dict(algo1, title='Heap Sort'))
+        with self.app.app_context():
+            engine = db.engine
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            result = get_json(self.client.get('/search?q=sort'))
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        assert [algo['title'] for algo in result] == [
+            'Binary Sort', 'Heap Sort']
+        assert 'content' not in result[0]
+        assert not [sql for sql in statements if 'content_blob' in sql]
+
+    def test_search_index_follows_writes(self):
+        """Updates and deletes are reflected in the search index."""
+        self.create_algorithm()
+        self.client.put('/1', data={'title': 'Quick Select'})
+        assert get_json(self.client.get('/search?q=binary')) == []
+        assert len(get_json(self.client.get('/search?q=quick'))) == 1
+
+        self.client.delete('/1')
+        assert get_json(self.client.get('/search?q=quick')) == []
+
+    def test_rebuild_search_index(self):
+        """The search index can be rebuilt from the algorithm table."""
+        self.create_algorithm()
+        with self.app.app_context():
+            assert rebuild_index(batch_size=1) == 1
+        res = self.client.get('/search?q=binary')
+        assert get_json(res)[0]['title'] == 'Binary Sort'
+
+    def test_search_index_is_found_once_created(self):
+        """A missing index table is looked for again after a while."""
+        with self.app.app_context():
+            connection = db.session.connection()
+            search.drop_index(connection)
+            assert not search.index_ready(connection)
+            for statement in search.CREATE_INDEX[connection.dialect.name]:
+                connection.execute(text(statement))
+            assert not search.index_ready(connection)
+            with mock.patch.object(search, 'RECHECK_INTERVAL', 0):
+                assert search.index_ready(connection)
+            db.session.commit()
+
+    def test_code_index_is_found_once_created(self):
+        """A missing code index table is looked for again after a while."""
+        with self.app.app_context():
+            connection = db.session.connection()
+            codesearch.drop_index(connection)
+            assert not codesearch.index_ready(connection)
+            for statement in codesearch.CREATE_INDEX[
+                    connection.dialect.name]:
+                connection.execute(text(statement))
+            assert not codesearch.index_ready(connection)
+            with mock.patch.object(codesearch, 'RECHECK_INTERVAL', 0):
+                assert codesearch.index_ready(connection)
+            db.session.commit()
+
+    def test_conditional_get_algorithm(self):
+        """Answer repeated reads with 304 until the algorithm changes."""
+        self.create_algorithm()
+        res = self.client.get('/1')
+        etag = res.headers['ETag']
+        assert res.headers['Last-Modified']
+
+        res = self.client.get('/1', headers={'If-None-Match': etag})
+        assert res.status_code == 304
+
+        self.client.put('/1', data=algo2)
+        res = self.client.get('/1', headers={'If-None-Match': etag})
+        assert res.status_code == 200
+        assert get_json(res)['title'] == 'Binary Search'
+        assert res.headers['ETag'] != etag
+
+    def test_cached_list_is_invalidated_by_writes(self):
+        """Creating or deleting an algorithm refreshes the cached list."""
+        self.create_algorithm()
+        assert len(get_json(self.client.get('/'))) == 1
+        self.client.post('/', data=algo1)
+        assert len(get_json(self.client.get('/'))) == 2
+        self.client.delete('/1')
+        assert len(get_json(self.client.get('/'))) == 1
+
+    def test_summary_view(self):
+        """The summary view replaces the content with its length and hash."""
+        self.create_algorithm()
+        res = self.client.get('/?view=summary')
+        result = get_json(res)[0]
+        assert 'content' not in result
+        assert result['content_length'] == len(algo1['content'])
+        assert len(result['content_hash']) == 64
+
+        res = self.client.get('/users/algorithms?fields=id,title')
+        assert get_json(res) == [{'id': 1, 'title': 'Binary Sort'}]
+        assert self.client.get('/?fields=password').status_code == 400
+        assert self.client.get('/?view=tiny').status_code == 400
+
+    def test_import_and_export_algorithms(self):
+        """Import NDJSON in batches and stream it back out."""
+        self.create_category()
+        self.app.config['IMPORT_BATCH_SIZE'] = 2
+        lines = [
+            json.dumps({'title': 'Heap Sort', 'category_id': 1}),
+            '{not json',
+            json.dumps({'title': 'Merge Sort', 'category_id': 1,
+                        'content': 'def merge(): pass'}),
+            json.dumps({'title': 'Lost', 'category_id': 99}),
+            json.dumps({'title': 'Quick Sort', 'category_id': 1})
+        ]
+        res = self.client.post(
+            '/algorithms/import', data='\n'.join(lines),
+            content_type='application/x-ndjson')
+        result = get_json(res)
+        assert res.status_code == 200
+        assert result['imported'] == 3
+        assert [error['line'] for error in result['errors']] == [2, 4]
+
+        res = self.client.get('/algorithms/export')
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+        assert [row['title'] for row in rows] == [
+            'Heap Sort', 'Merge Sort', 'Quick Sort']
+
+        self.logout()
+        assert self.client.get('/algorithms/export').status_code == 401
+
+    def test_filter_and_sort_algorithms(self):
+        """Filter by sub category and page through a title ordering."""
+        self.create_algorithm()
+        self.client.post('/', data=dict(algo1, title='Heap Sort'))
+        self.client.post('/', data=dict(
+            algo1, title='Jump Search', sub_category='searching'))
+
+        res = self.client.get('/?sub_category=sorting&sort=-title&limit=1')
+        assert [a['title'] for a in get_json(res)] == ['Heap Sort']
+        cursor = res.headers['X-Next-Cursor']
+        res = self.client.get(
+            '/?sub_category=sorting&sort=-title&limit=1&after=' + cursor)
+        assert [a['title'] for a in get_json(res)] == ['Binary Sort']
+        assert 'X-Next-Cursor' not in res.headers
+
+        res = self.client.get('/?sort=id&after=' + cursor)
+        assert res.status_code == 400
+        res = self.client.get('/?sort=title&after=' + cursor)
+        assert get_json(res) == {'message': 'Invalid cursor.'}
+        assert self.client.get('/?sort=content').status_code == 400
+        assert self.client.get('/?category_id=x').status_code == 400
+
+    def test_algorithm_facets(self):
+        """Facets count algorithms per category, sub category and access."""
+        self.create_algorithm()
+        self.client.post('/', data=dict(algo1, title='Heap Sort'))
+        self.client.post('/', data=dict(
+            algo1, title='Jump Search', sub_category='searching'))
+        res = self.client.get('/algorithms/facets')
+        result = get_json(res)
+        assert result['category_id'] == [{'value': 1, 'count': 3}]
+        assert result['sub_category'] == [
+            {'value': 'sorting', 'count': 2},
+            {'value': 'searching', 'count': 1}]
+        assert result['access'] == [{'value': 'public', 'count': 3}]
+
+        res = self.client.get('/users/algorithms/facets?sub_category=sorting')
+        assert get_json(res)['category_id'] == [{'value': 1, 'count': 2}]
+
+    def test_list_matches_jsonify(self):
+        """The fast list encoding is byte-identical to jsonify."""
+        self.create_algorithm()
+        self.client.post('/', data=dict(algo1, title='Tri rapide \u00e9'))
+        for backend in ('auto', 'stdlib'):
+            self.app.config['JSON_BACKEND'] = backend
+            res = self.client.get('/')
+            with self.app.app_context():
+                expected = jsonify([algo.get_secure_attributes()
+                                    for algo in Algorithm.query]).get_data()
+            assert res.get_data() == expected
+            assert res.mimetype == 'application/json'
+
+    def test_db_batch_commits_once_or_rolls_back(self):
+        """db_batch defers commits and undoes every write on error."""
+        self.create_algorithm()
+        with self.app.app_context():
+            with db_batch(flush_size=2):
+                for number in range(3):
+                    Algorithm.add(title='Batch {}'.format(number),
+                                  category_id=1, user_id=1)
+            assert Algorithm.query.count() == 4
+
+            with pytest.raises(RuntimeError):
+                with db_batch():
+                    Algorithm.add(title='Lost', category_id=1, user_id=1)
+                    Algorithm.get(1).delete()
+                    raise RuntimeError()
+            assert Algorithm.query.count() == 4
+            assert Algorithm.get(1) is not None
+
+    def test_batch_operations(self):
+        """Many algorithms are created, updated and deleted at once."""
+        self.create_algorithm()
+        self.client.post('/', data=dict(algo1, title='Heap Sort'))
+        res = self.client.post('/algorithms/batch', json=[
+            {'op': 'create', 'title': 'Jump Search', 'category_id': 1},
+            {'op': 'update', 'id': 1, 'title': 'Merge Sort'},
+            {'op': 'delete', 'id': 2}])
+        assert res.status_code == 200
+        results = get_json(res)['results']
+        assert results[0]['status'] == 201
+        assert results[0]['algorithm']['title'] == 'Jump Search'
+        assert results[1]['algorithm']['title'] == 'Merge Sort'
+        assert results[2] == {'index': 2, 'status': 200, 'id': 2}
+        assert sorted(a['title'] for a in get_json(self.client.get('/'))) == [
+            'Jump Search', 'Merge Sort']
+
+        res = self.client.post('/algorithms/batch', json={'operations': [
+            {'op': 'update', 'id': 1, 'title': 'Quick Sort'},
+            {'op': 'update', 'id': 99, 'title': 'Missing'},
+            {'op': 'create', 'title': 'No category'}]})
+        assert res.status_code == 400
+        errors = get_json(res)['errors']
+        assert [(e['index'], e['status']) for e in errors] == [
+            (1, 404), (2, 400)]
+        assert get_json(self.client.get('/1'))['title'] == 'Merge Sort'
+        assert self.client.post(
+            '/algorithms/batch', json=[]).status_code == 400
+
+    def test_batch_rejects_malformed_operations(self):
+        """Malformed operations are reported by index, not raised."""
+        self.create_algorithm()
+        for operations, message in (
+                ([{'title': 'x'}], 'Invalid op.'),
+                (['x'], 'Expected a JSON object.'),
+                ([{'op': 'update', 'id': [1]}], 'Invalid id.')):
+            res = self.client.post('/algorithms/batch', json=operations)
+            assert res.status_code == 400
+            assert get_json(res)['errors'] == [
+                {'index': 0, 'status': 400, 'message': message}]
+
+    def test_batch_reports_database_errors(self):
+        """A write refused by the database is reported at its index."""
+        self.create_algorithm()
+        with self.app.app_context():
+            db.session.execute(
+                "CREATE TRIGGER refuse_title BEFORE UPDATE ON algorithm "
+                "WHEN NEW.title = 'Refused' "
+                "BEGIN SELECT RAISE(ABORT, 'refused'); END")
+            db.session.commit()
+        res = self.client.post('/algorithms/batch', json=[
+            {'op': 'create', 'title': 'Jump Search', 'category_id': 1},
+            {'op': 'update', 'id': 99, 'title': 'Missing'},
+            {'op': 'update', 'id': 1, 'title': 'Refused'},
+            {'op': 'create', 'title': 'Heap Sort', 'category_id': 1}])
+        assert res.status_code == 400
+        assert get_json(res)['errors'] == [
+            {'index': 1, 'status': 404,
+             'message': 'Algorithm does not exist.'},
+            {'index': 2, 'status': 400, 'message': 'Could not be saved.'}]
+        assert [a['title'] for a in get_json(self.client.get('/'))] == [
+            'Binary Sort']
+
+    def test_contents_are_deduplicated_and_compressed(self):
+        """Identical bodies share one blob, compressed when large enough."""
+        self.create_algorithm()
+        content = 'for i in range(n):\n    total += i\n' * 20
+        for title in ('Sum', 'Sum again'):
+            self.client.post('/', data=dict(algo1, title=title,
+                                            content=content))
+        with self.app.app_context():
+            blobs = {blob.hash: blob for blob in ContentBlob.query}
+            assert len(blobs) == 2
+            large = blobs[Algorithm.get(2).content_hash]
+            assert large.encoding == 'zlib'
+            assert len(large.data) < large.size == len(content)
+            assert blobs[Algorithm.get(1).content_hash].encoding is None
+        assert get_json(self.client.get('/3'))['content'] == content
+        assert [a['content'] for a in get_json(self.client.get('/'))] == [
+            algo1['content'], content, content]
+
+        self.client.put('/3', data={'content': 'print(3)'})
+        with self.app.app_context():
+            assert prune_blobs(older_than=0) == 0
+        self.client.put('/2', data={'content': 'print(2)'})
+        with self.app.app_context():
+            assert prune_blobs(older_than=0) == 1
+
+    def test_migrate_inline_contents(self):
+        """Bodies stored inline are moved to blobs without API changes."""
+        self.create_algorithm()
+        with self.app.app_context():
+            db.session.execute(Algorithm.__table__.insert(), [
+                {'title': 'Legacy', 'content': 'print("old")',
+                 'user_id': 1, 'category_id': 1}])
+            db.session.commit()
+        assert get_json(self.client.get('/2'))['content'] == 'print("old")'
+        with self.app.app_context():
+            assert migrate_contents(batch_size=1) == 1
+            algo = Algorithm.get(2)
+            assert algo.inline_content is None
+            assert ContentBlob.query.get(algo.content_hash) is not None
+        res = self.client.get('/?stream=ndjson')
+        assert [json.loads(line)['content'] for line in
+                res.get_data(as_text=True).splitlines()] == [
+            algo1['content'], 'print("old")']
+
+    def test_revision_history(self):
+        """Edits are kept as revisions that can be fetched and compared."""
+        self.create_algorithm()
+        lines = ['line {}\n'.format(number) for number in range(60)]
+        versions = [algo1['content']]
+        self.app.config['REVISION_SNAPSHOT_INTERVAL'] = 3
+        for edit in range(6):
+            lines[edit * 7] = 'edited {}\n'.format(edit)
+            versions.append(''.join(lines))
+            self.client.put('/1', data={'content': versions[-1]})
+        self.client.put('/1', data={'title': 'Renamed'})
+
+        res = self.client.get('/1/revisions')
+        revisions = get_json(res)
+        assert [r['number'] for r in revisions] == list(range(1, 9))
+        assert [r['snapshot'] for r in revisions] == [
+            True, True, False, False, True, False, False, True]
+
+        self.app.extensions['revision_cache'] = type(
+            self.app.extensions['revision_cache'])()
+        for number, content in enumerate(versions, 1):
+            res = self.client.get('/1/revisions/{}'.format(number))
+            assert get_json(res)['content'] == content
+            assert get_json(res)['title'] == 'Binary Sort'
+        res = self.client.get('/1/revisions/8')
+        assert get_json(res)['title'] == 'Renamed'
+        assert self.client.get('/1/revisions/9').status_code == 404
+
+        diff = get_json(self.client.get('/1/revisions/2/diff/8'))
+        assert diff['fields'] == {
+            'title': {'from': 'Binary Sort', 'to': 'Renamed'}}
+        assert '-line 7\n+edited 1\n' in diff['diff']
+
+        self.client.delete('/1')
+        assert self.client.get('/1/revisions').status_code == 404
+        with self.app.app_context():
+            assert db.session.execute(
+                'SELECT count(*) FROM algorithm_revision').scalar() == 0
+
+    def test_revisions_of_algorithms_written_before_history(self):
+        """The first edit of an older algorithm also records its old state."""
+        self.create_category()
+        with self.app.app_context():
+            db.session.execute(Algorithm.__table__.insert(), [
+                {'title': 'Legacy', 'content': 'print("old")',
+                 'user_id': 1, 'category_id': 1}])
+            db.session.commit()
+        assert get_json(self.client.get('/1/revisions')) == []
+        self.client.put('/1', data={'content': 'print("new")'})
+        assert [get_json(self.client.get('/1/revisions/{}'.format(n)))[
+            'content'] for n in (1, 2)] == ['print("old")', 'print("new")']
+
+    def test_code_search(self):
+        """Substrings and regexes are found with their positions."""
+        self.create_category()
+        for content in ('import heapq\nheapq.heappush(heap, x)',
+                        'dp[i][j] = dp[i][j-1] + dp[i-1][j]',
+                        'heap = []\nheapq.heappop(heap)',
+                        'HEAPQ.HEAPPUSH(h, 1)'):
+            self.client.post('/', data=dict(algo1, content=content))
+        result = get_json(self.client.get('/search/code?q=heapq.heappush('))
+        assert [item['id'] for item in result] == [1]
+        assert result[0]['matches'] == [{
+            'start': 13, 'end': 28, 'line': 2, 'column': 1,
+            'text': 'heapq.heappush(heap, x)'}]
+        res = self.client.get('/search/code?q=heapq.heappush(&ignore_case=1')
+        assert [item['id'] for item in get_json(res)] == [1, 4]
+        res = self.client.get('/search/code', query_string={'q': 'dp[i][j-1]'})
+        assert get_json(res)[0]['matches'][0]['column'] == 12
+        res = self.client.get('/search/code', query_string={
+            'q': r'heapq\.heap(push|pop)\(', 'regex': '1', 'limit': 1})
+        assert [item['id'] for item in get_json(res)] == [1]
+        res = self.client.get(res.headers['Link'][1:].partition('>')[0])
+        assert [item['id'] for item in get_json(res)] == [3]
+
+        self.client.put('/1', data={'content': 'print(1)'})
+        res = self.client.get('/search/code?q=heappush')
+        assert get_json(res) == []
+        self.client.put('/4', data={'content': ''})
+        res = self.client.get('/search/code?q=heappush&ignore_case=1')
+        assert get_json(res) == []
+        for query in ('ab', r'a.c', '(x'):
+            res = self.client.get('/search/code', query_string={
+                'q': query, 'regex': '1'})
+            assert res.status_code == 400
+        with self.app.app_context():
+            assert rebuild_code_index(batch_size=3) == 4
+        res = self.client.get('/search/code?q=heappop')
+        assert [item['id'] for item in get_json(res)] == [3]
+
+    def test_code_search_timeout(self):
+        """A regex that backtracks for too long is stopped with a 400."""
+        self.create_category()
+        self.client.post('/', data=dict(algo1, content='abc' + 'a' * 40))
+        self.app.config['CODE_SEARCH_TIMEOUT'] = 0.1
+        res = self.client.get('/search/code', query_string={
+            'q': 'abc(a|aa)+d', 'regex': '1'})
+        assert res.status_code == 400
+        assert get_json(res) == {'message': 'Query took too long.'}
+
+    def test_change_feed(self):
+        """Clients fetch only what changed since their last sync."""
+        self.create_category()
+        for title in ('First', 'Second', 'Third'):
+            self.client.post('/', data=dict(algo1, title=title))
+        result = get_json(self.client.get('/changes?limit=3'))
+        assert [(change['type'], change['id'], change['seq'])
+                for change in result['changes']] == [
+            ('category', 1, 1), ('algorithm', 1, 2), ('algorithm', 2, 3)]
+        assert result['more'] is True
+        assert result['changes'][1]['data']['title'] == 'First'
+        result = get_json(self.client.get(
+            '/changes?since={}'.format(result['next'])))
+        assert [change['id'] for change in result['changes']] == [3]
+        assert result['more'] is False
+        since = result['next']
+
+        self.client.put('/2', data={'title': 'Second edit'})
+        self.client.delete('/1')
+        self.client.put('/2', data={'title': 'Second again'})
+        result = get_json(self.client.get('/changes?since={}'.format(since)))
+        assert [(change['id'], change['action'], change['data'])
+                for change in result['changes']][0] == (1, 'delete', None)
+        assert result['changes'][1]['data']['title'] == 'Second again'
+        assert len(result['changes']) == 2
+        result = get_json(self.client.get('/changes?since=0'))
+        assert [change['id'] for change in result['changes']] == [1, 3, 1, 2]
+
+        self.client.post('/users/register', data=user2)
+        self.client.post('/users/login', data=user2)
+        result = get_json(self.client.get('/changes?mine=1'))
+        assert [change['type'] for change in result['changes']] == [
+            'category']
+        assert self.client.get('/changes?since=x').status_code == 400
+
+    def test_backfill_change_feed(self):
+        """Rows written before the feed existed can be added to it."""
+        self.create_category()
+        self.client.post('/', data=algo1)
+        with self.app.app_context():
+            db.session.execute('DELETE FROM change_log')
+            db.session.commit()
+            assert backfill_changes(batch_size=1) == 2
+            assert backfill_changes() == 0
+        result = get_json(self.client.get('/changes'))
+        assert [change['type'] for change in result['changes']] == [
+            'category', 'algorithm']
+
+    def test_similar_algorithms(self):
+        """Near-duplicate bodies are found and the index follows writes."""
+        body = '\n'.join(
+            'def step_{0}(items):\n    return sorted(items)[{0}]'.format(i)
+            for i in range(20))
+        self.create_category()
+        for title, content in (('Original', body),
+                               ('Copy', body.replace('step_3', 'stage')),
+                               ('Other', 'print("something else")')):
+            self.client.post('/', data=dict(algo1, title=title,
+                                            content=content))
+        result = get_json(self.client.get('/algorithms/1/similar'))
+        assert [item['title'] for item in result] == ['Copy']
+        assert 0.5 < result[0]['similarity'] < 1
+        assert get_json(self.client.get('/1'))['similar'] == result
+
+        backend = self.app.extensions['response_cache'].backend
+        hits = backend.hits
+        self.client.put('/3', data={'title': 'Another'})
+        self.client.post('/', data=dict(algo1, title='Unrelated'))
+        assert get_json(self.client.get('/1'))['similar'] == result
+        assert backend.hits == hits + 1
+        self.client.put('/2', data={'title': 'Renamed copy'})
+        assert get_json(self.client.get('/1'))['similar'][0][
+            'title'] == 'Renamed copy'
+
+        self.client.put('/3', data={'content': body})
+        result = get_json(self.client.get('/algorithms/1/similar'))
+        assert result[0] == {'id': 3, 'title': 'Another', 'similarity': 1.0}
+        assert get_json(self.client.get('/1'))['similar'] == result
+        self.client.delete('/3')
+        result = get_json(self.client.get('/algorithms/1/similar'))
+        assert [item['id'] for item in result] == [2]
+        res = self.client.get('/algorithms/1/similar?min_similarity=2')
+        assert res.status_code == 400
+        with self.app.app_context():
+            assert rebuild_similarity(batch_size=1) == 3
+        assert get_json(self.client.get('/algorithms/2/similar'))[0][
+            'id'] == 1
+
+    def test_minhash_implementations_agree(self):
+        """NumPy and pure Python compute identical signatures."""
+        pytest.importorskip('numpy')
+        with open(similarity.__file__) as source:
+            hashes = similarity.shingle_hashes(source.read(), 4)
+        fast = similarity.minhash(hashes, 128)
+        others = [fast[:64] + fast[:64], list(reversed(fast))]
+        scores = similarity.similarities(fast, others)
+        with mock.patch.object(similarity, 'numpy', None):
+            assert similarity.minhash(hashes, 128) == fast
+            assert similarity.similarities(fast, others) == scores
+
     def tearDown(self):
         with self.app.app_context():
             db.session.remove()
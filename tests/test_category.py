@@ -6,6 +6,7 @@ import unittest
 import pytest
 
 from app import create_app, db
+from app.models import seed_db
 from tests.helpers import get_json, user1, admin, cat1, cat2
 
 
@@ -22,6 +23,7 @@ class CategoryTestCase(unittest.TestCase):
             db.session.close()
             db.drop_all()
             db.create_all()
+            seed_db()
 
     def login(self):
         """Login a user for other tests."""
@@ -115,6 +117,21 @@ class CategoryTestCase(unittest.TestCase):
         res = self.client.delete(self.route + '/22')
         assert res.status_code == 404
 
+    def test_conditional_get_categories(self):
+        """Cached categories are refreshed when a category changes."""
+        self.create_category()
+        res = self.client.get(self.route)
+        etag = res.headers['ETag']
+        res = self.client.get(self.route, headers={'If-None-Match': etag})
+        assert res.status_code == 304
+
+        self.client.put(self.route + '/1', data=cat2)
+        res = self.client.get(self.route, headers={'If-None-Match': etag})
+        assert res.status_code == 200
+        assert get_json(res)[0]['name'] == 'hackerrank'
+        assert get_json(self.client.get(self.route + '/1'))['name'] == (
+            'hackerrank')
+
     def tearDown(self):
         with self.app.app_context():
             db.session.remove()
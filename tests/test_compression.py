@@ -0,0 +1,107 @@
+"""Module for testing response compression."""
+
+import gzip
+import os
+import unittest
+import zlib
+from unittest import mock
+
+import pytest
+
+from app import compression, create_app, db
+from app.models import seed_db
+from tests.helpers import admin, algo1, cat1
+
+
+class CompressionTestCase(unittest.TestCase):
+    """Compression tests."""
+
+    def setUp(self):
+        os.environ['ADMIN_EMAIL'] = admin['email']
+        os.environ['ADMIN_PASSWORD'] = admin['password']
+        self.app = create_app("testing")
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.session.close()
+            db.drop_all()
+            db.create_all()
+            seed_db()
+
+    def create_algorithms(self, count=3):
+        """Create algorithms with bodies above the compression threshold."""
+        self.client.post('/users/login', data=admin)
+        self.client.post('/categories', data=cat1)
+        content = 'for i in range(n):\n    total += i\n' * 30
+        for number in range(count):
+            res = self.client.post('/', data=dict(
+                algo1, title='Sum {}'.format(number), content=content))
+            assert res.status_code == 201
+
+    def test_negotiate_encoding(self):
+        """Bodies are compressed with the encoding the client prefers."""
+        self.create_algorithms()
+        plain = self.client.get('/')
+        assert 'Content-Encoding' not in plain.headers
+        assert 'Accept-Encoding' in plain.headers['Vary']
+
+        res = self.client.get('/', headers={
+            'Accept-Encoding': 'deflate;q=0.5, gzip'})
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(res.get_data()) == plain.get_data()
+        assert res.headers['ETag'].startswith('W/')
+
+        res = self.client.get('/', headers={'Accept-Encoding': 'deflate'})
+        assert res.headers['Content-Encoding'] == 'deflate'
+        assert zlib.decompress(res.get_data()) == plain.get_data()
+
+    def test_small_responses_are_not_compressed(self):
+        """Payloads under COMPRESS_MIN_SIZE are sent as they are."""
+        res = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert res.get_data() == b'[]\n'
+        assert 'Content-Encoding' not in res.headers
+
+    def test_compress_stream(self):
+        """Streamed responses are compressed chunk by chunk."""
+        self.create_algorithms()
+        self.app.config['STREAM_BATCH_SIZE'] = 1
+        plain = self.client.get('/?stream=ndjson').get_data()
+        res = self.client.get('/?stream=ndjson',
+                              headers={'Accept-Encoding': 'gzip'})
+        assert res.headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Length' not in res.headers
+        assert gzip.decompress(res.get_data()) == plain
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        """brotli is preferred when the client accepts it."""
+        self.create_algorithms()
+        plain = self.client.get('/1').get_data()
+        res = self.client.get('/1', headers={
+            'Accept-Encoding': 'gzip, deflate, br'})
+        assert res.headers['Content-Encoding'] == 'br'
+        assert compression.brotli.decompress(res.get_data()) == plain
+
+    def test_cached_responses_are_compressed_once(self):
+        """Cache hits reuse the compressed body stored with the entry."""
+        self.create_algorithms()
+        headers = {'Accept-Encoding': 'gzip'}
+        with mock.patch('app.cache.compress',
+                        wraps=compression.compress) as compress:
+            first = self.client.get('/1', headers=headers)
+            second = self.client.get('/1', headers=headers)
+            assert compress.call_count == 1
+        assert first.get_data() == second.get_data()
+        assert second.headers['Content-Encoding'] == 'gzip'
+
+        res = self.client.get('/1', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': first.headers['ETag']})
+        assert res.status_code == 304
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    pytest.main()
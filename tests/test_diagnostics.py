@@ -0,0 +1,119 @@
+"""Module for testing the diagnostics routes."""
+
+import os
+import unittest
+
+import pytest
+
+from app import create_app, db
+from app.models import seed_db
+from app.profiling import init_profiling
+from tests.helpers import get_json, user1, admin
+
+
+class DiagnosticsTestCase(unittest.TestCase):
+    """Diagnostics tests."""
+
+    def setUp(self):
+        os.environ['ADMIN_EMAIL'] = admin['email']
+        os.environ['ADMIN_PASSWORD'] = admin['password']
+        self.app = create_app("testing")
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.session.close()
+            db.drop_all()
+            db.create_all()
+            seed_db()
+
+    def test_database_diagnostics(self):
+        """Show the engine settings and the SQLite pragmas in effect."""
+        self.client.post('/users/login', data=admin)
+        res = self.client.get('/debug/database')
+        assert res.status_code == 200
+        result = get_json(res)
+        assert result['dialect'] == 'sqlite'
+        assert result['pragmas']['journal_mode'] == 'wal'
+        assert result['pragmas']['busy_timeout'] == 5000
+        assert result['pragmas']['synchronous'] == 0
+
+    def test_only_admin_can_see_diagnostics(self):
+        """Other users are refused."""
+        self.client.post('/users/register', data=user1)
+        self.client.post('/users/login', data=user1)
+        res = self.client.get('/debug/database')
+        assert res.status_code == 403
+
+    def test_rate_limit_diagnostics(self):
+        """Show whether rate limiting is enabled and its limits."""
+        self.client.post('/users/login', data=admin)
+        result = get_json(self.client.get('/debug/rate-limits'))
+        assert result['enabled'] is False
+        assert result['limits']['auth.login'] == '10/minute'
+
+    def enable_profiling(self, sample_rate=0):
+        """Register the profiling hooks on the test app."""
+        self.app.config.update(PROFILING_ENABLED=True,
+                               PROFILE_SAMPLE_RATE=sample_rate,
+                               PROFILE_BUFFER_SIZE=2)
+        init_profiling(self.app)
+
+    def test_profiling_is_off_by_default(self):
+        """Without PROFILING_ENABLED no request is profiled."""
+        self.client.post('/users/login', data=admin)
+        res = self.client.get('/', headers={'X-Profile': '1'})
+        assert 'X-Profile-Id' not in res.headers
+        result = get_json(self.client.get('/debug/profiles'))
+        assert result == {'enabled': False, 'profiles': []}
+
+    def test_admin_can_profile_a_request(self):
+        """The profile header of an admin stores the request's profile."""
+        self.enable_profiling()
+        self.client.post('/users/login', data=admin)
+        assert 'X-Profile-Id' not in self.client.get('/').headers
+        res = self.client.get('/?limit=2', headers={'X-Profile': '1'})
+        profile_id = res.headers['X-Profile-Id']
+        listing = get_json(self.client.get('/debug/profiles'))
+        assert [item['id'] for item in listing['profiles']] == [1]
+        assert listing['profiles'][0]['path'] == '/?limit=2'
+
+        result = get_json(
+            self.client.get('/debug/profiles/{}'.format(profile_id)))
+        assert result['status'] == 200
+        assert result['statements']
+        assert result['queries'][0]['count'] >= 1
+        assert result['functions'][0]['cumulative_ms'] >= \
+            result['functions'][-1]['cumulative_ms']
+        res = self.client.get(
+            '/debug/profiles/{}/collapsed'.format(profile_id))
+        assert res.mimetype == 'text/plain'
+        for line in res.get_data(as_text=True).splitlines():
+            assert int(line.rpartition(' ')[2]) >= 1
+        assert self.client.get('/debug/profiles/9').status_code == 404
+
+    def test_users_cannot_ask_for_profiles(self):
+        """The profile header of other users is ignored."""
+        self.enable_profiling()
+        self.client.post('/users/register', data=user1)
+        self.client.post('/users/login', data=user1)
+        res = self.client.get('/', headers={'X-Profile': '1'})
+        assert 'X-Profile-Id' not in res.headers
+        assert self.client.get('/debug/profiles').status_code == 403
+
+    def test_sampled_profiles_are_bounded(self):
+        """Sampled requests keep only the most recent profiles."""
+        self.enable_profiling(sample_rate=1)
+        for _ in range(3):
+            self.client.get('/categories')
+        self.client.post('/users/login', data=admin)
+        result = get_json(self.client.get('/debug/profiles'))
+        assert [item['id'] for item in result['profiles']] == [4, 3]
+        assert result['profiles'][0]['endpoint'] == 'auth.login'
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,117 @@
+"""Module for testing the server-sent event stream."""
+
+import json
+import os
+import unittest
+
+from app import create_app, db
+from app.cache import LocalStore
+from app.events import Broker, SharedTransport, Subscription
+from app.models import seed_db
+from tests.helpers import admin, algo1, cat1, user2
+
+
+class EventsTestCase(unittest.TestCase):
+    """Event stream tests."""
+
+    def setUp(self):
+        os.environ['ADMIN_EMAIL'] = admin['email']
+        os.environ['ADMIN_PASSWORD'] = admin['password']
+        self.app = create_app("testing")
+        self.app.config['EVENTS_HEARTBEAT'] = 0.01
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.session.close()
+            db.drop_all()
+            db.create_all()
+            seed_db()
+
+    def login(self, user=admin):
+        """Login a user for other tests."""
+        res = self.client.post('/users/login', data=user)
+        assert res.status_code == 200
+
+    def read_event(self, stream):
+        """Return the next event of a stream, skipping heartbeats."""
+        for chunk in stream:
+            chunk = chunk.decode()
+            if chunk.startswith('id:'):
+                fields = dict(line.split(': ', 1)
+                              for line in chunk.strip().split('\n'))
+                return int(fields['id']), json.loads(fields['data'])
+
+    def test_stream_requires_login(self):
+        """Anonymous clients cannot open a stream."""
+        assert self.client.get('/events').status_code == 401
+        self.login()
+        res = self.client.get('/events', headers={'Last-Event-ID': 'x'})
+        assert res.status_code == 400
+
+    def test_stream_pushes_changes(self):
+        """Streams replay from Last-Event-ID, then push new changes."""
+        self.login()
+        self.client.post('/categories', data=cat1)
+        self.client.post('/', data=algo1)
+        res = self.client.get('/events', headers={'Last-Event-ID': '1'},
+                              buffered=False)
+        assert res.status_code == 200
+        assert res.mimetype == 'text/event-stream'
+        assert res.headers['Cache-Control'] == 'no-cache'
+        stream = iter(res.response)
+        assert next(stream) == b'retry: 3000\n\n'
+        seq, change = self.read_event(stream)
+        assert (seq, change['type'], change['id']) == (2, 'algorithm', 1)
+        assert next(stream) == b': heartbeat\n\n'
+
+        self.client.put('/1', data={'title': 'Renamed'})
+        seq, change = self.read_event(stream)
+        assert (seq, change['data']['title']) == (3, 'Renamed')
+        res.close()
+        assert self.app.extensions['events']._count == 0
+
+    def test_stream_filters_algorithms_by_owner(self):
+        """Users only receive their own algorithms, and every category."""
+        self.client.post('/users/register', data=user2)
+        self.login(user2)
+        res = self.client.get('/events', buffered=False)
+        stream = iter(res.response)
+        next(stream)
+        self.login()
+        self.client.post('/categories', data=cat1)
+        self.client.post('/', data=algo1)
+        seq, change = self.read_event(stream)
+        assert (seq, change['type']) == (1, 'category')
+        assert next(stream) == b': heartbeat\n\n'
+        res.close()
+
+    def test_stream_limit(self):
+        """Streams beyond EVENTS_MAX_STREAMS are refused."""
+        self.app.extensions['events'].max_streams = 1
+        self.login()
+        first = self.client.get('/events', buffered=False)
+        assert first.status_code == 200
+        res = self.client.get('/events')
+        assert res.status_code == 503
+        first.close()
+        assert self.client.get('/events', buffered=False).status_code == 200
+
+    def test_subscription_buffer_is_bounded(self):
+        """A full buffer drops wake-ups, which are drained together."""
+        subscription = Subscription(['a'], 2)
+        for message in range(5):
+            subscription.notify(message)
+        assert subscription._messages.qsize() == 2
+        assert subscription.wait(0) is True
+        assert subscription.wait(0) is False
+
+    def test_shared_transport(self):
+        """Messages reach subscribers through a shared transport."""
+        broker = Broker(SharedTransport(LocalStore()))
+        subscription = broker.subscribe(['user:1'], 4)
+        broker.publish('user:2')
+        broker.publish('user:1')
+        assert subscription.wait(1) is True
+        assert subscription.wait(0) is False
+        broker.unsubscribe(subscription)
+        broker.unsubscribe(subscription)
+        assert broker._count == 0
@@ -0,0 +1,107 @@
+"""Module for testing the metrics endpoint."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import pytest
+
+from app import create_app, db
+from app.metrics import Registry, merge, registry, render, snapshot_path
+from app.models import seed_db
+from tests.helpers import admin
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Metrics tests."""
+
+    def setUp(self):
+        os.environ['ADMIN_EMAIL'] = admin['email']
+        os.environ['ADMIN_PASSWORD'] = admin['password']
+        self.app = create_app("testing")
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.session.close()
+            db.drop_all()
+            db.create_all()
+            seed_db()
+        registry.reset()
+
+    def scrape(self, **kwargs):
+        """Return the lines served by /metrics."""
+        res = self.client.get('/metrics', **kwargs)
+        assert res.status_code == 200
+        assert res.mimetype == 'text/plain'
+        return res.get_data(as_text=True).splitlines()
+
+    def test_histograms_are_cumulative(self):
+        """Buckets count every value up to their bound."""
+        samples = Registry()
+        for value in (0, 1, 3, 500):
+            samples.observe('sql_statements_per_request',
+                            (('endpoint', 'x'),), value)
+        lines = render(*merge([samples.snapshot()]))
+        prefix = 'sql_statements_per_request_'
+        assert prefix + 'bucket{endpoint="x",le="0"} 1' in lines
+        assert prefix + 'bucket{endpoint="x",le="1"} 2' in lines
+        assert prefix + 'bucket{endpoint="x",le="5"} 3' in lines
+        assert prefix + 'bucket{endpoint="x",le="100"} 3' in lines
+        assert prefix + 'bucket{endpoint="x",le="+Inf"} 4' in lines
+        assert prefix + 'sum{endpoint="x"} 504' in lines
+        assert prefix + 'count{endpoint="x"} 4' in lines
+
+    def test_requests_are_measured_per_endpoint(self):
+        """Requests, SQL statements and cache lookups are counted."""
+        self.client.get('/')
+        self.client.get('/')
+        self.client.get('/categories')
+        self.client.post('/users/login', data=admin)
+        lines = self.scrape()
+        assert ('http_requests_total{endpoint="algorithm.home",'
+                'method="GET",status="200"} 2') in lines
+        assert ('http_requests_total{endpoint="auth.login",'
+                'method="POST",status="200"} 1') in lines
+        assert ('http_request_duration_seconds_count'
+                '{endpoint="category.categories"} 1') in lines
+        assert ('http_response_size_bytes_bucket'
+                '{endpoint="algorithm.home",le="+Inf"} 2') in lines
+        assert ('sql_statements_per_request_bucket'
+                '{endpoint="auth.login",le="0"} 0') in lines
+        assert any(line.startswith('db_pool_checkouts_total ')
+                   for line in lines)
+        assert 'cache_hits_total{cache="response"} 1' in lines
+        assert 'cache_hit_ratio{cache="response"} 0.5' in lines
+
+    def test_metrics_of_workers_are_added_up(self):
+        """With METRICS_DIR, the files of every process are summed."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config.update(METRICS_DIR=directory,
+                               METRICS_FLUSH_INTERVAL=0)
+        other = Registry()
+        other.inc('http_requests_total', (
+            ('endpoint', 'algorithm.home'), ('method', 'GET'),
+            ('status', '200')), 3)
+        with open(snapshot_path(directory, pid=1), 'w') as stream:
+            json.dump(other.snapshot(), stream)
+        self.client.get('/')
+        assert os.path.exists(snapshot_path(directory))
+        assert ('http_requests_total{endpoint="algorithm.home",'
+                'method="GET",status="200"} 4') in self.scrape()
+
+    def test_scrapes_can_require_a_token(self):
+        """With METRICS_TOKEN set, scrapes must send it."""
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        assert self.client.get('/metrics').status_code == 401
+        self.scrape(headers={'Authorization': 'Bearer secret'})
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    pytest.main()
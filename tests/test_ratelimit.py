@@ -0,0 +1,99 @@
+"""Module for testing rate limiting."""
+
+import os
+import unittest
+
+import pytest
+
+from app import create_app, db
+from app.cache import LocalStore
+from app.models import seed_db
+from app.ratelimit import (
+    MemoryBuckets, RateLimiter, SharedBuckets, parse_limit)
+from tests.helpers import admin, get_json, user1
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """Rate limiting tests."""
+
+    def setUp(self):
+        os.environ['ADMIN_EMAIL'] = admin['email']
+        os.environ['ADMIN_PASSWORD'] = admin['password']
+        self.app = create_app("testing")
+        self.app.config['RATE_LIMITS'] = {
+            'default': '100/minute',
+            'auth.login': '3/minute',
+            'auth.login:email': '3/minute',
+            'category': '2/minute',
+            'category.category': None
+        }
+        self.limiter = RateLimiter(MemoryBuckets())
+        self.app.extensions['rate_limiter'] = self.limiter
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.session.close()
+            db.drop_all()
+            db.create_all()
+            seed_db()
+
+    def test_token_bucket_refills(self):
+        """A bucket allows a burst of its capacity, then refills over time."""
+        limit = parse_limit('2/second')
+        key, other = [('key', limit)], [('other', limit)]
+        for buckets in (MemoryBuckets(), SharedBuckets(LocalStore())):
+            assert buckets.take(key, 100.0) == 0
+            assert buckets.take(key, 100.0) == 0
+            assert buckets.take(key, 100.0) == 0.5
+            assert buckets.take(key, 100.6) == 0
+            assert buckets.take(other, 100.6) == 0
+
+    def test_refused_request_takes_no_token(self):
+        """A request refused by one bucket leaves the others full."""
+        limit = parse_limit('1/second')
+        for buckets in (MemoryBuckets(), SharedBuckets(LocalStore())):
+            assert buckets.take([('a', limit)], 100.0) == 0
+            assert buckets.take([('b', limit), ('a', limit)], 100.0) == 1
+            assert buckets.take([('b', limit)], 100.0) == 0
+
+    def test_login_is_throttled(self):
+        """Logins past the limit get 429 with Retry-After."""
+        for _ in range(3):
+            res = self.client.post('/users/login', data=user1)
+            assert res.status_code != 429
+        res = self.client.post('/users/login', data=admin)
+        assert res.status_code == 429
+        assert get_json(res)['message'] == 'Too many requests.'
+        assert 1 <= int(res.headers['Retry-After']) <= 20
+        assert self.client.get('/').status_code == 200
+        assert self.limiter.snapshot()['shed'] == {'auth.login': 1}
+
+    def test_login_is_throttled_per_email(self):
+        """Logins to one account are limited per address."""
+        self.app.config['RATE_LIMITS']['auth.login:email'] = '1/minute'
+        statuses = [self.client.post('/users/login', data=user1).status_code
+                    for _ in range(3)]
+        assert statuses[0] != 429 and statuses[1:] == [429, 429]
+        res = self.client.post('/users/login', data=admin)
+        assert res.status_code == 200
+        res = self.client.post('/users/login', data=user1,
+                               environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        assert res.status_code != 429
+
+    def test_limits_per_blueprint_and_endpoint(self):
+        """Blueprint limits apply unless an endpoint has its own."""
+        self.client.post('/users/login', data=admin)
+        statuses = [self.client.get('/categories').status_code
+                    for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        statuses = [self.client.get('/categories/1').status_code
+                    for _ in range(3)]
+        assert 429 not in statuses
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,124 @@
+"""Module for testing read replica routing."""
+
+import os
+import unittest
+from unittest import mock
+
+import pytest
+from flask import g
+
+from app import create_app, db, login_manager
+from app.models import Algorithm, seed_db
+from app.ratelimit import make_limiter
+from config import get_sqlite_url
+from tests.helpers import admin, algo1, cat1, get_json
+
+REPLICA_DB = 'test_replica.db'
+OTHER_REPLICA_DB = 'test_replica_1.db'
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """Read replica tests."""
+
+    def setUp(self):
+        os.environ['ADMIN_EMAIL'] = admin['email']
+        os.environ['ADMIN_PASSWORD'] = admin['password']
+        self.app = create_app("testing")
+        self.app.config['SQLALCHEMY_BINDS'] = {
+            'replica_0': get_sqlite_url(REPLICA_DB)}
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.session.close()
+            db.drop_all(bind=None)
+            db.create_all(bind=None)
+            seed_db()
+            replica = db.get_engine(self.app, 'replica_0')
+            db.Model.metadata.drop_all(replica)
+            db.Model.metadata.create_all(replica)
+
+    def create_algorithm(self):
+        """Create an algorithm on the primary."""
+        self.client.post('/users/login', data=admin)
+        self.client.post('/categories', data=cat1)
+        res = self.client.post('/', data=algo1)
+        assert res.status_code == 201
+
+    def replicate(self, title):
+        """Copy the algorithm to the replica under another title."""
+        with self.app.app_context():
+            replica = db.get_engine(self.app, 'replica_0')
+            replica.execute(Algorithm.__table__.insert(), id=1, title=title,
+                            user_id=1, category_id=1)
+
+    def unpin(self):
+        """Let the client read from replicas again."""
+        with self.client.session_transaction() as session:
+            session['primary_until'] = 0
+
+    def test_reads_go_to_replica_after_write_window(self):
+        """Writers read their own writes, then reads move to the replica."""
+        self.create_algorithm()
+        self.replicate('Replica Sort')
+        res = self.client.get('/users/algorithms')
+        assert get_json(res)[0]['title'] == 'Binary Sort'
+
+        self.unpin()
+        res = self.client.get('/users/algorithms')
+        assert get_json(res)[0]['title'] == 'Replica Sort'
+
+    def test_cached_responses_are_read_from_primary(self):
+        """Responses stored in the cache never come from a replica."""
+        self.create_algorithm()
+        self.replicate('Replica Sort')
+        self.unpin()
+        assert get_json(self.client.get('/1'))['title'] == 'Binary Sort'
+        res = self.client.get('/users/algorithms')
+        assert get_json(res)[0]['title'] == 'Replica Sort'
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        """Reads use the primary when no replica passes its health check."""
+        self.app.config['SQLALCHEMY_BINDS'] = {
+            'replica_0': 'sqlite:////nonexistent/replica.db'}
+        self.create_algorithm()
+        self.unpin()
+        res = self.client.get('/users/algorithms')
+        assert get_json(res)[0]['title'] == 'Binary Sort'
+
+    def test_user_is_loaded_from_replica(self):
+        """Hooks loading the user run once the replica has been chosen."""
+        self.app.config['RATE_LIMIT_BACKEND'] = 'memory'
+        self.app.extensions['rate_limiter'] = make_limiter(self.app.config)
+        self.create_algorithm()
+        self.unpin()
+        callback, routed = login_manager._user_callback, []
+
+        def load_user(user_id):
+            routed.append(g.get('use_replica'))
+            return callback(user_id)
+        with mock.patch.object(login_manager, '_user_callback', load_user):
+            self.client.get('/users/algorithms')
+        assert routed == [True]
+
+    def test_session_sticks_to_one_replica(self):
+        """Every read of a session goes to the same replica."""
+        self.app.config['SQLALCHEMY_BINDS'] = {
+            'replica_0': get_sqlite_url(REPLICA_DB),
+            'replica_1': get_sqlite_url(OTHER_REPLICA_DB)}
+        with self.app.test_request_context():
+            g.use_replica = True
+            chosen = {db.session.get_bind() for _ in range(4)}
+            assert len(chosen) == 1
+            db.session.remove()
+            assert db.session.get_bind() not in chosen
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all(bind=None)
+        for path in (REPLICA_DB, OTHER_REPLICA_DB):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    pytest.main()
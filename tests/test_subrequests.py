@@ -0,0 +1,139 @@
+"""Module for testing the multi-request batch endpoint."""
+
+import json
+import os
+import unittest
+from unittest import mock
+
+from app import create_app, db, login_manager
+from app.models import seed_db
+from tests.helpers import admin, algo1, cat1, get_json
+
+
+class BatchRequestsTestCase(unittest.TestCase):
+    """Batch request tests."""
+
+    def setUp(self):
+        os.environ['ADMIN_EMAIL'] = admin['email']
+        os.environ['ADMIN_PASSWORD'] = admin['password']
+        self.app = create_app("testing")
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.session.close()
+            db.drop_all()
+            db.create_all()
+            seed_db()
+
+    def login(self):
+        """Login a user for other tests."""
+        res = self.client.post('/users/login', data=admin)
+        assert res.status_code == 200
+
+    def batch(self, requests, status=200):
+        """Post a batch and return its JSON."""
+        res = self.client.post('/batch', data=json.dumps(requests),
+                               content_type='application/json')
+        assert res.status_code == status
+        return get_json(res)
+
+    def test_batch_runs_requests_in_order(self):
+        """Writes are seen by the requests that follow them."""
+        self.login()
+        result = self.batch({'requests': [
+            {'method': 'POST', 'path': '/categories', 'body': cat1},
+            {'method': 'POST', 'path': '/', 'body': algo1},
+            {'method': 'GET', 'path': '/categories'},
+            {'method': 'GET', 'path': '/users/algorithms'},
+            {'method': 'GET', 'path': '/1'},
+            {'method': 'PUT', 'path': '/1', 'body': {'title': 'Renamed'}},
+            {'method': 'GET', 'path': '/1?fields=title'},
+            {'method': 'GET', 'path': '/99'}]})
+        responses = result['responses']
+        assert [item['status'] for item in responses] == [
+            201, 201, 200, 200, 200, 200, 200, 404]
+        assert responses[2]['body'] == [{'id': 1, 'name': 'codility'}]
+        assert responses[3]['body'][0]['title'] == 'Binary Sort'
+        assert responses[4]['body']['content'] == algo1['content']
+        assert responses[6]['body']['title'] == 'Renamed'
+        assert 'ETag' in responses[4]['headers']
+
+    def test_batch_shares_login(self):
+        """Sub-requests reuse the batch's user instead of loading it."""
+        self.client.post('/batch', json=[{'method': 'GET', 'path': '/'}])
+        self.login()
+        with mock.patch.object(login_manager, '_user_callback',
+                               wraps=login_manager._user_callback) as load:
+            result = self.batch([
+                {'method': 'GET', 'path': '/categories'},
+                {'method': 'GET', 'path': '/users/algorithms'},
+                {'method': 'POST', 'path': '/categories', 'body': cat1},
+                {'method': 'GET', 'path': '/categories'}])
+        assert load.call_count == 1
+        assert [item['status'] for item in result['responses']] == [
+            200, 200, 201, 200]
+        self.client.post('/users/logout')
+        result = self.batch([{'method': 'GET', 'path': '/categories'}])
+        assert result['responses'][0]['status'] == 401
+
+    def test_sub_responses_are_not_compressed(self):
+        """Sub-requests asking for a compressed body get plain JSON."""
+        self.login()
+        self.client.post('/categories', data=cat1)
+        self.client.post('/', data=dict(algo1, content='x = 1\n' * 200))
+        result = self.batch([{'method': 'GET', 'path': '/',
+                              'headers': {'Accept-Encoding': 'gzip'}}])
+        response = result['responses'][0]
+        assert response['status'] == 200
+        assert 'Content-Encoding' not in response['headers']
+        assert response['body'][0]['title'] == algo1['title']
+
+    def test_batch_runs_sequentially(self):
+        """BATCH_WORKERS of 1 runs every request on the batch's thread."""
+        self.app.config['BATCH_WORKERS'] = 1
+        self.login()
+        result = self.batch([
+            {'method': 'POST', 'path': '/categories', 'body': cat1},
+            {'method': 'GET', 'path': '/categories'},
+            {'method': 'GET', 'path': '/categories/1'}])
+        assert [item['status'] for item in result['responses']] == [
+            201, 200, 200]
+
+    def test_batch_limits(self):
+        """Oversized, nested and malformed batches are refused."""
+        self.login()
+        self.batch({}, 400)
+        self.batch([{'method': 'GET'}], 400)
+        self.batch([{'method': 'GET', 'path': '/', 'body': []}], 400)
+        self.app.config['BATCH_MAX_REQUESTS'] = 2
+        assert self.batch([{'method': 'GET', 'path': '/'}] * 3, 400) == {
+            'message': 'Too many requests.'}
+        result = self.batch([
+            {'method': 'POST', 'path': '/batch', 'json': []},
+            {'method': 'GET', 'path': '/events'}])
+        assert [item['status'] for item in result['responses']] == [400, 400]
+        assert self.app.extensions['events']._count == 0
+
+        self.client.post('/categories', data=cat1)
+        self.client.post('/', data=algo1)
+        self.app.config['BATCH_MAX_RESPONSE_SIZE'] = 50
+        result = self.batch([
+            {'method': 'GET', 'path': '/categories'},
+            {'method': 'GET', 'path': '/1'}])
+        assert [(item['status'], item.get('truncated'))
+                for item in result['responses']] == [(200, None), (200, True)]
+        assert result['responses'][1]['body'] is None
+
+    def test_write_crossing_response_limit(self):
+        """A write past the limit reports its status; later ones never run."""
+        self.login()
+        self.client.post('/categories', data=cat1)
+        self.app.config['BATCH_MAX_RESPONSE_SIZE'] = 50
+        result = self.batch([
+            {'method': 'GET', 'path': '/categories'},
+            {'method': 'POST', 'path': '/', 'body': algo1},
+            {'method': 'POST', 'path': '/', 'body': algo1}])
+        responses = result['responses']
+        assert [item['status'] for item in responses] == [200, 201, 413]
+        assert responses[1]['truncated'] is True
+        assert responses[1]['body'] is None
+        assert len(get_json(self.client.get('/'))) == 1
@@ -1,16 +1,26 @@
 """Module for testing the user registration and login."""
 
-import os
 import unittest
 import json
 
+import pytest
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+
 from app import create_app, db
+from app.hashing import needs_rehash, stats
+from app.identity import identity_cache
+from app.models import DBHelper, User, seed_db
 from tests.helpers import user1, admin
 
 
 class AuthTestCase(unittest.TestCase):
     """User userentication tests."""
 
+    @pytest.fixture(autouse=True)
+    def use_monkeypatch(self, monkeypatch):
+        """Give tests pytest's monkeypatch."""
+        self.monkeypatch = monkeypatch
+
     def setUp(self):
         self.app = create_app("testing")
         self.client = self.app.test_client()
@@ -18,6 +28,7 @@ class AuthTestCase(unittest.TestCase):
             db.session.close()
             db.drop_all()
             db.create_all()
+            seed_db()
 
     def test_user_registration(self):
         """Test for successful user registration."""
@@ -75,15 +86,86 @@ class AuthTestCase(unittest.TestCase):
         self.assertEqual(logout_res.status_code, 200)
 
     def test_seeding_the_db_with_admnin_details(self):
-        """Seed the database."""
-        os.environ['ADMIN_EMAIL'] = admin['email']
-        os.environ['ADMIN_PASSWORD'] = admin['password']
-        client = create_app("testing").test_client()
+        """Seed the database with the seed command."""
+        self.monkeypatch.setenv('ADMIN_EMAIL', admin['email'])
+        self.monkeypatch.setenv('ADMIN_PASSWORD', admin['password'])
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
+        login_res = self.client.post('/users/login', data=admin)
+        assert login_res.status_code != 200
 
-        login_res = client.post('/users/login', data=admin)
+        result = self.app.test_cli_runner().invoke(args=['seed'])
+        assert 'admin user is ready' in result.output
+        login_res = self.client.post('/users/login', data=admin)
         assert login_res.status_code == 200
         assert json.loads(login_res.data)['message'] == "Login successful."
 
+    def test_login_upgrades_outdated_password_hash(self):
+        """Logging in rehashes passwords stored with old parameters."""
+        self.register()
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.login_user()
+        with self.app.app_context():
+            user = User.query.filter_by(email=user1['email']).first()
+            assert user.password.startswith('pbkdf2:sha256:2000$')
+        self.client.post('/users/logout')
+        self.login_user()
+
+    def test_login_keeps_current_password_hash(self):
+        """Hashes using the configured parameters are not rehashed."""
+        self.register()
+        with self.app.app_context():
+            password = User.query.filter_by(
+                email=user1['email']).first().password
+        self.login_user()
+        with self.app.app_context():
+            user = User.query.filter_by(email=user1['email']).first()
+            assert user.password == password
+            self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:SHA256'
+            assert not needs_rehash(
+                'pbkdf2:sha256$' + 'a' * 16 + '$digest')
+            assert not needs_rehash(
+                'pbkdf2:sha256:{}${}$digest'.format(
+                    DEFAULT_PBKDF2_ITERATIONS, 'a' * 16))
+            assert needs_rehash('pbkdf2:sha256:x$' + 'a' * 16 + '$digest')
+            assert needs_rehash('pbkdf2:sha1$' + 'a' * 16 + '$digest')
+
+    def login_user(self):
+        """Login the registered user."""
+        login_res = self.client.post('/users/login', data=user1)
+        self.assertEqual(login_res.status_code, 200)
+
+    def test_password_hashing_on_process_pool(self):
+        """Hashes computed on the process pool are counted."""
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        self.register()
+        stats.reset()
+        self.login_user()
+        self.client.post('/users/register', data={
+            'email': 'ichigo@bleach.com', 'password': 'getsuga'})
+        snapshot = stats.snapshot()
+        assert snapshot['counts'] == {'hash': 1, 'check': 1}
+        assert snapshot['seconds']['hash'] > 0
+
+    def test_identity_cache(self):
+        """Logged-in requests reuse the cached identity until it changes."""
+        self.login()
+        with self.app.app_context():
+            cache = identity_cache()
+        self.client.get('/users/algorithms')
+        misses = cache.misses
+        self.client.get('/users/algorithms')
+        assert cache.misses == misses
+        assert cache.hits >= 1
+
+        with self.app.app_context():
+            user = User.query.filter_by(email=user1['email']).first()
+            user.role = 'admin'
+            DBHelper.add(user)
+        self.client.get('/users/algorithms')
+        assert cache.misses == misses + 1
+
     def tearDown(self):
         with self.app.app_context():
             db.session.remove()